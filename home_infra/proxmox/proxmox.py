@@ -269,7 +269,6 @@ class Proxmox:
         self.reboot_after_grub = PulumiExtras.reboot_remote_host(
             resource_name="ProxmoxRebootAfterGrub",
             connection=pulumi_connection,
-            seconds_to_wait_for_reboot=140,
             use_sudo=True,
             opts=pulumi.ResourceOptions(
                 parent=self.modify_grub,
@@ -300,7 +299,6 @@ class Proxmox:
             resource_name="ProxmoxRebootAfterGpuVfio",
             connection=pulumi_connection,
             use_sudo=True,
-            seconds_to_wait_for_reboot=140,
             opts=pulumi.ResourceOptions(
                 parent=self.gpu_vfio_update_initramfs,
                 depends_on=[],
@@ -374,7 +372,6 @@ class Proxmox:
         self.reboot_after_isolating_gpu = PulumiExtras.reboot_remote_host(
             resource_name="ProxmoxRebootAfterGpuIsolated",
             connection=pulumi_connection,
-            seconds_to_wait_for_reboot=140,
             use_sudo=True,
             opts=pulumi.ResourceOptions(
                 parent=self.isolate_gpu,
@@ -591,14 +588,13 @@ class Proxmox:
             api_verify_ssl=False,
         )
 
-        # Start the VM and pause for 60 seconds
+        # Start the VM and wait until it (and its guest agent) is up
         self.nixos_samba_server_start_vm = StartVm(
             resource_name="StartNixOsSambaServer",
             start_vm_args=StartVmArgs(
                 proxmox_connection_args=proxmox_connection_args,
                 node_name="pve",
                 vm_id=vm_id,
-                wait=60,
             ),
             opts=pulumi.ResourceOptions(
                 parent=self.create_nixos_smb_vm,
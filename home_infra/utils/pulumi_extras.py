@@ -7,6 +7,8 @@ import pulumi_command
 from pulumi import Output
 from pulumi_command.remote import ConnectionArgs
 
+from pulumi_mrsharky.remote.wait_for_host import WaitForHost, WaitForHostArgs
+
 
 class PulumiExtras:
     @staticmethod
@@ -139,28 +141,64 @@ class PulumiExtras:
     def reboot_remote_host(
         resource_name: str,
         connection: pulumi.Input[pulumi.InputType[ConnectionArgs]],
-        seconds_to_wait_for_reboot: int = 120,
+        seconds_to_wait_for_reboot: int = 300,
         use_sudo: bool = False,
         opts: Optional[pulumi.ResourceOptions] = None,
-    ):
+    ) -> pulumi_command.remote.Command:
+        # Reboot and actively wait until the host is back on a new boot (instead
+        # of a fixed sleep). Fails fast if the host never goes down.
+        # NOTE: seconds_to_wait_for_reboot is an upper bound, not a delay
+        # NOTE: The RebootCommand -> Delay -> CheckBackUp resources (and the
+        #       returned CheckBackUp, which callers parent other resources on)
+        #       keep their names / types, so existing stacks don't reboot again
+        #       or replace anything downstream
         reboot_cmd = "reboot now"
         if use_sudo:
             reboot_cmd = "sudo reboot now"
 
-        # Reboot
+        # Print the current boot_id, then reboot once the command has returned.
+        # NOTE: create is ignored on existing stacks, they already rebooted
         reboot_now = PulumiExtras.run_command_on_remote_host(
             resource_name=f"{resource_name}RebootCommand",
             connection=connection,
-            create=reboot_cmd,
-            opts=opts,
+            create=(
+                "cat /proc/sys/kernel/random/boot_id && "
+                f"(nohup sh -c 'sleep 1; {reboot_cmd}' > /dev/null 2>&1 &)"
+            ),
+            opts=pulumi.ResourceOptions.merge(
+                opts, pulumi.ResourceOptions(ignore_changes=["create"])
+            ),
+        )
+
+        # Wait for a new boot_id. Existing stacks have no previous boot_id (the
+        # old command didn't print one), so this only checks the host is up
+        port = connection.port
+        if port is None:
+            port = 22
+        wait_for_reboot = WaitForHost(
+            resource_name=f"{resource_name}WaitForReboot",
+            wait_for_host_args=WaitForHostArgs(
+                host=connection.host,
+                user=connection.user,
+                port=port,
+                password=connection.password,
+                private_key=connection.private_key,
+                max_wait_for_reboot_in_seconds=seconds_to_wait_for_reboot,
+                previous_boot_id=reboot_now.stdout.apply(
+                    lambda stdout: (stdout or "").strip() or None
+                ),
+                max_wait_for_shutdown_in_seconds=60,
+            ),
+            opts=pulumi.ResourceOptions(parent=reboot_now),
         )
 
-        # Since it can take time for the PC to reboot, force a delay.
+        # Only kept for its place in the resource tree (was a fixed sleep)
         delay = pulumi_command.local.Command(
             resource_name=f"{resource_name}Delay",
-            create=f"sleep {seconds_to_wait_for_reboot}",
+            create="true",
             opts=pulumi.ResourceOptions(
                 parent=reboot_now,
+                ignore_changes=["create"],
             ),
         )
 
@@ -170,6 +208,7 @@ class PulumiExtras:
             create="echo 'Server is back online'",
             opts=pulumi.ResourceOptions(
                 parent=delay,
+                depends_on=[wait_for_reboot],
             ),
         )
         return check_back_up
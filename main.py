@@ -10,6 +10,7 @@ from pulumi.automation import LocalWorkspaceOptions, ProjectRuntimeInfo, Project
 from pulumi_mrsharky.common.helpers import generate_private_key
 from pulumi_mrsharky.nixos.nix_settings import NixSettings
 from pulumi_mrsharky.nixos.nixos import NixosBase
+from pulumi_mrsharky.proxmox.provisioning_scheduler import ProvisioningScheduler
 from pulumi_mrsharky.proxmox.proxmox_base import ProxmoxBase
 from pulumi_mrsharky.proxmox.proxmox_nixos import ProxmoxNixOS
 
@@ -56,6 +57,11 @@ def pulumi_program():
     proxmox_nixos = ProxmoxNixOS(
         resource_name_prefix="ProxmoxNixOS",
         proxmox_base=proxmox_server,
+        provisioning_scheduler=ProvisioningScheduler(
+            max_concurrent_clones_per_storage=settings.get(
+                "max_concurrent_clones_per_storage", 1
+            ),
+        ),
     )
 
     # if True:
@@ -84,6 +90,8 @@ def pulumi_program():
             ip_v4_cidr=cidr,
             start_on_boot=nixos_vm.get("start_on_boot", False),
             hardware_passthrough=nixos_vm.get("hardware_passthrough", []),
+            clone_mode=nixos_vm.get("clone_mode"),
+            promote_to_storage=nixos_vm.get("promote_to_storage"),
         )
 
         # Create the connection
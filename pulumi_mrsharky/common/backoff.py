@@ -0,0 +1,62 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def poll_with_backoff(
+    check: Callable[[], Optional[T]],
+    max_wait_in_seconds: float,
+    description: str,
+    initial_delay_in_seconds: float = 1.0,
+    max_delay_in_seconds: float = 10.0,
+    factor: float = 1.5,
+) -> T:
+    """
+    Call `check` until it returns something other than None, sleeping with a
+    capped exponential backoff between attempts. Raises once
+    `max_wait_in_seconds` has elapsed.
+    """
+    deadline = time.time() + max_wait_in_seconds
+    delay = initial_delay_in_seconds
+    while True:
+        result = check()
+        if result is not None:
+            return result
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError(
+                f"Timed out after {max_wait_in_seconds} seconds waiting for {description}"
+            )
+        time.sleep(min(delay, remaining))
+        delay = min(delay * factor, max_delay_in_seconds)
+
+
+async def poll_with_backoff_async(
+    check: Callable[[], Awaitable[Optional[T]]],
+    max_wait_in_seconds: float,
+    description: str,
+    initial_delay_in_seconds: float = 1.0,
+    max_delay_in_seconds: float = 10.0,
+    factor: float = 1.5,
+) -> T:
+    """
+    Same as poll_with_backoff, for a coroutine `check` (other polls keep
+    running while this one sleeps).
+    """
+    deadline = time.time() + max_wait_in_seconds
+    delay = initial_delay_in_seconds
+    while True:
+        result = await check()
+        if result is not None:
+            return result
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError(
+                f"Timed out after {max_wait_in_seconds} seconds waiting for {description}"
+            )
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * factor, max_delay_in_seconds)
@@ -1,12 +1,15 @@
-import io
 import socket
 import time
-from typing import Optional
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
 
 import paramiko
 from paramiko.client import SSHClient
 from pulumi import Input
 
+from pulumi_mrsharky.common.backoff import poll_with_backoff
+from pulumi_mrsharky.common.ssh_pool import SshConnectionPool
+
 IOMMU_GRUB = {
     "INTEL": "quiet intel_iommu=on iommu=pt pcie_acs_override=downstream",
     "AMD": "quiet amd_iommu=on iommu=pt pcie_acs_override=downstream",
@@ -27,67 +30,173 @@ class RemoteMethods:
         password: Optional[Input[str]] = None,
         private_key: Optional[Input[str]] = None,
     ) -> SSHClient:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        # SSH > Password
-        if private_key is not None:
-            pkey = paramiko.RSAKey.from_private_key(io.StringIO(private_key))
-            ssh.connect(hostname=host, username=user, port=port, pkey=pkey, timeout=10)
-        elif password is not None:
-            ssh.connect(
-                hostname=host, username=user, port=port, password=password, timeout=10
-            )
-        if password is None and private_key is None:
-            raise Exception("Must either have a password or private_key")
-        return ssh
+        # Connections are shared process-wide, callers must not close them.
+        # The connection stays checked out until return_ssh_connection() (see
+        # ssh_session() for a with block that does both). Use
+        # release_ssh_connection() to drop one that is known to be stale.
+        return SshConnectionPool.instance().get(
+            host=host,
+            user=user,
+            port=port,
+            password=password,
+            private_key=private_key,
+        )
 
     @staticmethod
-    def wait_for_remote_host(
+    def return_ssh_connection(ssh: SSHClient) -> None:
+        SshConnectionPool.instance().release(ssh)
+        return
+
+    @staticmethod
+    @contextmanager
+    def ssh_session(
+        host: Optional[Input[str]],
+        user: Optional[Input[str]],
+        port: Optional[Input[int]],
+        password: Optional[Input[str]] = None,
+        private_key: Optional[Input[str]] = None,
+    ) -> Iterator[SSHClient]:
+        # Pooled connection, checked out (never closed) for the with block
+        with SshConnectionPool.instance().checkout(
+            host=host,
+            user=user,
+            port=port,
+            password=password,
+            private_key=private_key,
+        ) as ssh:
+            yield ssh
+
+    @staticmethod
+    def release_ssh_connection(
+        host: Optional[Input[str]],
+        user: Optional[Input[str]],
+        port: Optional[Input[int]],
+        password: Optional[Input[str]] = None,
+        private_key: Optional[Input[str]] = None,
+    ) -> None:
+        SshConnectionPool.instance().evict(
+            host=host,
+            user=user,
+            port=port,
+            password=password,
+            private_key=private_key,
+        )
+        return
+
+    @staticmethod
+    def get_boot_id(ssh: SSHClient) -> str:
+        # Changes on every boot, so it tells us if a reboot actually happened
+        raw_results = ssh.exec_command("cat /proc/sys/kernel/random/boot_id")
+        return raw_results[1].read().decode("ascii").strip()
+
+    @staticmethod
+    def probe_tcp_port(host: str, port: int, timeout_in_seconds: float = 2) -> bool:
+        try:
+            with socket.create_connection((host, port), timeout=timeout_in_seconds):
+                return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def wait_for_boot(
         host: str,
         user: str,
         port: int,
         password: Optional[str] = None,
         private_key: Optional[str] = None,
         max_wait_for_reboot_in_seconds: int = 300,
-    ) -> float:
-        # Loop and wait
-        connected = False
+        previous_boot_id: Optional[str] = None,
+        max_wait_for_shutdown_in_seconds: Optional[int] = None,
+    ) -> Tuple[float, str]:
+        """
+        Wait until the host accepts ssh again. If `previous_boot_id` is given,
+        also wait until the host reports a different boot_id (i.e. it really
+        did go down and come back). Returns (seconds waited, current boot_id).
+
+        With `max_wait_for_shutdown_in_seconds`, give up early if the host
+        stays reachable on its old boot for that long (the reboot never ran).
+        """
+        # Any pooled connection to this host is stale at this point
+        SshConnectionPool.instance().evict_host(host)
         start_time = time.time()
-        finish_time = -100.0
-        ssh: SSHClient
-        while (
-            start_time + max_wait_for_reboot_in_seconds > time.time()
-            or connected is True
-        ):
+        went_down = False
+
+        def check() -> Optional[str]:
+            nonlocal went_down
+
+            # Cheap TCP probe first, only do the full ssh handshake once it's open
+            if not RemoteMethods.probe_tcp_port(host=host, port=port):
+                went_down = True
+                return None
             try:
-                ssh = RemoteMethods.ssh_connection(
+                with RemoteMethods.ssh_session(
                     host=host,
                     user=user,
                     port=port,
                     password=password,
                     private_key=private_key,
-                )
-                connected = True
-                finish_time = time.time() - start_time
-                break
+                ) as ssh:
+                    boot_id = RemoteMethods.get_boot_id(ssh)
             except (
                 paramiko.ssh_exception.NoValidConnectionsError,
                 paramiko.ssh_exception.SSHException,
+                EOFError,
                 TimeoutError,
                 socket.timeout,
                 socket.error,
             ):
-                time.sleep(5)
-
-        if not connected:
+                went_down = True
+                SshConnectionPool.instance().evict_host(host)
+                return None
+
+            if previous_boot_id is not None and boot_id == previous_boot_id:
+                # Still the old boot, the reboot hasn't started yet
+                SshConnectionPool.instance().evict_host(host)
+                if (
+                    max_wait_for_shutdown_in_seconds is not None
+                    and not went_down
+                    and time.time() - start_time > max_wait_for_shutdown_in_seconds
+                ):
+                    raise Exception(
+                        f"Host '{host}' never went down after "
+                        f"{max_wait_for_shutdown_in_seconds} seconds, reboot failed."
+                    )
+                return None
+            return boot_id
+
+        try:
+            boot_id = poll_with_backoff(
+                check=check,
+                max_wait_in_seconds=max_wait_for_reboot_in_seconds,
+                description=f"host '{host}'",
+            )
+        except TimeoutError:
             raise Exception(f"Host '{host}', took to long to reboot.")
 
-        # Cleanup the SSH connection
-        ssh.close()
+        # NOTE: The new connection stays in the pool for whoever needs it next
+        return time.time() - start_time, boot_id
+
+    @staticmethod
+    def wait_for_remote_host(
+        host: str,
+        user: str,
+        port: int,
+        password: Optional[str] = None,
+        private_key: Optional[str] = None,
+        max_wait_for_reboot_in_seconds: int = 300,
+    ) -> float:
+        finish_time, _ = RemoteMethods.wait_for_boot(
+            host=host,
+            user=user,
+            port=port,
+            password=password,
+            private_key=private_key,
+            max_wait_for_reboot_in_seconds=max_wait_for_reboot_in_seconds,
+        )
         return finish_time
 
     @staticmethod
-    def reboot_function(
+    def reboot_and_wait(
         host: str,
         user: str,
         port: int,
@@ -95,27 +204,53 @@ class RemoteMethods:
         private_key: Optional[str] = None,
         max_wait_for_reboot_in_seconds: int = 300,
         use_sudo: bool = False,
-    ) -> float:
-        # Connect using the proper creds and reboot the computer
-        ssh = RemoteMethods.ssh_connection(
+        force: bool = True,
+        max_wait_for_shutdown_in_seconds: int = 60,
+    ) -> Tuple[float, str]:
+        # Connect using the proper creds and note the current boot before rebooting
+        with RemoteMethods.ssh_session(
             host=host, user=user, port=port, password=password, private_key=private_key
+        ) as ssh:
+            previous_boot_id = RemoteMethods.get_boot_id(ssh)
+
+            # A forced reboot skips the clean shutdown of services
+            command_to_run = "/sbin/reboot > /dev/null 2>&1 &"
+            if force:
+                command_to_run = "/sbin/reboot -f > /dev/null 2>&1 &"
+            if use_sudo:
+                command_to_run = f"sudo {command_to_run}"
+            ssh.exec_command(command_to_run)
+
+        # Wait for a new boot_id
+        return RemoteMethods.wait_for_boot(
+            host=host,
+            user=user,
+            port=port,
+            password=password,
+            private_key=private_key,
+            max_wait_for_reboot_in_seconds=max_wait_for_reboot_in_seconds,
+            previous_boot_id=previous_boot_id,
+            max_wait_for_shutdown_in_seconds=max_wait_for_shutdown_in_seconds,
         )
-        command_to_run = "/sbin/reboot -f > /dev/null 2>&1 &"
-        if use_sudo:
-            command_to_run = f"sudo {command_to_run}"
-        ssh.exec_command(command_to_run)
-        ssh.close()
-
-        # Wait for ssh to close
-        time.sleep(30)
 
-        finish_time = RemoteMethods.wait_for_remote_host(
+    @staticmethod
+    def reboot_function(
+        host: str,
+        user: str,
+        port: int,
+        password: Optional[str] = None,
+        private_key: Optional[str] = None,
+        max_wait_for_reboot_in_seconds: int = 300,
+        use_sudo: bool = False,
+    ) -> float:
+        finish_time, _ = RemoteMethods.reboot_and_wait(
             host=host,
             user=user,
             port=port,
             password=password,
             private_key=private_key,
             max_wait_for_reboot_in_seconds=max_wait_for_reboot_in_seconds,
+            use_sudo=use_sudo,
         )
         return finish_time
 
@@ -128,84 +263,80 @@ class RemoteMethods:
         private_key: Optional[Input[str]] = None,
     ):
         # Connect using the proper creds
-        ssh = RemoteMethods.ssh_connection(
+        with RemoteMethods.ssh_session(
             host=host, user=user, port=port, password=password, private_key=private_key
-        )
-
-        # Figure out the type of CPU
-        command_to_run = """
-            cpu_info=$(lscpu)
-            if echo "$cpu_info" | grep -q "GenuineIntel"; then
-                echo "INTEL"
-            elif echo "$cpu_info" | grep -q "AuthenticAMD"; then
-                echo "AMD"
-            else
-                echo "UNKNOWN"
-            fi
-            """
-        detect_cpu = ssh.exec_command(command_to_run)
-
-        cpu_type = detect_cpu[1].read().decode("ascii").strip()
-        print(f"CPU Type: {cpu_type}")
-        if cpu_type not in IOMMU_GRUB.keys():
-            raise Exception(f"Not an Intel or AMD CPU: {cpu_type}")
-
-        #############################
-        # Modify GRUB boot loader
-        #   This file is always here
-        #############################
-        grub_modify = (
-            r"sudo sed -i '/^GRUB_CMDLINE_LINUX_DEFAULT=/"
-            rf"c\GRUB_CMDLINE_LINUX_DEFAULT=\"{IOMMU_GRUB[cpu_type]}\"' /etc/default/grub && "
-            "sudo chmod 644 /etc/default/grub && "
-            "sudo update-grub && "
-            "sudo update-initramfs -u -k all"
-        )
-        ssh.exec_command(grub_modify)
-
-        #############################
-        # Modify UEFI Boot Loader
-        #   This file may not be here
-        #############################
-
-        # Check if the UEFI file "/etc/kernel/cmdline" exists
-        command_to_run = """
-            FILE="/etc/kernel/cmdline"
-            if [[ -f "$FILE" ]]; then
-                echo "True"
-            else
-                echo ""
-            fi
-            """
-        detect_file = ssh.exec_command(command_to_run)
-        cmdline_file_exists = bool(detect_file[1].read().decode("ascii").strip())
-
-        if cmdline_file_exists:
-            cmdline_modify = (
-                r"sudo sed -i '/^root=ZFS=rpool/ROOT/pve-1 boot=zfs/"
-                rf"c\root=ZFS=rpool/ROOT/pve-1 boot=zfs {IOMMU_UEFI[cpu_type]}' /etc/kernel/cmdline && "
-                "sudo chmod 644 /etc/kernel/cmdline && "
-                "sudo pve-efiboot-tool refresh "
+        ) as ssh:
+            # Figure out the type of CPU
+            command_to_run = """
+                cpu_info=$(lscpu)
+                if echo "$cpu_info" | grep -q "GenuineIntel"; then
+                    echo "INTEL"
+                elif echo "$cpu_info" | grep -q "AuthenticAMD"; then
+                    echo "AMD"
+                else
+                    echo "UNKNOWN"
+                fi
+                """
+            detect_cpu = ssh.exec_command(command_to_run)
+
+            cpu_type = detect_cpu[1].read().decode("ascii").strip()
+            print(f"CPU Type: {cpu_type}")
+            if cpu_type not in IOMMU_GRUB.keys():
+                raise Exception(f"Not an Intel or AMD CPU: {cpu_type}")
+
+            #############################
+            # Modify GRUB boot loader
+            #   This file is always here
+            #############################
+            grub_modify = (
+                r"sudo sed -i '/^GRUB_CMDLINE_LINUX_DEFAULT=/"
+                rf"c\GRUB_CMDLINE_LINUX_DEFAULT=\"{IOMMU_GRUB[cpu_type]}\"' /etc/default/grub && "
+                "sudo chmod 644 /etc/default/grub && "
+                "sudo update-grub && "
+                "sudo update-initramfs -u -k all"
             )
-            ssh.exec_command(cmdline_modify)
-
-        # Create "/etc/modules-load.d/vfio.conf" to add vfio modules
-        cmdline_create_vfio_conf = (
-            r'sudo echo -e "vfio\nvfio_iommu_type1\nvfio_pci\nvfio_virqfd" '
-            r"> /etc/modules-load.d/vfio.conf"
-        )
-        ssh.exec_command(cmdline_create_vfio_conf)
+            ssh.exec_command(grub_modify)
+
+            #############################
+            # Modify UEFI Boot Loader
+            #   This file may not be here
+            #############################
+
+            # Check if the UEFI file "/etc/kernel/cmdline" exists
+            command_to_run = """
+                FILE="/etc/kernel/cmdline"
+                if [[ -f "$FILE" ]]; then
+                    echo "True"
+                else
+                    echo ""
+                fi
+                """
+            detect_file = ssh.exec_command(command_to_run)
+            cmdline_file_exists = bool(detect_file[1].read().decode("ascii").strip())
+
+            if cmdline_file_exists:
+                cmdline_modify = (
+                    r"sudo sed -i '/^root=ZFS=rpool/ROOT/pve-1 boot=zfs/"
+                    rf"c\root=ZFS=rpool/ROOT/pve-1 boot=zfs {IOMMU_UEFI[cpu_type]}' /etc/kernel/cmdline && "
+                    "sudo chmod 644 /etc/kernel/cmdline && "
+                    "sudo pve-efiboot-tool refresh "
+                )
+                ssh.exec_command(cmdline_modify)
 
-        # Blacklist drivers "/etc/modprobe.d/blacklist.conf"
-        cmdline_blacklist = (
-            r'sudo echo -e "blacklist amdgpu\nblacklist radeon\nblacklist '
-            r'nouveau\nblacklist nvidia*\nblacklist i915" > /etc/modprobe.d/blacklist.conf'
-        )
-        ssh.exec_command(cmdline_blacklist)
-        ssh.exec_command("sudo update-initramfs -u -k all")
+            # Create "/etc/modules-load.d/vfio.conf" to add vfio modules
+            cmdline_create_vfio_conf = (
+                r'sudo echo -e "vfio\nvfio_iommu_type1\nvfio_pci\nvfio_virqfd" '
+                r"> /etc/modules-load.d/vfio.conf"
+            )
+            ssh.exec_command(cmdline_create_vfio_conf)
 
-        # Close the session
-        ssh.close()
+            # Blacklist drivers "/etc/modprobe.d/blacklist.conf"
+            cmdline_blacklist = (
+                r'sudo echo -e "blacklist amdgpu\nblacklist radeon\nblacklist '
+                r'nouveau\nblacklist nvidia*\nblacklist i915" > /etc/modprobe.d/blacklist.conf'
+            )
+            ssh.exec_command(cmdline_blacklist)
+            ssh.exec_command("sudo update-initramfs -u -k all")
 
         # Reboot Machine
         finish_time = RemoteMethods.reboot_function(
@@ -227,53 +358,49 @@ class RemoteMethods:
         private_key: Optional[Input[str]] = None,
     ):
         # Connect using the proper creds
-        ssh = RemoteMethods.ssh_connection(
+        with RemoteMethods.ssh_session(
             host=host, user=user, port=port, password=password, private_key=private_key
-        )
-
-        grub_modify = (
-            r"sudo sed -i '/^GRUB_CMDLINE_LINUX_DEFAULT=/"
-            r"c\GRUB_CMDLINE_LINUX_DEFAULT=\"quiet\"' /etc/default/grub && "
-            "sudo chmod 644 /etc/default/grub && "
-            "sudo update-grub && "
-            "sudo update-initramfs -u -k all"
-        )
-        ssh.exec_command(grub_modify)
-
-        #############################
-        # Modify UEFI Boot Loader
-        #   This file may not be here
-        #############################
-
-        # Check if the UEFI file "/etc/kernel/cmdline" exists
-        command_to_run = """
-            FILE="/etc/kernel/cmdline"
-            if [[ -f "$FILE" ]]; then
-                echo "True"
-            else
-                echo ""
-            fi
-            """
-        detect_file = ssh.exec_command(command_to_run)
-        cmdline_file_exists = bool(detect_file[1].read().decode("ascii").strip())
-
-        if cmdline_file_exists:
-            cmdline_modify = (
-                r"sudo sed -i '/^root=ZFS=rpool/ROOT/pve-1 boot=zfs/"
-                r"c\root=ZFS=rpool/ROOT/pve-1 boot=zfs' /etc/kernel/cmdline && "
-                "sudo chmod 644 /etc/kernel/cmdline && "
-                "sudo pve-efiboot-tool refresh "
+        ) as ssh:
+            grub_modify = (
+                r"sudo sed -i '/^GRUB_CMDLINE_LINUX_DEFAULT=/"
+                r"c\GRUB_CMDLINE_LINUX_DEFAULT=\"quiet\"' /etc/default/grub && "
+                "sudo chmod 644 /etc/default/grub && "
+                "sudo update-grub && "
+                "sudo update-initramfs -u -k all"
             )
-            ssh.exec_command(cmdline_modify)
-
-        # Remove vfio modules
-        ssh.exec_command("sudo rm /etc/modules-load.d/vfio.conf")
+            ssh.exec_command(grub_modify)
+
+            #############################
+            # Modify UEFI Boot Loader
+            #   This file may not be here
+            #############################
+
+            # Check if the UEFI file "/etc/kernel/cmdline" exists
+            command_to_run = """
+                FILE="/etc/kernel/cmdline"
+                if [[ -f "$FILE" ]]; then
+                    echo "True"
+                else
+                    echo ""
+                fi
+                """
+            detect_file = ssh.exec_command(command_to_run)
+            cmdline_file_exists = bool(detect_file[1].read().decode("ascii").strip())
+
+            if cmdline_file_exists:
+                cmdline_modify = (
+                    r"sudo sed -i '/^root=ZFS=rpool/ROOT/pve-1 boot=zfs/"
+                    r"c\root=ZFS=rpool/ROOT/pve-1 boot=zfs' /etc/kernel/cmdline && "
+                    "sudo chmod 644 /etc/kernel/cmdline && "
+                    "sudo pve-efiboot-tool refresh "
+                )
+                ssh.exec_command(cmdline_modify)
 
-        # Remove Blacklist
-        ssh.exec_command("sudo rm /etc/modprobe.d/blacklist.conf")
+            # Remove vfio modules
+            ssh.exec_command("sudo rm /etc/modules-load.d/vfio.conf")
 
-        # Close the session
-        ssh.close()
+            # Remove Blacklist
+            ssh.exec_command("sudo rm /etc/modprobe.d/blacklist.conf")
 
         # Reboot machine
         finish_time = RemoteMethods.reboot_function(
@@ -298,20 +425,18 @@ class RemoteMethods:
         private_key: str = None,
     ):
         # Connect using the proper creds
-        ssh = RemoteMethods.ssh_connection(
+        with RemoteMethods.ssh_session(
             host=host, user=user, port=port, password=password, private_key=private_key
-        )
+        ) as ssh:
+            sftp = ssh.open_sftp()
 
-        sftp = ssh.open_sftp()
-
-        results = sftp.put(
-            localpath=local_path,
-            remotepath=remote_path,
-        )
+            results = sftp.put(
+                localpath=local_path,
+                remotepath=remote_path,
+            )
 
-        # Close up
-        sftp.close()
-        ssh.close()
+            # Close up (the ssh connection itself is pooled)
+            sftp.close()
 
         return results
 
@@ -378,25 +503,25 @@ class RemoteMethods:
         ssh_private_key: Optional[Input[str]] = None,
     ) -> str:
         # Connect using the proper creds
-        ssh = RemoteMethods.ssh_connection(
+        with RemoteMethods.ssh_session(
             host=ssh_host,
             user=ssh_user,
             port=ssh_port,
             password=ssh_password,
             private_key=ssh_private_key,
-        )
-
-        # Certificate Authority
-        ca_pem = RemoteMethods.base64_file(ssh, r"/var/lib/kubernetes/secrets/ca.pem")
-        cluster_admin = RemoteMethods.base64_file(
-            ssh, r"/var/lib/kubernetes/secrets/cluster-admin.pem"
-        )
-        # "/var/lib/kubernetes/secrets/cluster-admin.pem"
+        ) as ssh:
+            # Certificate Authority
+            ca_pem = RemoteMethods.base64_file(
+                ssh, r"/var/lib/kubernetes/secrets/ca.pem"
+            )
+            cluster_admin = RemoteMethods.base64_file(
+                ssh, r"/var/lib/kubernetes/secrets/cluster-admin.pem"
+            )
+            # "/var/lib/kubernetes/secrets/cluster-admin.pem"
 
-        cluster_admin_key = RemoteMethods.base64_file(
-            ssh, "/var/lib/kubernetes/secrets/cluster-admin-key.pem"
-        )
-        ssh.close()
+            cluster_admin_key = RemoteMethods.base64_file(
+                ssh, "/var/lib/kubernetes/secrets/cluster-admin-key.pem"
+            )
 
         # Create the file
         kubectl_config = rf"""apiVersion: v1
@@ -432,18 +557,17 @@ users:
         ssh_private_key: Optional[Input[str]] = None,
     ) -> str:
         # Connect using the proper creds
-        ssh = RemoteMethods.ssh_connection(
+        with RemoteMethods.ssh_session(
             host=ssh_host,
             user=ssh_user,
             port=ssh_port,
             password=ssh_password,
             private_key=ssh_private_key,
-        )
-
-        # K3s makes it easy, file is available to download
-        kubectl_config = RemoteMethods.get_file_contents(
-            ssh, r"/etc/rancher/k3s/k3s.yaml"
-        )
+        ) as ssh:
+            # K3s makes it easy, file is available to download
+            kubectl_config = RemoteMethods.get_file_contents(
+                ssh, r"/etc/rancher/k3s/k3s.yaml"
+            )
 
         # Need to replace the server url to the correct one for remote connections
         kubectl_config.replace("https://127.0.0.1:6443", kubectl_api_url)
@@ -0,0 +1,283 @@
+import atexit
+import hashlib
+import io
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+import paramiko
+from paramiko.client import SSHClient
+
+# (host, user, port, credential fingerprint)
+PoolKey = Tuple[str, str, int, str]
+
+
+class _PooledConnection:
+    def __init__(self, client: SSHClient):
+        self.client = client
+        self.created = time.time()
+        self.last_used = time.time()
+        # Number of callers currently using the client, it's only closed once
+        # none are (a long running command looks idle from the pool's side)
+        self.in_use = 0
+        # Dropped from the pool while in use, closed on the last release
+        self.retired = False
+
+
+class SshConnectionPool:
+    """
+    Process-wide pool of paramiko SSH clients, keyed on host, user, port and a
+    fingerprint of the credentials. Every dynamic provider running in the same
+    Python process shares the same instance (see SshConnectionPool.instance()).
+
+    Clients are checked out with get() and handed back with release() (or
+    both via checkout()); only clients nobody has checked out get closed.
+    """
+
+    _instance: Optional["SshConnectionPool"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        keepalive_interval_in_seconds: int = 30,
+        max_idle_in_seconds: int = 300,
+        connect_timeout_in_seconds: int = 10,
+        connect_attempts: int = 2,
+    ):
+        if connect_attempts < 1:
+            raise ValueError(f"connect_attempts must be at least 1: {connect_attempts}")
+        self.keepalive_interval_in_seconds = keepalive_interval_in_seconds
+        self.max_idle_in_seconds = max_idle_in_seconds
+        self.connect_timeout_in_seconds = connect_timeout_in_seconds
+        self.connect_attempts = connect_attempts
+        self._connections: Dict[PoolKey, _PooledConnection] = {}
+        # id(client) -> pooled connection, for every checked out client
+        self._checked_out: Dict[int, _PooledConnection] = {}
+        self._private_keys: Dict[str, paramiko.PKey] = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def instance(cls) -> "SshConnectionPool":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = SshConnectionPool()
+                atexit.register(cls._instance.close_all)
+            return cls._instance
+
+    @staticmethod
+    def fingerprint(
+        password: Optional[str] = None, private_key: Optional[str] = None
+    ) -> str:
+        # Never keep the raw secret in the key, only a hash of it
+        if private_key is not None:
+            return "key:" + hashlib.sha256(private_key.encode("utf-8")).hexdigest()
+        if password is not None:
+            return "pass:" + hashlib.sha256(password.encode("utf-8")).hexdigest()
+        raise Exception("Must either have a password or private_key")
+
+    @staticmethod
+    def make_key(
+        host: str,
+        user: str,
+        port: int,
+        password: Optional[str] = None,
+        private_key: Optional[str] = None,
+    ) -> PoolKey:
+        return (
+            str(host),
+            str(user),
+            int(port),
+            SshConnectionPool.fingerprint(password=password, private_key=private_key),
+        )
+
+    def get(
+        self,
+        host: str,
+        user: str,
+        port: int,
+        password: Optional[str] = None,
+        private_key: Optional[str] = None,
+    ) -> SSHClient:
+        key = self.make_key(host, user, port, password, private_key)
+        with self._lock:
+            self._evict_idle()
+
+            # Re-use the connection if it's still healthy
+            pooled = self._connections.get(key)
+            if pooled is not None and not self._is_healthy(pooled.client):
+                self._retire(self._connections.pop(key))
+                pooled = None
+
+            if pooled is None:
+                client = self._connect(host, user, port, password, private_key)
+                pooled = _PooledConnection(client)
+                self._connections[key] = pooled
+
+            pooled.in_use += 1
+            pooled.last_used = time.time()
+            self._checked_out[id(pooled.client)] = pooled
+            return pooled.client
+
+    def release(self, client: SSHClient) -> None:
+        # Hand back a client from get()
+        with self._lock:
+            pooled = self._checked_out.get(id(client))
+            if pooled is None:
+                return
+            pooled.in_use -= 1
+            pooled.last_used = time.time()
+            if pooled.in_use > 0:
+                return
+            del self._checked_out[id(client)]
+            close = pooled.retired
+        if close:
+            self._close_quietly(client)
+        return
+
+    @contextmanager
+    def checkout(
+        self,
+        host: str,
+        user: str,
+        port: int,
+        password: Optional[str] = None,
+        private_key: Optional[str] = None,
+    ) -> Iterator[SSHClient]:
+        client = self.get(host, user, port, password, private_key)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def evict(
+        self,
+        host: str,
+        user: str,
+        port: int,
+        password: Optional[str] = None,
+        private_key: Optional[str] = None,
+    ) -> None:
+        key = self.make_key(host, user, port, password, private_key)
+        with self._lock:
+            pooled = self._connections.pop(key, None)
+            if pooled is not None:
+                self._retire(pooled)
+        return
+
+    def evict_host(self, host: str) -> None:
+        # Drop every connection to a host (i.e. it's about to reboot). The
+        # ones still checked out are closed once they're released
+        with self._lock:
+            keys = [key for key in self._connections if key[0] == str(host)]
+            for key in keys:
+                self._retire(self._connections.pop(key))
+        return
+
+    def close_all(self) -> None:
+        # At exit, so checked out clients go too
+        with self._lock:
+            pooled = list(self._connections.values())
+            pooled += [
+                curr for curr in self._checked_out.values() if curr not in pooled
+            ]
+            self._connections.clear()
+            self._checked_out.clear()
+        for curr in pooled:
+            self._close_quietly(curr.client)
+        return
+
+    def _connect(
+        self,
+        host: str,
+        user: str,
+        port: int,
+        password: Optional[str],
+        private_key: Optional[str],
+    ) -> SSHClient:
+        last_exception: Optional[Exception] = None
+        for attempt in range(self.connect_attempts):
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                # SSH > Password
+                if private_key is not None:
+                    ssh.connect(
+                        hostname=host,
+                        username=user,
+                        port=port,
+                        pkey=self._load_private_key(private_key),
+                        timeout=self.connect_timeout_in_seconds,
+                    )
+                else:
+                    ssh.connect(
+                        hostname=host,
+                        username=user,
+                        port=port,
+                        password=password,
+                        timeout=self.connect_timeout_in_seconds,
+                    )
+            except paramiko.ssh_exception.AuthenticationException:
+                # Retrying won't fix bad credentials
+                self._close_quietly(ssh)
+                raise
+            except Exception as e:
+                self._close_quietly(ssh)
+                last_exception = e
+                if attempt < self.connect_attempts - 1:
+                    time.sleep(1)
+                continue
+
+            transport = ssh.get_transport()
+            if transport is not None:
+                transport.set_keepalive(self.keepalive_interval_in_seconds)
+            return ssh
+
+        raise last_exception
+
+    def _load_private_key(self, private_key: str) -> paramiko.PKey:
+        # Parsing a 4096-bit RSA key is expensive, only do it once per key
+        fingerprint = self.fingerprint(private_key=private_key)
+        pkey = self._private_keys.get(fingerprint)
+        if pkey is None:
+            pkey = paramiko.RSAKey.from_private_key(io.StringIO(private_key))
+            self._private_keys[fingerprint] = pkey
+        return pkey
+
+    def _evict_idle(self) -> None:
+        now = time.time()
+        idle_keys = [
+            key
+            for key, pooled in self._connections.items()
+            if pooled.in_use == 0 and now - pooled.last_used > self.max_idle_in_seconds
+        ]
+        for key in idle_keys:
+            self._retire(self._connections.pop(key))
+        return
+
+    def _retire(self, pooled: _PooledConnection) -> None:
+        # NOTE: Called with the lock held, and once the client is out of the pool
+        pooled.retired = True
+        if pooled.in_use == 0:
+            self._close_quietly(pooled.client)
+        return
+
+    @staticmethod
+    def _is_healthy(ssh: SSHClient) -> bool:
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            # Cheap round trip that fails fast on a dead socket
+            transport.send_ignore()
+        except (EOFError, OSError, paramiko.ssh_exception.SSHException):
+            return False
+        return True
+
+    @staticmethod
+    def _close_quietly(ssh: SSHClient) -> None:
+        try:
+            ssh.close()
+        except Exception:
+            pass
+        return
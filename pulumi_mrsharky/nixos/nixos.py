@@ -2,6 +2,7 @@ import json
 import os
 from pathlib import Path
 from typing import Any, List, Optional
+from urllib.parse import quote
 
 import pulumi
 import pulumi_command
@@ -13,10 +14,17 @@ from home_infra.utils.pulumi_extras import PulumiExtras
 from pulumi_mrsharky.local import Local
 from pulumi_mrsharky.nixos.create_config import CreateConfig, CreateConfigArgs
 from pulumi_mrsharky.nixos.nix_settings import NixSettings
+from pulumi_mrsharky.proxmox.clone_spec import clone_spec_cleanup, clone_spec_statements
 from pulumi_mrsharky.proxmox.get_ip_of_vm import GetIpOfVm, GetIpOfVmArgs
 from pulumi_mrsharky.proxmox.proxmox_connection import ProxmoxConnectionArgs
 from pulumi_mrsharky.proxmox.start_vm import StartVm, StartVmArgs
-from pulumi_mrsharky.remote import RunCommandsOnHost, SaveFileOnRemoteHost
+from pulumi_mrsharky.proxmox.vm_settings import VmSettings, VmSettingsArgs
+from pulumi_mrsharky.remote import (
+    RunCommandsOnHost,
+    SaveFileOnRemoteHost,
+    SyncDirectoryToRemoteHost,
+    SyncDirectoryToRemoteHostArgs,
+)
 
 
 class NixosBase:
@@ -39,29 +47,6 @@ class NixosBase:
 
         return
 
-    def _upload_local_files(
-        self, local_dir: str, upload_location_root: str, resource_name_suffix: str
-    ):
-        # Get all the files and paths in the local_dir
-        base_path = Path(local_dir)
-
-        file_counter = 0
-        for path in base_path.rglob("*"):
-            relative_path = path.relative_to(base_path)
-            if path.is_file():
-                file_counter += 1
-                curr_suffix = f"{resource_name_suffix}_{file_counter}"
-                # Create the upload path
-                upload_location = str(Path(upload_location_root) / relative_path)
-                local_file_path = str(path)
-                self._upload_local_file(
-                    local_file=local_file_path,
-                    upload_location=upload_location,
-                    resource_name_suffix=curr_suffix,
-                )
-
-        return
-
     def _upload_local_file(
         self, local_file: str, upload_location: str, resource_name_suffix: str
     ):
@@ -82,11 +67,54 @@ class NixosBase:
     def _copy_configurations(self):
         config_location = Path(__file__).resolve().parent / "config"
 
-        self._upload_local_files(
-            local_dir=config_location,
-            upload_location_root="/etc/nixos/",
-            resource_name_suffix="nix_config",
+        # Send the whole tree as a single tar stream (a no-op if nothing changed)
+        port = self.pulumi_connection.port
+        if port is None:
+            port = 22
+        self.nix_config = SyncDirectoryToRemoteHost(
+            resource_name=f"{self.resource_name_prefix}_nix_config",
+            sync_directory_args=SyncDirectoryToRemoteHostArgs(
+                host=self.pulumi_connection.host,
+                user=self.pulumi_connection.user,
+                port=port,
+                password=self.pulumi_connection.password,
+                private_key=self.pulumi_connection.private_key,
+                local_dir=str(config_location),
+                remote_dir="/etc/nixos/",
+                use_sudo=True,
+            ),
+            opts=pulumi.ResourceOptions(
+                parent=self.parent,
+            ),
         )
+
+        # The files used to be uploaded by one SaveFileOnRemoteHost per file.
+        # Removing those from a stack would run their `rm -f` *after* the sync
+        # above (Pulumi deletes removed resources last), so their commands
+        # stay declared, never run anything and are never deleted.
+        # NOTE: Can go once every stack has been updated with this in place
+        file_count = sum(1 for path in config_location.rglob("*") if path.is_file())
+        for file_counter in range(1, file_count + 1):
+            pulumi_command.remote.Command(
+                resource_name=(
+                    f"{self.resource_name_prefix}_nix_config_{file_counter}"
+                    "-remote-command"
+                ),
+                connection=self.pulumi_connection,
+                opts=pulumi.ResourceOptions(
+                    parent=self.parent,
+                    retain_on_delete=True,
+                    ignore_changes=[
+                        "connection",
+                        "create",
+                        "delete",
+                        "environment",
+                        "stdin",
+                        "triggers",
+                        "update",
+                    ],
+                ),
+            )
         return
 
     def setup_nixos(
@@ -300,53 +328,85 @@ class NixosSambaServer:
             opts=opts,
         )
 
-        # Create the VM
-        script = [
+        # Clone the VM. Only what it's cloned from is immutable (changing it
+        # re-clones the VM), everything else is kept in sync by VmSettings below
+        clone_script = [
             # Clone the nixos template
             f"qm clone {self.nixos_template_vm_id} {vm_id} --name nixos-fileserver "
             + f'--description "{vm_description}" --full 1',
-            # Set options on the template
-            f"qm set {vm_id} --kvm 1 --ciuser ops",
-            f"qm set {vm_id} --cores {cpu_cores}",
-            f"qm set {vm_id} --balloon 0 --memory {memory}",
-            f"qm set {vm_id} --scsi0 local-lvm:vm-{vm_id}-disk-0,ssd=1",
-            f"qm set {vm_id} --agent 1",
-            f"qm set {vm_id} --onboot 1"
-            f"qm disk resize {vm_id} scsi0 {disk_space_in_gb}G",
-            # Set the SSH key
-            f"qm set {vm_id} --sshkeys {key_path}",
         ]
+        delete_script = [f"qm destroy {vm_id}", clone_spec_cleanup(vm_id)]
+        create_script, update_script = clone_spec_statements(
+            vm_id=vm_id,
+            clone_spec=f"template={self.nixos_template_vm_id} clone_mode=full",
+            create_script=clone_script,
+            delete_script=delete_script,
+        )
+
+        self.create_nixos_smb_vm = RunCommandsOnHost(
+            resource_name=f"{resource_name}_proxmoxCreateNixosSambaServer",
+            connection=self.pulumi_connection,
+            create=create_script,
+            delete=delete_script,
+            update=[update_script],
+            use_sudo=True,
+            opts=pulumi.ResourceOptions(
+                parent=save_key,
+            ),
+        )
+
+        # Settings of the VM, changed in place (hot-plugged, or with a single
+        # reboot when proxmox can't)
+        vm_config = {
+            "name": "nixos-fileserver",
+            "description": vm_description,
+            "kvm": 1,
+            "ciuser": "ops",
+            "cores": cpu_cores,
+            "balloon": 0,
+            "memory": memory,
+            "agent": 1,
+            "onboot": 1,
+            # Set the SSH key
+            "sshkeys": self.proxmox_private_key.public_key_openssh.apply(
+                lambda key: quote(key.strip(), safe="")
+            ),
+        }
 
         # Add hardware passthrough (if applicable)
         for idx, hardware in enumerate(hardware_passthrough):
             # Set the PCI card (notice it's 0000:02:00 and NOT 0000:02:00.0)
             # Serial Attached SCSI controller: Broadcom / LSI SAS2008 PCI-Express Fusion-MPT SAS-2 [Falcon] (rev 03)
             # qm set 300 --hostpci0 host=0000:02:00,rombar=1
-            script.append(f"qm set {vm_id} --hostpci{idx} host={hardware}")
+            vm_config[f"hostpci{idx}"] = f"host={hardware}"
 
-        self.create_nixos_smb_vm = RunCommandsOnHost(
-            resource_name=f"{resource_name}_proxmoxCreateNixosSambaServer",
-            connection=self.pulumi_connection,
-            create=script,
-            delete=[f"qm destroy {vm_id}"],
-            update=[f"qm destroy {vm_id}"] + script,
-            use_sudo=True,
+        self.nixos_samba_server_settings = VmSettings(
+            resource_name=f"{resource_name}_NixosSambaServerSettings",
+            vm_settings_args=VmSettingsArgs(
+                proxmox_connection_args=self.proxmox_connection_args,
+                node_name=self.proxmox_node_name,
+                vm_id=vm_id,
+                config=vm_config,
+                disk="scsi0",
+                disk_size_in_gb=disk_space_in_gb,
+                disk_options={"ssd": "1"},
+            ),
             opts=pulumi.ResourceOptions(
-                parent=save_key,
+                parent=self.create_nixos_smb_vm,
             ),
         )
 
-        # Start the VM and pause for 60 seconds
+        # Start the VM and wait until it (and its guest agent) is up
         self.nixos_samba_server_start_vm = StartVm(
             resource_name=f"{resource_name}_StartNixOsSambaServer",
             start_vm_args=StartVmArgs(
                 proxmox_connection_args=self.proxmox_connection_args,
                 node_name=self.proxmox_node_name,
                 vm_id=vm_id,
-                wait=60,
             ),
             opts=pulumi.ResourceOptions(
                 parent=self.create_nixos_smb_vm,
+                depends_on=[self.nixos_samba_server_settings],
             ),
         )
 
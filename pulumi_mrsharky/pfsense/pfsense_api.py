@@ -1,24 +1,299 @@
+import base64
+import hashlib
 import json
-from typing import List
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+# Retried (with backoff) on every method; 5xx only on the idempotent ones, as a
+# POST that failed half way may have created something already
+PFSENSE_RATE_LIMIT_STATUS = 429
+PFSENSE_IDEMPOTENT_METHODS = ("GET", "PUT", "PATCH", "DELETE")
+
+# Used when a JWT doesn't say when it expires (pfSense's default)
+PFSENSE_JWT_DEFAULT_LIFETIME_IN_SECONDS = 3600
+PFSENSE_JWT_RENEW_MARGIN_IN_SECONDS = 60
+
+# Record kinds kept in the name -> record index
+PFSENSE_USER = "user"
+PFSENSE_GROUP = "group"
+
+# kind -> (single record end point, list end point)
+PFSENSE_END_POINTS = {
+    PFSENSE_USER: ("/api/v2/user", "/api/v2/users"),
+    PFSENSE_GROUP: ("/api/v2/user/group", "/api/v2/user/groups"),
+}
+
+
+class _PfsenseSession:
+    """
+    Keep-alive HTTP session (and auth token) for one pfSense + credentials.
+    Shared by every PfsenseApi in the process, so all calls made during a run
+    go over the same pooled TLS connection(s) and only log in once.
+
+    Also holds the name -> record index of users and groups seen so far.
+    """
+
+    _sessions: Dict[Tuple[str, str, str, bool], "_PfsenseSession"] = {}
+    _sessions_lock = threading.Lock()
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.token: Optional[str] = None
+        self.token_expires_at = 0.0
+        # Older versions of the API have no JWT auth (and newer ones may only
+        # accept BasicAuth), fall back to basic auth
+        self.use_basic_auth = False
+        self.lock = threading.Lock()
+        # kind ("user" / "group") -> name -> record. "complete" once the full
+        # list has been loaded (then a missing name doesn't exist)
+        self.index: Dict[str, Dict[str, Dict[str, Any]]] = {
+            PFSENSE_USER: {},
+            PFSENSE_GROUP: {},
+        }
+        self.index_complete: Dict[str, bool] = {
+            PFSENSE_USER: False,
+            PFSENSE_GROUP: False,
+        }
+        self.index_lock = threading.Lock()
+
+    @classmethod
+    def for_connection(
+        cls,
+        url: str,
+        username: str,
+        secret: str,
+        verify_cert: bool,
+    ) -> "_PfsenseSession":
+        # Never keep the raw secret in the key, only a hash of it
+        fingerprint = hashlib.sha256(str(secret).encode("utf-8")).hexdigest()
+        key = (str(url), str(username), fingerprint, bool(verify_cert))
+        with cls._sessions_lock:
+            shared = cls._sessions.get(key)
+            if shared is None:
+                shared = _PfsenseSession()
+                cls._sessions[key] = shared
+            return shared
+
+
+def _jwt_expiry(token: str) -> float:
+    # Read the "exp" claim (no need to verify the token, pfSense does that)
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + PFSENSE_JWT_DEFAULT_LIFETIME_IN_SECONDS
 
 
 class PfsenseApi:
     def __init__(
-        self, username: str, password: str, url: str, verify_cert: bool = True
+        self,
+        username: str,
+        password: str,
+        url: str,
+        verify_cert: bool = True,
+        api_key: Optional[str] = None,
+        max_retries: int = 4,
+        backoff_in_seconds: float = 0.5,
+        timeout_in_seconds: float = 30,
     ):
+        """
+        Authenticates with `api_key` (X-API-Key) when given, otherwise gets a
+        JWT with username / password once and reuses it until it expires.
+        """
         self.username = username
         self.password = password
         self.url = url
         self.verify_cert = verify_cert
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.backoff_in_seconds = backoff_in_seconds
+        self.timeout_in_seconds = timeout_in_seconds
         self.json_headers = {"Content-Type": "application/json"}
+        self._shared = _PfsenseSession.for_connection(
+            url=url,
+            username=username,
+            secret=api_key if api_key is not None else password,
+            verify_cert=verify_cert,
+        )
 
     def _handle_error(self, response):
         raise Exception(
             f"Received the following error {response.status_code}: {response}"
         )
 
+    def _send(self, method: str, end_point: str, **kwargs) -> requests.Response:
+        # One request, retried with exponential backoff on 429 (and 5xx /
+        # connection errors when it's safe to repeat it)
+        retry_on_error = method in PFSENSE_IDEMPOTENT_METHODS
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff_in_seconds * (2**attempt)
+            try:
+                # NOTE: verify is passed per request, a session-level value is
+                #       overridden by REQUESTS_CA_BUNDLE / CURL_CA_BUNDLE
+                response = self._shared.session.request(
+                    method,
+                    end_point,
+                    timeout=self.timeout_in_seconds,
+                    verify=self.verify_cert,
+                    **kwargs,
+                )
+            except requests.ConnectionError:
+                if not retry_on_error or attempt == self.max_retries:
+                    raise
+                time.sleep(delay)
+                continue
+
+            retry = response.status_code == PFSENSE_RATE_LIMIT_STATUS or (
+                response.status_code >= 500 and retry_on_error
+            )
+            if not retry or attempt == self.max_retries:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = float(retry_after)
+            time.sleep(delay)
+        return response
+
+    def _login(self) -> None:
+        # NOTE: Called with the shared session's lock held
+        shared = self._shared
+        response = self._send(
+            "POST",
+            f"https://{self.url}/api/v2/auth/jwt",
+            auth=(self.username, self.password),
+        )
+        if response.status_code == 404:
+            shared.use_basic_auth = True
+            return
+        if response.status_code != 200:
+            self._handle_error(response)
+        shared.token = response.json().get("data").get("token")
+        shared.token_expires_at = _jwt_expiry(shared.token)
+        return
+
+    def _auth(self) -> Tuple[Dict[str, Any], bool]:
+        # Request arguments that authenticate it, and whether they carry a
+        # token that was issued just now
+        if self.api_key is not None:
+            return {"headers": {"X-API-Key": self.api_key}}, False
+        shared = self._shared
+        with shared.lock:
+            fresh_token = False
+            renew_at = shared.token_expires_at - PFSENSE_JWT_RENEW_MARGIN_IN_SECONDS
+            if not shared.use_basic_auth and (
+                shared.token is None or time.time() > renew_at
+            ):
+                self._login()
+                fresh_token = not shared.use_basic_auth
+            if shared.use_basic_auth:
+                return {"auth": (self.username, self.password)}, False
+            headers = {"Authorization": f"Bearer {shared.token}"}
+            return {"headers": headers}, fresh_token
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        data: Optional[Dict[str, Any]] = None,
+    ) -> requests.Response:
+        end_point = f"https://{self.url}{path}"
+        kwargs: Dict[str, Any] = {}
+        if params is not None:
+            kwargs["params"] = params
+        headers = {}
+        if data is not None:
+            kwargs["data"] = json.dumps(data)
+            headers.update(self.json_headers)
+
+        # At most: a stale token, a new token, then basic auth
+        for _ in range(3):
+            auth, fresh_token = self._auth()
+            response = self._send(
+                method,
+                end_point,
+                headers={**headers, **auth.get("headers", {})},
+                auth=auth.get("auth"),
+                **kwargs,
+            )
+            # Only a rejected token is worth another try
+            if response.status_code != 401 or "Authorization" not in auth.get(
+                "headers", {}
+            ):
+                break
+            with self._shared.lock:
+                self._shared.token = None
+                if fresh_token:
+                    # pfSense issues tokens even when only BasicAuth is enabled
+                    # as an auth method, then rejects them
+                    self._shared.use_basic_auth = True
+                # Otherwise the token was revoked / expired early: log in again
+        return response
+
+    ###########################
+    # Name -> record index
+    ###########################
+
+    def _index_all(self, kind: str, records: List[Dict[str, Any]]) -> None:
+        shared = self._shared
+        with shared.index_lock:
+            shared.index[kind] = {record.get("name"): record for record in records}
+            shared.index_complete[kind] = True
+        return
+
+    def _forget(self, kind: str, name: Optional[str] = None) -> None:
+        # Drop one record after a write to it, or all of them (i.e. after a
+        # delete, as record ids are positions that shift)
+        shared = self._shared
+        with shared.index_lock:
+            if name is None:
+                shared.index[kind] = {}
+            else:
+                shared.index[kind].pop(name, None)
+            shared.index_complete[kind] = False
+        return
+
+    def _list(self, kind: str, end_point: str) -> List[Dict[str, Any]]:
+        response = self._request("GET", end_point)
+
+        if response.status_code != 200:
+            self._handle_error(response)
+
+        data = response.json().get("data")
+        self._index_all(kind, data)
+        return data
+
+    def _find(self, kind: str, end_point: str, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Record called `name` (None if there's none): from the index if it's
+        there, otherwise with a single GET filtered on the name.
+        """
+        shared = self._shared
+        with shared.index_lock:
+            record = shared.index[kind].get(name)
+            if record is not None or shared.index_complete[kind]:
+                return record
+
+        response = self._request("GET", end_point, params={"name": name})
+        if response.status_code != 200:
+            self._handle_error(response)
+        records = response.json().get("data") or []
+
+        if any(curr.get("name") != name for curr in records):
+            # The API ignored the filter (older version), so that's everything
+            self._index_all(kind, records)
+        record = next((curr for curr in records if curr.get("name") == name), None)
+        if record is not None:
+            with shared.index_lock:
+                shared.index[kind][name] = record
+        return record
+
     def create_user_group(
         self,
         group_name: str,
@@ -28,7 +303,7 @@ class PfsenseApi:
         privileges: List[str] = None,
     ):
 
-        end_point = f"https://{self.url}/api/v2/user/group"
+        end_point = "/api/v2/user/group"
         data = {
             "name": group_name,
             "scope": scope,
@@ -44,13 +319,8 @@ class PfsenseApi:
         if privileges is not None:
             data["priv"] = privileges
 
-        response = requests.post(
-            end_point,
-            auth=(self.username, self.password),
-            data=json.dumps(data),
-            headers=self.json_headers,
-            verify=self.verify_cert,
-        )
+        response = self._request("POST", end_point, data=data)
+        self._forget(PFSENSE_GROUP, group_name)
 
         if response.status_code != 200:
             self._handle_error(response)
@@ -61,41 +331,26 @@ class PfsenseApi:
         self,
         group_name: str,
     ):
-        end_point = f"https://{self.url}/api/v2/user/group"
+        end_point = "/api/v2/user/group"
 
         curr_data = self.get_group_by_group_name(group_name)
-        response = requests.delete(
-            end_point,
-            auth=(self.username, self.password),
-            params={
-                "id": curr_data.get("id"),
-            },
-            verify=self.verify_cert,
+        response = self._request(
+            "DELETE", end_point, params={"id": curr_data.get("id")}
         )
+        self._forget(PFSENSE_GROUP)
 
         if response.status_code != 200:
             self._handle_error(response)
 
     def get_user_groups(self):
-        end_point = f"https://{self.url}/api/v2/user/groups"
-
-        # Send a GET request to the specified URL
-        response = requests.get(
-            url=end_point, auth=(self.username, self.password), verify=self.verify_cert
-        )
-
-        if response.status_code != 200:
-            self._handle_error(response)
-
-        # Parse the JSON content of the response
-        data = response.json().get("data")
-
-        return data
+        return self._list(PFSENSE_GROUP, "/api/v2/user/groups")
 
     def add_user_to_group(self, username: str, group_name: str):
         _ = self.get_user_by_username(username=username)
         group = self.get_group_by_group_name(group_name=group_name)
-        group_members: List[str] = group.get("member")
+        group_members: List[str] = list(group.get("member") or [])
+        if username in group_members:
+            return
 
         group_members.append(username)
         self.update_user_group(
@@ -114,7 +369,7 @@ class PfsenseApi:
         members: List[str] = None,
         privileges: List[str] = None,
     ):
-        end_point = f"https://{self.url}/api/v2/user/group"
+        end_point = "/api/v2/user/group"
 
         curr_data = self.get_group_by_group_name(group_name=group_name)
         data = {
@@ -130,13 +385,8 @@ class PfsenseApi:
         if privileges is not None:
             data["priv"] = privileges
 
-        response = requests.patch(
-            end_point,
-            auth=(self.username, self.password),
-            data=json.dumps(data),
-            headers=self.json_headers,
-            verify=self.verify_cert,
-        )
+        response = self._request("PATCH", end_point, data=data)
+        self._forget(PFSENSE_GROUP, group_name)
 
         if response.status_code != 200:
             self._handle_error(response)
@@ -144,35 +394,20 @@ class PfsenseApi:
         return
 
     def get_users(self):
-        end_point = f"https://{self.url}/api/v2/users"
-
-        # Send a GET request to the specified URL
-        response = requests.get(
-            url=end_point, auth=(self.username, self.password), verify=self.verify_cert
-        )
-
-        if response.status_code != 200:
-            self._handle_error(response)
-
-        # Parse the JSON content of the response
-        data = response.json().get("data")
-
-        return data
+        return self._list(PFSENSE_USER, "/api/v2/users")
 
     def get_group_by_group_name(self, group_name: str):
-        users = self.get_user_groups()
-        for user in users:
-            if user.get("name") == group_name:
-                return user
+        group = self._find(PFSENSE_GROUP, "/api/v2/user/groups", group_name)
+        if group is not None:
+            return group
 
-        # Didn't find the username
+        # Didn't find the group
         raise Exception(f"Groupname '{group_name}' not found")
 
     def get_user_by_username(self, username: str):
-        users = self.get_users()
-        for user in users:
-            if user.get("name") == username:
-                return user
+        user = self._find(PFSENSE_USER, "/api/v2/users", username)
+        if user is not None:
+            return user
 
         # Didn't find the username
         raise Exception(f"Username '{username}' not found")
@@ -192,7 +427,7 @@ class PfsenseApi:
         authorized_keys: str = None,
         ipsecpsk: str = None,
     ):
-        end_point = f"https://{self.url}/api/v2/user"
+        end_point = "/api/v2/user"
 
         data = {
             "name": username,
@@ -206,13 +441,8 @@ class PfsenseApi:
             "ipsecpsk": ipsecpsk,
         }
 
-        response = requests.post(
-            end_point,
-            auth=(self.username, self.password),
-            data=json.dumps(data),
-            headers=self.json_headers,
-            verify=self.verify_cert,
-        )
+        response = self._request("POST", end_point, data=data)
+        self._forget(PFSENSE_USER, username)
         if response.status_code != 200:
             self._handle_error(response)
 
@@ -230,8 +460,7 @@ class PfsenseApi:
         authorized_keys: str = None,
         ipsecpsk: str = None,
     ):
-        headers = {"Content-Type": "application/json"}
-        end_point = f"https://{self.url}/api/v2/user"
+        end_point = "/api/v2/user"
 
         curr_data = self.get_user_by_username(username)
 
@@ -256,13 +485,8 @@ class PfsenseApi:
         if ipsecpsk is not None:
             data["ipsecpsk"] = ipsecpsk
 
-        response = requests.patch(
-            end_point,
-            auth=(self.username, self.password),
-            data=json.dumps(data),
-            headers=headers,
-            verify=self.verify_cert,
-        )
+        response = self._request("PATCH", end_point, data=data)
+        self._forget(PFSENSE_USER, username)
 
         if response.status_code != 200:
             self._handle_error(response)
@@ -270,19 +494,59 @@ class PfsenseApi:
         return
 
     def delete_user(self, username: str) -> None:
-        end_point = f"https://{self.url}/api/v2/user"
+        end_point = "/api/v2/user"
 
         curr_data = self.get_user_by_username(username)
-        response = requests.delete(
-            end_point,
-            auth=(self.username, self.password),
-            params={
-                "id": curr_data.get("id"),
-            },
-            verify=self.verify_cert,
+        response = self._request(
+            "DELETE", end_point, params={"id": curr_data.get("id")}
         )
+        # pfSense also drops the user from its groups
+        self._forget(PFSENSE_USER)
+        self._forget(PFSENSE_GROUP)
 
         if response.status_code != 200:
             self._handle_error(response)
 
         return
+
+    ###########################
+    # Bulk changes
+    ###########################
+
+    def apply_changes(
+        self,
+        kind: str,
+        creates: List[Dict[str, Any]] = None,
+        patches: List[Dict[str, Any]] = None,
+        delete_ids: List[int] = None,
+    ) -> None:
+        """
+        Write a batch of changes to one kind of record, planned against a
+        single list call: `creates` are POSTed, `patches` (each including the
+        record's "id") PATCHed, then `delete_ids` DELETEd highest first so the
+        ids (positions) still to be used don't shift. One call per change, no
+        lookups.
+
+        NOTE: The plural end points only offer a PUT that replaces every
+              record (admin included), so that's not used
+        """
+        end_point, _ = PFSENSE_END_POINTS[kind]
+        try:
+            for data in creates or []:
+                response = self._request("POST", end_point, data=data)
+                if response.status_code != 200:
+                    self._handle_error(response)
+            for data in patches or []:
+                response = self._request("PATCH", end_point, data=data)
+                if response.status_code != 200:
+                    self._handle_error(response)
+            for record_id in sorted(delete_ids or [], reverse=True):
+                response = self._request("DELETE", end_point, params={"id": record_id})
+                if response.status_code != 200:
+                    self._handle_error(response)
+        finally:
+            self._forget(kind)
+            if kind == PFSENSE_USER and len(delete_ids or []) > 0:
+                # pfSense also drops deleted users from their groups
+                self._forget(PFSENSE_GROUP)
+        return
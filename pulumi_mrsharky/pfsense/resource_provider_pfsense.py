@@ -13,6 +13,7 @@ class PfsenseApiConnectionArgs(object):
     password: Input[str]
     url: Input[str]
     verify_cert: Optional[Input[bool]]
+    api_key: Optional[Input[str]]
 
     def __init__(
         self,
@@ -20,11 +21,14 @@ class PfsenseApiConnectionArgs(object):
         password: Input[str],
         url: Input[str],
         verify_cert: Optional[Input[bool]] = True,
+        api_key: Optional[Input[str]] = None,
     ) -> None:
         self.username = username
         self.password = password
         self.url = url
         self.verify_cert = bool(verify_cert)
+        # NOTE: Stays None unless given (username / password get a JWT instead)
+        self.api_key = api_key
         return
 
 
@@ -43,6 +47,7 @@ class ResourceProviderPfsense(ResourceProvider):
             verify_cert=bool(
                 props.get("pf_sense_api_connection_args").get("verify_cert")
             ),
+            api_key=props.get("pf_sense_api_connection_args").get("api_key"),
         )
         return pfsense_api_connection_args
 
@@ -56,4 +61,5 @@ class ResourceProviderPfsense(ResourceProvider):
             password=pfsense_api_connection_args.password,
             url=pfsense_api_connection_args.url,
             verify_cert=pfsense_api_connection_args.verify_cert,
+            api_key=pfsense_api_connection_args.api_key,
         )
@@ -0,0 +1,272 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import pulumi
+from pulumi import Input, Output, ResourceOptions
+from pulumi.dynamic import CreateResult, DiffResult, Resource, UpdateResult
+from pulumi.runtime.rpc import UNKNOWN
+
+from pulumi_mrsharky.pfsense.pfsense_api import PFSENSE_GROUP, PFSENSE_USER, PfsenseApi
+from pulumi_mrsharky.pfsense.resource_provider_pfsense import (
+    PfsenseApiConnectionArgs,
+    ResourceProviderPfsense,
+)
+
+# Input key -> pfSense field (same names as PfsenseCreateUserArgs /
+# PfsenseApi.create_user_group)
+USER_FIELDS = {
+    "privileges": "priv",
+    "disable": "disabled",
+    "description": "descr",
+    "expires": "expires",
+    "certs": "cert",
+    "authorized_keys": "authorizedkeys",
+    "ipsecpsk": "ipsecpsk",
+}
+GROUP_FIELDS = {
+    "scope": "scope",
+    "description": "description",
+    "members": "member",
+    "privileges": "priv",
+}
+
+# (creates, patches, ids to delete)
+Plan = Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[int]]
+
+
+def _normalize(value: Any) -> Any:
+    # pfSense leaves out / blanks fields that aren't set
+    if value is None or value is False or value == "" or value == []:
+        return None
+    if isinstance(value, (list, tuple)):
+        # Members, privileges and certs are sets, pfSense may list them in any
+        # order
+        return sorted(str(curr) for curr in value)
+    if isinstance(value, bool):
+        return value
+    return str(value)
+
+
+def plan_records(
+    desired: List[Dict[str, Any]],
+    current: List[Dict[str, Any]],
+    name_key: str,
+    fields: Dict[str, str],
+    previous: List[Dict[str, Any]],
+) -> Plan:
+    """
+    Minimal set of changes that takes the `current` records (as listed by
+    pfSense) to the `desired` ones. Only the fields given in `desired` are
+    compared; a record is only deleted if it was `previous`ly managed here.
+
+    A password can't be read back, so it's only sent when the record is new
+    to this resource or its password input changed.
+    """
+    current_by_name = {record.get("name"): record for record in current}
+    previous_by_name = {entry.get(name_key): entry for entry in previous}
+    desired_names = {entry.get(name_key) for entry in desired}
+
+    creates = []
+    patches = []
+    for entry in desired:
+        name = entry.get(name_key)
+        data = {
+            field: entry.get(key)
+            for key, field in fields.items()
+            if entry.get(key) is not None
+        }
+        password = entry.get("password")
+        previous_entry = previous_by_name.get(name)
+        send_password = password is not None and (
+            previous_entry is None or previous_entry.get("password") != password
+        )
+
+        record = current_by_name.get(name)
+        if record is None:
+            if password is not None:
+                data["password"] = password
+            creates.append({"name": name, **data})
+            continue
+
+        changed = {
+            field: value
+            for field, value in data.items()
+            if _normalize(record.get(field)) != _normalize(value)
+        }
+        if send_password:
+            changed["password"] = password
+        if len(changed) > 0:
+            patches.append({"id": record.get("id"), "name": name, **changed})
+
+    delete_ids = [
+        current_by_name[name].get("id")
+        for name in previous_by_name
+        if name not in desired_names and name in current_by_name
+    ]
+    return creates, patches, delete_ids
+
+
+@pulumi.input_type
+class PfsenseUsersAndGroupsArgs(object):
+    pf_sense_api_connection_args: Input[PfsenseApiConnectionArgs]
+    users: Optional[Input[List[Dict[str, Any]]]]
+    groups: Optional[Input[List[Dict[str, Any]]]]
+
+    def __init__(
+        self,
+        pf_sense_api_connection_args: PfsenseApiConnectionArgs,
+        users: List[Dict[str, Any]] = None,
+        groups: List[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        `users` take the same keys as PfsenseCreateUserArgs (username,
+        password, privileges, disable, description, expires, certs,
+        authorized_keys, ipsecpsk) and `groups` the same as
+        PfsenseApi.create_user_group (group_name, scope, description, members,
+        privileges).
+        """
+        self.pf_sense_api_connection_args = pf_sense_api_connection_args
+        self.users = list(users or [])
+        self.groups = list(groups or [])
+        for user in self.users:
+            if user.get("username") is None:
+                raise Exception(f"{self.__class__.__name__}: username cannot be None")
+        for group in self.groups:
+            if group.get("group_name") is None:
+                raise Exception(f"{self.__class__.__name__}: group_name cannot be None")
+        return
+
+
+class PfsenseUsersAndGroupsProvider(ResourceProviderPfsense):
+    def _process_inputs(self, props) -> PfsenseUsersAndGroupsArgs:
+        pf_sense_api_connection_args = super()._process_inputs(props)
+
+        arguments = PfsenseUsersAndGroupsArgs(
+            pf_sense_api_connection_args=pf_sense_api_connection_args,
+            users=props.get("users"),
+            groups=props.get("groups"),
+        )
+        return arguments
+
+    def _plan(
+        self,
+        api: PfsenseApi,
+        arguments: PfsenseUsersAndGroupsArgs,
+        old_props: Any,
+    ) -> Tuple[Plan, Plan]:
+        # Everything is planned against one read of each list
+        user_plan = plan_records(
+            desired=arguments.users,
+            current=api.get_users(),
+            name_key="username",
+            fields=USER_FIELDS,
+            previous=old_props.get("users") or [],
+        )
+        group_plan = plan_records(
+            desired=arguments.groups,
+            current=api.get_user_groups(),
+            name_key="group_name",
+            fields=GROUP_FIELDS,
+            previous=old_props.get("groups") or [],
+        )
+        return user_plan, group_plan
+
+    def _apply(self, props: Any, old_props: Any):
+        arguments = self._process_inputs(props)
+        api = self._create_pfsense_api_connection(
+            arguments.pf_sense_api_connection_args
+        )
+        user_plan, group_plan = self._plan(api, arguments, old_props)
+        user_creates, user_patches, user_delete_ids = user_plan
+        group_creates, group_patches, group_delete_ids = group_plan
+
+        # Users first (groups may list them as members), deleted ones last
+        print(
+            f"Users: {len(user_creates)} to create, {len(user_patches)} to update, "
+            f"{len(user_delete_ids)} to delete"
+        )
+        print(
+            f"Groups: {len(group_creates)} to create, {len(group_patches)} to "
+            f"update, {len(group_delete_ids)} to delete"
+        )
+        api.apply_changes(PFSENSE_USER, creates=user_creates, patches=user_patches)
+        api.apply_changes(
+            PFSENSE_GROUP,
+            creates=group_creates,
+            patches=group_patches,
+            delete_ids=group_delete_ids,
+        )
+        api.apply_changes(PFSENSE_USER, delete_ids=user_delete_ids)
+
+        outs = {
+            "pf_sense_api_connection_args": arguments.pf_sense_api_connection_args,
+            "users": arguments.users,
+            "groups": arguments.groups,
+            "changed_users": sorted(
+                {data.get("name") for data in user_creates + user_patches}
+            ),
+            "changed_groups": sorted(
+                {data.get("name") for data in group_creates + group_patches}
+            ),
+        }
+        return arguments.pf_sense_api_connection_args.url, outs
+
+    def create(self, props: Any) -> CreateResult:
+        id, outs = self._apply(props, old_props={})
+        return CreateResult(id_=id, outs=outs)
+
+    def diff(self, id: str, old_props: Any, new_props: Any) -> DiffResult:
+        if any(
+            old_props.get(key) != new_props.get(key)
+            for key in ("pf_sense_api_connection_args", "users", "groups")
+        ):
+            return DiffResult(changes=True)
+
+        # Same inputs, check whether pfSense drifted from them
+        entries = (new_props.get("users") or []) + (new_props.get("groups") or [])
+        if any(value == UNKNOWN for entry in entries for value in entry.values()):
+            return DiffResult(changes=True)
+        arguments = self._process_inputs(new_props)
+        api = self._create_pfsense_api_connection(
+            arguments.pf_sense_api_connection_args
+        )
+        user_plan, group_plan = self._plan(api, arguments, old_props)
+        changes = any(len(curr) > 0 for curr in user_plan + group_plan)
+        return DiffResult(changes=changes)
+
+    def update(self, id: str, old_props: Any, new_props: Any) -> UpdateResult:
+        _, outs = self._apply(new_props, old_props=old_props)
+        return UpdateResult(outs=outs)
+
+    def delete(self, id: str, props: Any) -> None:
+        # Remove everything this resource manages
+        _ = self._apply({**props, "users": [], "groups": []}, old_props=props)
+        return
+
+
+class PfsenseUsersAndGroups(Resource):
+    """
+    Every user and group managed in one resource: pfSense is read once and
+    only the records that differ get created / updated / deleted. Records
+    that were never part of `users` / `groups` (i.e. admin) are left alone.
+    """
+
+    pf_sense_api_connection_args: Output[Dict]
+    users: Output[List[Dict[str, Any]]]
+    groups: Output[List[Dict[str, Any]]]
+    changed_users: Output[List[str]]
+    changed_groups: Output[List[str]]
+
+    def __init__(
+        self,
+        resource_name,
+        users_and_groups_args: PfsenseUsersAndGroupsArgs,
+        opts: Optional[ResourceOptions] = None,
+    ):
+        full_args = {
+            "changed_users": None,
+            "changed_groups": None,
+            **vars(users_and_groups_args),
+        }
+        super().__init__(
+            PfsenseUsersAndGroupsProvider(), resource_name, full_args, opts
+        )
@@ -1 +1,3 @@
 from .add_iso_image import AddIsoImage, AddIsoImageArgs  # noqa: F401
+from .image_store import CachedImage, CachedImageArgs  # noqa: F401
+from .vm_settings import VmSettings, VmSettingsArgs  # noqa: F401
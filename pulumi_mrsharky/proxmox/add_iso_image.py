@@ -1,3 +1,4 @@
+import time
 from typing import Any, Optional
 
 import pulumi
@@ -7,19 +8,53 @@ from pulumi.dynamic import CreateResult, Resource, UpdateResult
 from pulumi_mrsharky.proxmox.proxmox_connection import ProxmoxConnectionArgs
 from pulumi_mrsharky.proxmox.resource_provider_proxmox import ResourceProviderProxmox
 
+# "ssh": download over an SSH session (curl | decompress on the host)
+# "api": have proxmox download it (download-url API), then track the task
+ISO_DOWNLOAD_BACKEND_SSH = "ssh"
+ISO_DOWNLOAD_BACKEND_API = "api"
+
 
 @pulumi.input_type
 class AddIsoImageArgs(object):
     proxmox_connection_args: Input[ProxmoxConnectionArgs]
     url: Input[str]
+    backend: Optional[Input[str]]
+    node_name: Optional[Input[str]]
+    storage: Optional[Input[str]]
+    checksum: Optional[Input[str]]
+    checksum_algorithm: Optional[Input[str]]
+    max_wait_in_seconds: Optional[Input[int]]
 
     def __init__(
         self,
         proxmox_connection_args: Input[ProxmoxConnectionArgs],
         url: Input[str],
+        backend: Optional[Input[str]] = None,
+        node_name: Optional[Input[str]] = None,
+        storage: Optional[Input[str]] = None,
+        checksum: Optional[Input[str]] = None,
+        checksum_algorithm: Optional[Input[str]] = None,
+        max_wait_in_seconds: Optional[Input[int]] = None,
     ) -> None:
+        """
+        backend: "ssh" (default) or "api". The "api" backend needs `node_name`
+            and can verify `checksum` (with `checksum_algorithm`, i.e. "sha256")
+            of the file at `url`. `storage` defaults to "local".
+        """
+        if backend not in (None, ISO_DOWNLOAD_BACKEND_SSH, ISO_DOWNLOAD_BACKEND_API):
+            raise ValueError(f"Invalid backend: {backend}")
+        if backend == ISO_DOWNLOAD_BACKEND_API and node_name is None:
+            raise ValueError("The 'api' backend needs a node_name")
         self.proxmox_connection_args = proxmox_connection_args
         self.url = url
+        # NOTE: Optional args stay None when not given, so they don't show up as
+        #       a change (and trigger a re-download) on existing resources
+        self.backend = backend
+        self.node_name = node_name
+        self.storage = storage
+        self.checksum = checksum
+        self.checksum_algorithm = checksum_algorithm
+        self.max_wait_in_seconds = max_wait_in_seconds
         return
 
 
@@ -31,6 +66,12 @@ class AddIsoImageProvider(ResourceProviderProxmox):
         start_vm_args = AddIsoImageArgs(
             proxmox_connection_args=proxmox_connection_args,
             url=props.get("url"),
+            backend=props.get("backend"),
+            node_name=props.get("node_name"),
+            storage=props.get("storage"),
+            checksum=props.get("checksum"),
+            checksum_algorithm=props.get("checksum_algorithm"),
+            max_wait_in_seconds=props.get("max_wait_in_seconds"),
         )
         return start_vm_args
 
@@ -43,14 +84,32 @@ class AddIsoImageProvider(ResourceProviderProxmox):
         )
 
         # Download the image
-        local_image_name = proxmox_connection.download_iso_image(
-            url=arguments.url,
-        )
+        throughput = None
+        if arguments.backend == ISO_DOWNLOAD_BACKEND_API:
+            download = proxmox_connection.download_iso_image_via_api(
+                node_name=arguments.node_name,
+                url=arguments.url,
+                storage=arguments.storage or "local",
+                checksum=arguments.checksum,
+                checksum_algorithm=arguments.checksum_algorithm,
+                max_wait_in_seconds=int(arguments.max_wait_in_seconds or 3600),
+            )
+            local_image_name = download["local_image_name"]
+            duration = download["duration"]
+            if duration > 0 and download["size"]:
+                throughput = download["size"] / duration / (1024 * 1024)
+        else:
+            start_time = time.time()
+            local_image_name = proxmox_connection.download_iso_image(
+                url=arguments.url,
+            )
+            duration = time.time() - start_time
 
         results = {
-            "url": arguments.url,
+            **vars(arguments),
             "local_image_name": local_image_name,
-            "proxmox_connection_args": arguments.proxmox_connection_args,
+            "download_duration_in_seconds": duration,
+            "download_throughput_in_mib_per_second": throughput,
         }
 
         return proxmox_connection.host, results
@@ -70,7 +129,14 @@ class AddIsoImageProvider(ResourceProviderProxmox):
         print("Getting local_image_name")
         local_image_name = props.get("local_image_name")
 
-        proxmox_connection.remove_iso_image(local_image_name)
+        if arguments.backend == ISO_DOWNLOAD_BACKEND_API:
+            proxmox_connection.remove_iso_image_via_api(
+                node_name=arguments.node_name,
+                local_image_name=local_image_name,
+                storage=arguments.storage or "local",
+            )
+        else:
+            proxmox_connection.remove_iso_image(local_image_name)
         return
 
     def update(self, id: str, old_props: Any, new_props: Any) -> UpdateResult:
@@ -84,6 +150,8 @@ class AddIsoImage(Resource):
     add_iso_image_args: Output[AddIsoImageArgs]
     url: Output[int]
     local_image_name: Output[str]
+    download_duration_in_seconds: Output[float]
+    download_throughput_in_mib_per_second: Output[Optional[float]]
 
     def __init__(
         self,
@@ -91,7 +159,12 @@ class AddIsoImage(Resource):
         add_iso_image_args: AddIsoImageArgs,
         opts: Optional[ResourceOptions] = None,
     ):
-        full_args = {"local_image_name": None, **vars(add_iso_image_args)}
+        full_args = {
+            "local_image_name": None,
+            "download_duration_in_seconds": None,
+            "download_throughput_in_mib_per_second": None,
+            **vars(add_iso_image_args),
+        }
         super().__init__(
             provider=AddIsoImageProvider(),
             name=resource_name,
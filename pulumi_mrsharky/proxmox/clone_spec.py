@@ -0,0 +1,53 @@
+import shlex
+from typing import List, Optional, Tuple
+
+# What each cloned VM was cloned from (template, clone mode, storage)
+VM_CLONE_SPEC_DIR = "/var/lib/pulumi-provisioning/vm-clone-specs"
+
+
+def clone_spec_statements(
+    vm_id: int,
+    clone_spec: str,
+    create_script: List[str],
+    delete_script: List[str],
+    keep_script: Optional[List[str]] = None,
+) -> Tuple[List[str], str]:
+    """
+    Create statements and the update statement for the command that clones a
+    VM, so it's only re-cloned when what it was cloned from changes. Changes
+    to the wording of the clone command alone never touch the VM.
+
+    `create_script` clones the VM. The spec it was cloned from is recorded on
+    the host. On update the VM is destroyed and re-cloned only if the recorded
+    spec differs from `clone_spec`. Without a recorded spec (the VM was created
+    before specs were recorded) the VM is never destroyed: an existing one is
+    adopted, a missing one is cloned. `keep_script` runs whenever the existing
+    VM is kept (adopted or unchanged), i.e. to update it in place.
+    """
+    spec_file = f"{VM_CLONE_SPEC_DIR}/{vm_id}"
+    record_spec = (
+        f"mkdir -p {VM_CLONE_SPEC_DIR} && "
+        f"echo {shlex.quote(clone_spec)} > {spec_file}"
+    )
+    keep = keep_script or []
+    adopt = " && ".join([f'echo "VM {vm_id} adopted"'] + keep)
+    unchanged = " && ".join([f'echo "VM {vm_id} clone unchanged"'] + keep)
+    create = " && ".join(create_script)
+    recreate = " && ".join(delete_script + create_script)
+    update_script = (
+        f"if [ ! -f {spec_file} ]; then "
+        f"if qm status {vm_id} > /dev/null 2>&1; then {adopt}; "
+        f"else {create}; "
+        "fi; "
+        f'elif [ "$(cat {spec_file})" = {shlex.quote(clone_spec)} ]; then '
+        f"{unchanged}; "
+        f"else {recreate}; "
+        "fi && "
+        f"{record_spec}"
+    )
+    create_statements = create_script + [f"bash -c {shlex.quote(record_spec)}"]
+    return create_statements, f"bash -c {shlex.quote(update_script)}"
+
+
+def clone_spec_cleanup(vm_id: int) -> str:
+    return f"rm -f {VM_CLONE_SPEC_DIR}/{vm_id}"
@@ -0,0 +1,88 @@
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+from proxmoxer import ProxmoxAPI
+
+
+class ClusterInventory:
+    """
+    Snapshot of the cluster built from a single `/cluster/resources` call.
+
+    Nodes and VMs are indexed in dicts so existence checks are O(1). Per-VM
+    configs and per-node disk lists are only fetched when first asked for.
+    Everything expires after `ttl_in_seconds`, and ProxmoxConnection calls
+    invalidate()/invalidate_vm() whenever it changes something itself.
+    """
+
+    def __init__(self, proxmox_api: ProxmoxAPI, ttl_in_seconds: float = 30):
+        self.proxmox_api = proxmox_api
+        self.ttl_in_seconds = ttl_in_seconds
+        self._loaded_at: Optional[float] = None
+        self._nodes: Set[str] = set()
+        self._vms: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        self._vm_configs: Dict[Tuple[str, int], Tuple[float, Dict[str, Any]]] = {}
+        self._node_disks: Dict[str, Tuple[float, Set[str]]] = {}
+
+    def _expired(self, loaded_at: Optional[float]) -> bool:
+        return loaded_at is None or time.time() - loaded_at > self.ttl_in_seconds
+
+    def refresh(self) -> None:
+        nodes = set()
+        vms = {}
+        for resource in self.proxmox_api.cluster.resources.get():
+            resource_type = resource.get("type")
+            if resource_type == "node":
+                nodes.add(resource.get("node"))
+            elif resource_type == "qemu":
+                vms[(resource.get("node"), int(resource.get("vmid")))] = resource
+        self._nodes = nodes
+        self._vms = vms
+        self._loaded_at = time.time()
+        return
+
+    def _ensure_loaded(self) -> None:
+        if self._expired(self._loaded_at):
+            self.refresh()
+        return
+
+    def invalidate(self) -> None:
+        self._loaded_at = None
+        self._vm_configs.clear()
+        self._node_disks.clear()
+        return
+
+    def invalidate_vm(self, node_name: str, vm_id: int) -> None:
+        self._loaded_at = None
+        self._vm_configs.pop((node_name, int(vm_id)), None)
+        return
+
+    def has_node(self, node_name: str) -> bool:
+        self._ensure_loaded()
+        return node_name in self._nodes
+
+    def has_vm(self, node_name: str, vm_id: int) -> bool:
+        self._ensure_loaded()
+        return (node_name, int(vm_id)) in self._vms
+
+    def vm(self, node_name: str, vm_id: int) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        return self._vms.get((node_name, int(vm_id)))
+
+    def vm_config(self, node_name: str, vm_id: int) -> Dict[str, Any]:
+        key = (node_name, int(vm_id))
+        cached = self._vm_configs.get(key)
+        if cached is None or self._expired(cached[0]):
+            config = self.proxmox_api(f"nodes/{node_name}/qemu/{vm_id}/config").get()
+            cached = (time.time(), config)
+            self._vm_configs[key] = cached
+        return cached[1]
+
+    def has_drive(self, node_name: str, drive_id: str) -> bool:
+        cached = self._node_disks.get(node_name)
+        if cached is None or self._expired(cached[0]):
+            # NOTE: skipsmart avoids running a SMART query against every disk
+            disks = self.proxmox_api.nodes(node_name).disks.list.get(skipsmart=1)
+            by_id_links = {disk.get("by_id_link") for disk in disks}
+            cached = (time.time(), by_id_links)
+            self._node_disks[node_name] = cached
+        return f"/dev/disk/by-id/{drive_id}" in cached[1]
@@ -2,6 +2,7 @@ import pulumi
 import pulumi_command
 import pulumi_tls
 
+from pulumi_mrsharky.proxmox.image_store import CachedImage, CachedImageArgs
 from pulumi_mrsharky.remote import RunCommandsOnHost
 
 
@@ -17,10 +18,28 @@ def create_cloud_init_image(
         private_key=proxmox_private_key.private_key_pem,
     )
 
+    # Only downloaded if it isn't in the host's image store yet (or the copy
+    # there is over a month old, jammy/current keeps getting new builds)
+    image = CachedImage(
+        resource_name="proxmoxUbuntuCloudInitImage",
+        cached_image_args=CachedImageArgs(
+            host=proxmox_ip,
+            user="pulumi",
+            private_key=proxmox_private_key.private_key_pem,
+            url="https://cloud-images.ubuntu.com/jammy/current/jammy-server-cloudimg-amd64-disk-kvm.img",
+            use_sudo=True,
+            max_age_in_seconds=30 * 24 * 60 * 60,
+        ),
+        opts=pulumi.ResourceOptions(
+            depends_on=[
+                reboot_after_isolating_gpu,
+            ]
+        ),
+    )
+
     script = [
-        "wget https://cloud-images.ubuntu.com/jammy/current/jammy-server-cloudimg-amd64-disk-kvm.img",
         "qm create 9000 --memory 2048 --core 2 --name ubuntu-cloud-jammy-kvm --net0 virtio,bridge=vmbr0",
-        "qm importdisk 9000 jammy-server-cloudimg-amd64-disk-kvm.img local-lvm",
+        image.path.apply(lambda path: f"qm importdisk 9000 {path} local-lvm"),
         "qm set 9000 --scsihw virtio-scsi-pci --scsi0 local-lvm:vm-9000-disk-0",
         "qm set 9000 --ide2 local-lvm:cloudinit",
         "qm set 9000 --boot c --bootdisk scsi0",
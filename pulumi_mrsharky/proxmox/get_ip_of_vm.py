@@ -1,26 +1,66 @@
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from pulumi import Input, Output, ResourceOptions
 from pulumi.dynamic import CreateResult, Resource, UpdateResult
 
+from pulumi_mrsharky.proxmox.proxmox_async import ProxmoxClient
 from pulumi_mrsharky.proxmox.proxmox_connection import ProxmoxConnectionArgs
 from pulumi_mrsharky.proxmox.resource_provider_proxmox import ResourceProviderProxmox
 
+DEFAULT_MAX_WAIT_FOR_IP_IN_SECONDS = 300
+
+# (host, node, vm id) -> IP, for the rest of the run (the provider process
+# lives as long as the `pulumi up`)
+_RESOLVED_IPS: Dict[Tuple[str, str, int], str] = {}
+
+
+def resolve_ips_of_vms(
+    proxmox_client: ProxmoxClient,
+    host: str,
+    node_name: str,
+    vm_ids: List[int],
+    max_wait_in_seconds: float,
+    use_cache: bool = True,
+) -> Dict[int, str]:
+    """
+    IPs of the VMs, waiting (concurrently) for the ones that haven't reported
+    one yet. Already resolved VMs come from the cache, unless use_cache is
+    False, in which case every VM is asked again (and the cache refreshed).
+    """
+    missing = [
+        vm_id
+        for vm_id in vm_ids
+        if not use_cache or (host, node_name, vm_id) not in _RESOLVED_IPS
+    ]
+    if len(missing) > 0:
+        ips = proxmox_client.wait_for_ips_of_vms(
+            node_name=node_name,
+            vm_ids=missing,
+            max_wait_in_seconds=max_wait_in_seconds,
+        )
+        for vm_id, ip in ips.items():
+            _RESOLVED_IPS[(host, node_name, vm_id)] = ip
+    return {vm_id: _RESOLVED_IPS[(host, node_name, vm_id)] for vm_id in vm_ids}
+
 
 class GetIpOfVmArgs(object):
     proxmox_connection_args: Input[ProxmoxConnectionArgs]
     node_name: Input[str]
     vm_id: Input[int]
+    max_wait_in_seconds: Optional[Input[int]]
 
     def __init__(
         self,
         proxmox_connection_args: Input[ProxmoxConnectionArgs],
         node_name: str,
         vm_id: int,
+        max_wait_in_seconds: Optional[int] = None,
     ) -> None:
         self.proxmox_connection_args = proxmox_connection_args
         self.node_name = node_name
         self.vm_id = vm_id
+        # NOTE: Stays None unless given, so existing resources don't see a diff
+        self.max_wait_in_seconds = max_wait_in_seconds
         return
 
 
@@ -35,28 +75,39 @@ class GetIpOfVmProvider(ResourceProviderProxmox):
             # vm related arguments
             node_name=props.get("node_name"),
             vm_id=int(props.get("vm_id")),
+            max_wait_in_seconds=props.get("max_wait_in_seconds"),
         )
         return arguments
 
-    def _common_create(self, props):
+    def _common_create(self, props, use_cache: bool = True):
         arguments = self._process_inputs(props)
+        host = arguments.proxmox_connection_args.host
 
         # Setup the connection
-        proxmox_connection = self._create_proxmox_connection(
+        proxmox_client = self._create_proxmox_client(
             proxmox_connection_args=arguments.proxmox_connection_args
         )
 
-        # Get the IP
-        ip_address = proxmox_connection.get_ip_of_vm(
-            node_name=arguments.node_name,
-            vm_id=arguments.vm_id,
-        )
+        # Get the IP (waiting for the guest agent to report one)
+        try:
+            ips = resolve_ips_of_vms(
+                proxmox_client=proxmox_client,
+                host=host,
+                node_name=arguments.node_name,
+                vm_ids=[arguments.vm_id],
+                max_wait_in_seconds=(
+                    arguments.max_wait_in_seconds or DEFAULT_MAX_WAIT_FOR_IP_IN_SECONDS
+                ),
+                use_cache=use_cache,
+            )
+        finally:
+            proxmox_client.close()
 
         results = {
-            "ip": ip_address,
+            "ip": ips[arguments.vm_id],
         }
 
-        return proxmox_connection.host, results
+        return host, results
 
     def create(self, props) -> CreateResult:
         id, results = self._common_create(props)
@@ -67,7 +118,9 @@ class GetIpOfVmProvider(ResourceProviderProxmox):
 
     def update(self, id: str, old_props: Any, new_props: Any) -> UpdateResult:
         self.delete(id=id, props=old_props)
-        _, results = self._common_create(new_props)
+        # The VM may have changed (i.e. recreated), don't trust an IP cached
+        # earlier in the run
+        _, results = self._common_create(new_props, use_cache=False)
         return UpdateResult(outs=results)
 
 
@@ -88,3 +141,109 @@ class GetIpOfVm(Resource):
         super().__init__(
             provider=GetIpOfVmProvider(), name=resource_name, props=full_args, opts=opts
         )
+
+
+class GetIpsOfVmsArgs(object):
+    proxmox_connection_args: Input[ProxmoxConnectionArgs]
+    node_name: Input[str]
+    vm_ids: Input[List[int]]
+    max_wait_in_seconds: Optional[Input[int]]
+
+    def __init__(
+        self,
+        proxmox_connection_args: Input[ProxmoxConnectionArgs],
+        node_name: str,
+        vm_ids: List[int],
+        max_wait_in_seconds: Optional[int] = None,
+    ) -> None:
+        self.proxmox_connection_args = proxmox_connection_args
+        self.node_name = node_name
+        self.vm_ids = [int(vm_id) for vm_id in vm_ids]
+        self.max_wait_in_seconds = max_wait_in_seconds
+        return
+
+
+class GetIpsOfVmsProvider(ResourceProviderProxmox):
+    def _process_inputs(self, props) -> GetIpsOfVmsArgs:
+        # Proxmox connection args
+        proxmox_connection_args = super()._process_inputs(props)
+
+        arguments = GetIpsOfVmsArgs(
+            proxmox_connection_args=proxmox_connection_args,
+            node_name=props.get("node_name"),
+            vm_ids=props.get("vm_ids"),
+            max_wait_in_seconds=props.get("max_wait_in_seconds"),
+        )
+        return arguments
+
+    def _common_create(self, props, use_cache: bool = True):
+        arguments = self._process_inputs(props)
+        host = arguments.proxmox_connection_args.host
+
+        # Setup the connection
+        proxmox_client = self._create_proxmox_client(
+            proxmox_connection_args=arguments.proxmox_connection_args
+        )
+
+        # Get all the IPs at once
+        try:
+            ips = resolve_ips_of_vms(
+                proxmox_client=proxmox_client,
+                host=host,
+                node_name=arguments.node_name,
+                vm_ids=arguments.vm_ids,
+                max_wait_in_seconds=(
+                    arguments.max_wait_in_seconds or DEFAULT_MAX_WAIT_FOR_IP_IN_SECONDS
+                ),
+                use_cache=use_cache,
+            )
+        finally:
+            proxmox_client.close()
+
+        results = {
+            # NOTE: Output map keys have to be strings
+            "ips": {str(vm_id): ip for vm_id, ip in ips.items()},
+        }
+
+        return host, results
+
+    def create(self, props) -> CreateResult:
+        id, results = self._common_create(props)
+        return CreateResult(id_=id, outs=results)
+
+    def delete(self, id: str, props: Any) -> None:
+        return
+
+    def update(self, id: str, old_props: Any, new_props: Any) -> UpdateResult:
+        self.delete(id=id, props=old_props)
+        # The VM may have changed (i.e. recreated), don't trust an IP cached
+        # earlier in the run
+        _, results = self._common_create(new_props, use_cache=False)
+        return UpdateResult(outs=results)
+
+
+class GetIpsOfVms(Resource):
+    """
+    IPs of several VMs (on the same node), resolved concurrently. `ips` maps
+    the VM id (as a string) to its IP.
+    """
+
+    id: Output[str]
+    ips: Output[Dict[str, str]]
+    node_name: Output[str]
+    proxmox_connection_args: Output[ProxmoxConnectionArgs]
+    vm_ids: Output[List[int]]
+
+    def __init__(
+        self,
+        resource_name,
+        get_ips_of_vms_args: GetIpsOfVmsArgs,
+        opts: Optional[ResourceOptions] = None,
+    ):
+        full_args = {"ips": None, **vars(get_ips_of_vms_args)}
+        super().__init__(
+            provider=GetIpsOfVmsProvider(),
+            name=resource_name,
+            props=full_args,
+            opts=opts,
+        )
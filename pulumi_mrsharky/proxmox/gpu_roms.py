@@ -0,0 +1,256 @@
+import posixpath
+import re
+import shlex
+from typing import Dict, List, Optional
+
+# https://github.com/isc30/ryzen-gpu-passthrough-proxmox
+GPU_ROM_REPO_URL = "https://github.com/isc30/ryzen-gpu-passthrough-proxmox"
+GPU_ROM_BRANCH = "main"
+
+# Where proxmox looks for romfile= entries
+GPU_ROM_DIR = "/usr/share/kvm"
+
+# ETags + SHA256SUMS of what's been fetched, so re-runs only fetch changes
+GPU_ROM_STATE_DIR = f"{GPU_ROM_DIR}/.gpu-roms"
+
+GPU_ROMS = [
+    "AMDGopDriver-5825U.rom",
+    "AMDGopDriver.rom",
+    "AMDGopDriver_5500U.rom",
+    "AMDGopDriver_5600G.rom",
+    "AMDGopDriver_5700G.rom",
+    "AMDGopDriver_5700U.rom",
+    "AMDGopDriver_5800H.rom",
+    "AMDGopDriver_6600H.rom",
+    "AMDGopDriver_6800H.rom",
+    "AMDGopDriver_6900HX.rom",
+    "AMDGopDriver_7840hs.rom",
+    "AMDGopDriver_7900.rom",
+    "AMDGopDriver_7950x.rom",
+    "AMDGopDriver_8700GE.rom",
+    "AMDGopDriver_8745hs.rom",
+    "AMDGopDriver_8845hs.rom",
+    "AMDGopDriver_8945.rom",
+    "AMDGopDriver_9700x.rom",
+    "AMDGopDriver_9800x3d.rom",
+    "vbios_5500U.bin",
+    "vbios_5600G.bin",
+    "vbios_5700G.bin",
+    "vbios_5700U.bin",
+    "vbios_5825U.bin",
+    "vbios_6600h.bin",
+    "vbios_6800h.bin",
+    "vbios_6900HX.bin",
+    "vbios_7530u.bin",
+    "vbios_7600x.bin",
+    "vbios_7700x.rom",
+    "vbios_7735hs.bin",
+    "vbios_7840hs.bin",
+    "vbios_7900.bin",
+    "vbios_7900x.bin",
+    "vbios_7940hs.bin",
+    "vbios_7945hx.bin",
+    "vbios_7950x.bin",
+    "vbios_7950x3d.bin",
+    "vbios_8600g.bin",
+    "vbios_8700g.bin",
+    "vbios_8745hs.bin",
+    "vbios_8845hs.bin",
+    "vbios_8845hs.dat",
+    "vbios_8945.bin",
+    "vbios_9700x.bin",
+    "vbios_9800x3d.bin",
+    "vbios_9950x.rom",
+]
+
+# AMD iGPU PCI device id -> models (as in the rom file names) it ships in. Only
+# used when the CPU model name doesn't match any rom directly.
+GPU_ROM_PCI_DEVICE_MODELS: Dict[str, List[str]] = {
+    # Cezanne
+    "1638": ["5600g", "5700g", "5800h", "5825u"],
+    # Lucienne
+    "164c": ["5500u", "5700u"],
+    # Barcelo
+    "15e7": ["5825u", "7530u"],
+    # Rembrandt
+    "1681": ["6600h", "6800h", "6900hx", "7735hs"],
+    # Phoenix
+    "15bf": [
+        "7840hs",
+        "7940hs",
+        "8600g",
+        "8700g",
+        "8700ge",
+        "8745hs",
+        "8845hs",
+        "8945",
+    ],
+    # Raphael
+    "164e": ["7600x", "7700x", "7900", "7900x", "7945hx", "7950x", "7950x3d"],
+    # Granite Ridge
+    "13c0": ["9700x", "9800x3d", "9950x"],
+}
+
+
+def gpu_rom_model(rom: str) -> str:
+    """
+    Model a rom is for, i.e. "AMDGopDriver_5700G.rom" -> "5700g". Empty for
+    the generic "AMDGopDriver.rom".
+    """
+    stem, _ = posixpath.splitext(rom)
+    return re.sub(r"^(AMDGopDriver|vbios)[-_]?", "", stem).lower()
+
+
+def _hardware_selection_script(roms: List[str]) -> List[str]:
+    """
+    Shell statements that narrow `roms` down to the ones matching this host:
+    first by CPU model name (lscpu), then by the iGPU's PCI device id. Generic
+    roms are always kept. If nothing matches, all roms are kept.
+    """
+    catalog = " ".join(shlex.quote(f"{rom}:{gpu_rom_model(rom)}") for rom in roms)
+    pci_cases = " ".join(
+        f"{device_id}) pci_models=\"$pci_models {' '.join(models)}\";;"
+        for device_id, models in GPU_ROM_PCI_DEVICE_MODELS.items()
+    )
+    return [
+        f"catalog=({catalog})",
+        "cpu_model=$(lscpu 2>/dev/null | sed -n 's/^Model name:[[:space:]]*//p' | "
+        "tr 'A-Z' 'a-z')",
+        # Display controllers (class 03xx) from AMD
+        "gpu_ids=$(lspci -nn -d 1002: 2>/dev/null | "
+        "sed -n 's/.*\\[03[0-9a-f][0-9a-f]\\].*\\[1002:\\([0-9a-f]\\{4\\}\\)\\].*/\\1/p' | "
+        "tr '\\n' ' ')",
+        'pci_models=""',
+        f"for id in $gpu_ids; do case $id in {pci_cases} esac; done",
+        "generic=(); by_cpu=(); by_pci=()",
+        'for entry in "${catalog[@]}"; do '
+        "rom=${entry%%:*}; model=${entry#*:}; "
+        'if [ -z "$model" ]; then generic+=("$rom"); continue; fi; '
+        # Model is a whole word in the CPU name (5700g in "ryzen 7 5700g", not
+        # in "ryzen 7 5700ge")
+        'if echo " $cpu_model" | grep -qE "[^0-9a-z]$model([^0-9a-z]|\\$)"; '
+        'then by_cpu+=("$rom"); fi; '
+        'if [[ " $pci_models " == *" $model "* ]]; then by_pci+=("$rom"); fi; '
+        "done",
+        'if [ ${#by_cpu[@]} -gt 0 ]; then roms=("${by_cpu[@]}" "${generic[@]}"); '
+        'elif [ ${#by_pci[@]} -gt 0 ]; then roms=("${by_pci[@]}" "${generic[@]}"); '
+        'else echo "no roms match cpu: $cpu_model, gpu: $gpu_ids; fetching all" >&2; '
+        "fi",
+        'echo "selected roms: ${roms[*]}"',
+    ]
+
+
+def gpu_rom_sync_script(
+    roms: Optional[List[str]] = None,
+    max_parallel_downloads: int = 8,
+    use_archive: bool = False,
+    detect_hardware: bool = True,
+) -> str:
+    """
+    Shell script (run as root on the proxmox host) that brings the GPU roms in
+    GPU_ROM_DIR up to date.
+
+    Each rom is fetched with a conditional request (If-None-Match on the ETag
+    saved from the last download), `max_parallel_downloads` at a time, so a
+    re-run only transfers new or changed roms. Roms that are missing, or no
+    longer match the recorded SHA256SUMS, are always fetched again.
+
+    With `use_archive`, the whole repo is fetched as a single tarball instead
+    (also ETag'd) and the roms are extracted from it.
+
+    With `detect_hardware` (and no explicit `roms`), only the roms matching the
+    host's CPU/iGPU are fetched (see _hardware_selection_script).
+    """
+    if roms is None:
+        roms = GPU_ROMS
+    else:
+        detect_hardware = False
+    if max_parallel_downloads < 1:
+        raise ValueError("max_parallel_downloads must be at least 1")
+
+    raw_url = f"{GPU_ROM_REPO_URL}/raw/refs/heads/{GPU_ROM_BRANCH}"
+    archive_url = f"{GPU_ROM_REPO_URL}/archive/refs/heads/{GPU_ROM_BRANCH}.tar.gz"
+    quoted_roms = " ".join(shlex.quote(rom) for rom in roms)
+
+    setup = [
+        "set -e",
+        f"dest={GPU_ROM_DIR}",
+        f"state={GPU_ROM_STATE_DIR}",
+        f"roms=({quoted_roms})",
+        'mkdir -p "$dest" "$state"',
+    ]
+    if detect_hardware:
+        setup += _hardware_selection_script(roms)
+    setup += [
+        # True if the rom is on disk and matches its recorded checksum
+        "is_current() { "
+        '[ -f "$dest/$1" ] && '
+        'grep -s "  $1\\$" "$state/SHA256SUMS" | (cd "$dest" && sha256sum --check --status); '
+        "}",
+        # Conditional GET, prints the http status. The body goes to $2 (only
+        # meaningful on a 200) and the new ETag to $3.new
+        "fetch() { "
+        "local etag_args=(); "
+        '[ -s "$3" ] && etag_args=(--etag-compare "$3"); '
+        'curl --silent --show-error --location --retry 3 "${etag_args[@]}" '
+        '--etag-save "$3.new" --output "$2" --write-out "%{http_code}" "$1"; '
+        "}",
+    ]
+
+    if use_archive:
+        sync = [
+            'etag="$state/archive.etag"',
+            'for rom in "${roms[@]}"; do is_current "$rom" || rm -f "$etag"; done',
+            'tmp=$(mktemp -d "$state/.archive.XXXXXX")',
+            "trap 'rm -rf \"$tmp\"' EXIT",
+            f'code=$(fetch {shlex.quote(archive_url)} "$tmp/roms.tar.gz" "$etag")',
+            'if [ "$code" = "200" ]; then '
+            'tar -xzf "$tmp/roms.tar.gz" -C "$tmp" --strip-components=1; '
+            'for rom in "${roms[@]}"; do '
+            'if [ -f "$tmp/$rom" ]; then mv -f "$tmp/$rom" "$dest/$rom"; '
+            'else echo "missing from archive: $rom" >&2; fi; '
+            "done; "
+            'mv -f "$etag.new" "$etag"; '
+            'echo "fetched archive"; '
+            'elif [ "$code" = "304" ]; then '
+            'rm -f "$etag.new"; '
+            'echo "unchanged: archive"; '
+            "else "
+            'echo "failed to fetch archive ($code)" >&2; '
+            "exit 1; "
+            "fi",
+        ]
+    else:
+        sync = [
+            "sync_rom() { "
+            "set -e; "
+            'local rom=$1; local etag="$state/$1.etag"; '
+            'is_current "$rom" || rm -f "$etag"; '
+            f'local code=$(fetch {shlex.quote(raw_url)}/"$rom" "$dest/$rom.partial" "$etag"); '
+            'if [ "$code" = "200" ]; then '
+            'mv -f "$dest/$rom.partial" "$dest/$rom"; '
+            'mv -f "$etag.new" "$etag"; '
+            'echo "fetched: $rom"; '
+            'elif [ "$code" = "304" ]; then '
+            'rm -f "$dest/$rom.partial" "$etag.new"; '
+            'echo "unchanged: $rom"; '
+            "else "
+            'rm -f "$dest/$rom.partial" "$etag.new"; '
+            'echo "failed to fetch $rom ($code)" >&2; '
+            "return 1; "
+            "fi; "
+            "}",
+            "export dest state",
+            "export -f is_current fetch sync_rom",
+            'printf "%s\\n" "${roms[@]}" | '
+            f"xargs -P {max_parallel_downloads} -I{{}} bash -c 'sync_rom \"$1\"' _ {{}}",
+        ]
+
+    # Record checksums of everything now in place
+    finish = [
+        'cd "$dest"',
+        'ls -1 -- "${roms[@]}" 2>/dev/null | xargs -r sha256sum > "$state/SHA256SUMS.new"',
+        'mv -f "$state/SHA256SUMS.new" "$state/SHA256SUMS"',
+    ]
+
+    return "; ".join(setup + sync + finish)
@@ -0,0 +1,242 @@
+import hashlib
+import posixpath
+import shlex
+import time
+from typing import Any, Optional, Union
+from urllib.parse import urlparse
+
+from pulumi import Input, Output, ResourceOptions
+from pulumi.dynamic import (
+    CreateResult,
+    DiffResult,
+    Resource,
+    ResourceProvider,
+    UpdateResult,
+)
+
+from pulumi_mrsharky.common.remote import RemoteMethods
+
+# Content addressed image cache on the proxmox host:
+#   {IMAGE_STORE_DIR}/sha256/<sha256>/<filename>   the image itself
+#   {IMAGE_STORE_DIR}/manifests/<sha256 of url>.sha256
+#       `sha256sum` style manifest ("<sha256>  sha256/<sha256>/<filename>")
+IMAGE_STORE_DIR = "/var/lib/vz/image-store"
+
+CACHED_IMAGE_INPUT_KEYS = [
+    "host",
+    "user",
+    "port",
+    "password",
+    "private_key",
+    "url",
+    "expected_sha256",
+    "filename",
+    "use_sudo",
+    "verify_on_hit",
+    "max_wait_for_lock_in_seconds",
+    "max_age_in_seconds",
+]
+
+
+class CachedImageArgs(object):
+    host: Input[str]
+    user: Input[str]
+    port: Input[int]
+    password: Optional[Input[str]]
+    private_key: Optional[Input[str]]
+    url: Input[str]
+    expected_sha256: Optional[Input[str]]
+    filename: Input[str]
+    use_sudo: Input[bool]
+    verify_on_hit: Input[bool]
+    max_wait_for_lock_in_seconds: Input[int]
+    max_age_in_seconds: Optional[Input[int]]
+
+    def __init__(
+        self,
+        host: Union[Input[str], str],
+        user: Union[Input[str], str],
+        url: str,
+        expected_sha256: Optional[str] = None,
+        filename: Optional[str] = None,
+        port: Union[Input[int], int] = 22,
+        password: Optional[Union[Input[str], str]] = None,
+        private_key: Optional[Union[Input[str], str]] = None,
+        use_sudo: bool = False,
+        verify_on_hit: bool = False,
+        max_wait_for_lock_in_seconds: int = 3600,
+        max_age_in_seconds: Optional[int] = None,
+    ) -> None:
+        """
+        url: Where to download the image from (only on a cache miss)
+        expected_sha256: If set, the download is verified against it and any
+            image already in the store with this checksum is reused. If not
+            set, the first download of `url` is pinned by its manifest.
+        filename: Name of the file in the store (defaults to the url's basename)
+        verify_on_hit: Re-hash the cached image on a hit (slow for big images)
+        max_age_in_seconds: Download `url` again once the pinned copy is older
+            than this (for urls that get updated in place, i.e. .../current/...).
+            If not set, the pin never expires.
+        """
+        self.host = host
+        self.user = user
+        self.port = port
+        self.password = password
+        self.private_key = private_key
+        self.url = url
+        if expected_sha256 is not None:
+            expected_sha256 = expected_sha256.lower()
+        self.expected_sha256 = expected_sha256
+        if filename is None:
+            filename = posixpath.basename(urlparse(url).path)
+        self.filename = filename
+        self.use_sudo = use_sudo
+        self.verify_on_hit = verify_on_hit
+        self.max_wait_for_lock_in_seconds = max_wait_for_lock_in_seconds
+        self.max_age_in_seconds = max_age_in_seconds
+        return
+
+
+class CachedImageProvider(ResourceProvider):
+    @staticmethod
+    def _ensure_script(props) -> str:
+        url = props.get("url")
+        filename = props.get("filename")
+        expected = props.get("expected_sha256") or ""
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        lock_timeout = int(props.get("max_wait_for_lock_in_seconds", 3600))
+        max_age = props.get("max_age_in_seconds")
+        max_age = "" if max_age is None else str(int(max_age))
+        verify = "true"
+        if props.get("verify_on_hit"):
+            verify = 'sha256sum --check --status "$manifest"'
+
+        # Everything happens under a per-url lock, so two templates asking for
+        # the same image at once share a single download
+        return (
+            "set -e; "
+            f"store={IMAGE_STORE_DIR}; "
+            'mkdir -p "$store/manifests" "$store/sha256"; '
+            f'manifest="$store/manifests/{key}.sha256"; '
+            f'partial="$store/manifests/{key}.partial"; '
+            f'exec 9>"$store/manifests/{key}.lock"; '
+            f"flock -w {lock_timeout} 9; "
+            'cd "$store"; '
+            f"url={shlex.quote(url)}; "
+            f"expected={shlex.quote(expected)}; "
+            f"filename={shlex.quote(filename)}; "
+            f"max_age={max_age}; "
+            # Already downloaded under another url (or the manifest was lost)
+            'if [ -n "$expected" ] && [ -f "sha256/$expected/$filename" ] && '
+            '! grep -qs "^$expected " "$manifest"; then '
+            'echo "$expected  sha256/$expected/$filename" > "$manifest"; '
+            "fi; "
+            'if [ -f "$manifest" ] && '
+            '{ [ -z "$expected" ] || grep -qs "^$expected " "$manifest"; } && '
+            # The manifest is rewritten on every download, its age is the pin's
+            '{ [ -z "$max_age" ] || '
+            '[ $(( $(date +%s) - $(stat -c %Y "$manifest") )) -lt "$max_age" ]; } && '
+            '[ -f "$(cut -d" " -f3- "$manifest")" ] && '
+            f"{verify}; then "
+            "status=hit; "
+            "else "
+            "status=miss; "
+            # --continue resumes an interrupted download of the same url
+            'wget --quiet --continue --output-document="$partial" "$url"; '
+            'sha=$(sha256sum "$partial" | cut -d" " -f1); '
+            'if [ -n "$expected" ] && [ "$sha" != "$expected" ]; then '
+            'rm -f "$partial"; '
+            'echo "Checksum mismatch for $url: expected $expected, got $sha" >&2; '
+            "exit 1; "
+            "fi; "
+            'mkdir -p "sha256/$sha"; '
+            'chmod 644 "$partial"; '
+            'mv -f "$partial" "sha256/$sha/$filename"; '
+            'echo "$sha  sha256/$sha/$filename" > "$manifest.tmp"; '
+            'mv -f "$manifest.tmp" "$manifest"; '
+            "fi; "
+            'echo "$status $(stat -c %Y "$manifest") $(cat "$manifest")"'
+        )
+
+    def _ensure(self, props) -> dict:
+        with RemoteMethods.ssh_session(
+            host=props.get("host"),
+            user=props.get("user"),
+            port=int(props.get("port", 22)),
+            password=props.get("password"),
+            private_key=props.get("private_key"),
+        ) as ssh:
+            sudo = "sudo " if props.get("use_sudo") else ""
+            command = f"{sudo}bash -c {shlex.quote(self._ensure_script(props))}"
+            _, stdout, stderr = ssh.exec_command(command)
+            output = stdout.read().decode("utf-8").strip()
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                error = stderr.read().decode("utf-8")
+                raise Exception(f"Failed to cache image '{props.get('url')}':\n{error}")
+
+        # i.e. "hit <fetched at> <sha256>  sha256/<sha256>/<filename>"
+        status, fetched_at, sha256, relative_path = output.splitlines()[-1].split(
+            maxsplit=3
+        )
+        cache_hit = status == "hit"
+        print(
+            f"Image cache {'hit' if cache_hit else 'miss'}: "
+            f"{props.get('url')} ({sha256})"
+        )
+        return {
+            **props,
+            "path": f"{IMAGE_STORE_DIR}/{relative_path}",
+            "sha256": sha256,
+            "cache_hit": cache_hit,
+            "fetched_at": float(fetched_at),
+        }
+
+    def diff(self, id: str, old_props: Any, new_props: Any) -> DiffResult:
+        if any(
+            old_props.get(key) != new_props.get(key) for key in CACHED_IMAGE_INPUT_KEYS
+        ):
+            return DiffResult(changes=True)
+
+        # Same inputs, but the pinned download may have outlived max_age
+        max_age = new_props.get("max_age_in_seconds")
+        fetched_at = old_props.get("fetched_at")
+        if max_age is not None and fetched_at is not None:
+            if time.time() - float(fetched_at) >= int(max_age):
+                return DiffResult(changes=True)
+        return DiffResult(changes=False)
+
+    def create(self, props: Any) -> CreateResult:
+        outs = self._ensure(props)
+        return CreateResult(id_=f"{props.get('host')}:{outs['sha256']}", outs=outs)
+
+    def update(self, id: str, old_props: Any, new_props: Any) -> UpdateResult:
+        outs = self._ensure(new_props)
+        return UpdateResult(outs=outs)
+
+    def delete(self, id: str, props: Any) -> None:
+        # The store is shared by every template on the host (and is the whole
+        # point of not downloading again), so images are left in place
+        return
+
+
+class CachedImage(Resource):
+    path: Output[str]
+    sha256: Output[str]
+    cache_hit: Output[bool]
+    fetched_at: Output[float]
+
+    def __init__(
+        self,
+        resource_name,
+        cached_image_args: CachedImageArgs,
+        opts: Optional[ResourceOptions] = None,
+    ):
+        full_args = {
+            "path": None,
+            "sha256": None,
+            "cache_hit": None,
+            "fetched_at": None,
+            **vars(cached_image_args),
+        }
+        super().__init__(CachedImageProvider(), resource_name, full_args, opts)
@@ -0,0 +1,64 @@
+import re
+import shlex
+from typing import Dict, Optional
+
+# Where the per-storage slot lock files live on the proxmox host
+PROVISIONING_LOCK_DIR = "/run/lock/pulumi-provisioning"
+
+
+class ProvisioningScheduler:
+    """
+    Host-side scheduler for I/O heavy provisioning steps (i.e. `qm clone`).
+
+    Pulumi launches every VM at once, so clones against the same storage end up
+    fighting over LVM/ZFS locks and disk bandwidth. Each storage gets a fixed
+    number of `flock` slots on the proxmox host; a wrapped command waits for a
+    free slot, runs, and releases it on exit. Only the wrapped step holds a
+    slot, so the network bound steps of one VM (start, nix-channel update, ...)
+    still overlap with the clone of the next.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_clones_per_storage: int = 1,
+        storage_limits: Optional[Dict[str, int]] = None,
+        max_wait_in_seconds: int = 3600,
+    ):
+        if max_concurrent_clones_per_storage < 1:
+            raise ValueError("max_concurrent_clones_per_storage must be at least 1")
+        self.max_concurrent_clones_per_storage = max_concurrent_clones_per_storage
+        self.storage_limits = storage_limits or {}
+        self.max_wait_in_seconds = max_wait_in_seconds
+
+    def slots_for_storage(self, storage: str) -> int:
+        return max(
+            1,
+            int(
+                self.storage_limits.get(storage, self.max_concurrent_clones_per_storage)
+            ),
+        )
+
+    def with_storage_slot(self, storage: str, command: str) -> str:
+        """
+        Wrap `command` so it only runs while holding one of the storage's slots.
+        The result is a single `bash -c '...'` statement (so it can be prefixed
+        with sudo by RunCommandsOnHost).
+        """
+        slots = self.slots_for_storage(storage)
+        safe_storage = re.sub(r"[^A-Za-z0-9_.-]", "_", storage)
+        lock_prefix = f"{PROVISIONING_LOCK_DIR}/{safe_storage}"
+        script = (
+            f"mkdir -p {PROVISIONING_LOCK_DIR}; "
+            "while :; do "
+            f"for slot in $(seq 0 {slots - 1}); do "
+            f'exec 9>"{lock_prefix}.$slot.lock"; '
+            f"if flock -n 9; then {command}; exit $?; fi; "
+            "done; "
+            f"if [ $SECONDS -ge {self.max_wait_in_seconds} ]; then "
+            f"echo 'Timed out waiting for a provisioning slot on {safe_storage}' >&2; "
+            "exit 1; "
+            "fi; "
+            "sleep 2; "
+            "done"
+        )
+        return f"bash -c {shlex.quote(script)}"
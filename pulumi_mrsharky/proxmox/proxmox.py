@@ -358,7 +358,6 @@ class Proxmox:
         self.reboot_after_grub = PulumiExtras.reboot_remote_host(
             resource_name="ProxmoxRebootAfterGrub",
             connection=pulumi_connection,
-            seconds_to_wait_for_reboot=140,
             use_sudo=True,
             opts=pulumi.ResourceOptions(
                 parent=self.modify_grub,
@@ -389,7 +388,6 @@ class Proxmox:
             resource_name="ProxmoxRebootAfterGpuVfio",
             connection=pulumi_connection,
             use_sudo=True,
-            seconds_to_wait_for_reboot=140,
             opts=pulumi.ResourceOptions(
                 parent=self.gpu_vfio_update_initramfs,
                 depends_on=[],
@@ -463,7 +461,6 @@ class Proxmox:
         self.reboot_after_isolating_gpu = PulumiExtras.reboot_remote_host(
             resource_name="ProxmoxRebootAfterGpuIsolated",
             connection=pulumi_connection,
-            seconds_to_wait_for_reboot=140,
             use_sudo=True,
             opts=pulumi.ResourceOptions(
                 parent=self.isolate_gpu,
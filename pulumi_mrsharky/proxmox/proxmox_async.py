@@ -0,0 +1,385 @@
+import asyncio
+import functools
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Dict, List, Optional, TypeVar
+
+import requests
+from proxmoxer.core import ResourceException
+from requests.adapters import HTTPAdapter
+
+from pulumi_mrsharky.common.backoff import poll_with_backoff_async
+from pulumi_mrsharky.proxmox.proxmox_connection import (
+    ProxmoxConnectionArgs,
+    available_disk_interfaces,
+    ipv4_of_interface,
+    ipv4_of_mac_addresses,
+    vm_mac_addresses,
+)
+from pulumi_mrsharky.proxmox.proxmox_sessions import ProxmoxSessionRegistry
+
+T = TypeVar("T")
+
+PROXMOX_API_PORT = 8006
+
+
+class ProxmoxAsyncClient:
+    """
+    asyncio client for the proxmox REST API, for when many calls can go out at
+    once (i.e. the configs, statuses or IPs of a batch of VMs).
+
+    All requests share one requests.Session, so connections are kept alive and
+    reused from a pool sized to `max_concurrency`. The blocking calls run on a
+    thread pool and a semaphore keeps at most `max_concurrency` in flight.
+
+        client = ProxmoxAsyncClient.from_connection_args(args)
+        configs = await client.get_vm_configs("pve", [501, 502, 503])
+
+    Use ProxmoxClient to call it from synchronous code.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        api_user: str,
+        api_token_name: Optional[str] = None,
+        api_token_value: Optional[str] = None,
+        api_password: Optional[str] = None,
+        api_verify_ssl: bool = False,
+        max_concurrency: int = 8,
+        timeout_in_seconds: float = 30,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if api_token_name is None or api_token_value is None:
+            if api_password is None:
+                raise SyntaxError("Must connect either via token or password.")
+
+        self.host = host
+        if ":" not in host:
+            host = f"{host}:{PROXMOX_API_PORT}"
+        self.base_url = f"https://{host}/api2/json"
+        self.api_user = api_user
+        self.api_token_name = api_token_name
+        self.api_token_value = api_token_value
+        self.api_password = api_password
+        # NOTE: Passed per request, a session-level value is overridden by
+        #       REQUESTS_CA_BUNDLE / CURL_CA_BUNDLE
+        self.api_verify_ssl = api_verify_ssl
+        self.max_concurrency = max_concurrency
+        self.timeout_in_seconds = timeout_in_seconds
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        if api_token_value is not None and api_token_name is not None:
+            self.session.headers["Authorization"] = (
+                f"PVEAPIToken={api_user}!{api_token_name}={api_token_value}"
+            )
+        self._ticket: Optional[str] = None
+        self._csrf_token: Optional[str] = None
+        self._logged_in = api_password is None or api_token_value is not None
+
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        # Created on first use, so they belong to the loop the client runs on
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._login_lock: Optional[asyncio.Lock] = None
+
+    @classmethod
+    def from_connection_args(
+        cls, proxmox_connection_args: ProxmoxConnectionArgs, max_concurrency: int = 8
+    ) -> "ProxmoxAsyncClient":
+        return cls(
+            host=proxmox_connection_args.host,
+            api_user=proxmox_connection_args.api_user,
+            api_token_name=proxmox_connection_args.api_token_name,
+            api_token_value=proxmox_connection_args.api_token_value,
+            api_password=proxmox_connection_args.api_password,
+            api_verify_ssl=bool(proxmox_connection_args.api_verify_ssl),
+            max_concurrency=max_concurrency,
+        )
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def _send(self, method: str, path: str, params: Dict[str, Any]) -> Any:
+        # Blocking; runs on the thread pool
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        headers = {}
+        if method != "GET" and self._csrf_token is not None:
+            headers["CSRFPreventionToken"] = self._csrf_token
+        if method in ("GET", "DELETE"):
+            response = self.session.request(
+                method,
+                url,
+                params=params,
+                headers=headers,
+                timeout=self.timeout_in_seconds,
+                verify=self.api_verify_ssl,
+            )
+        else:
+            response = self.session.request(
+                method,
+                url,
+                data=params,
+                headers=headers,
+                timeout=self.timeout_in_seconds,
+                verify=self.api_verify_ssl,
+            )
+        if response.status_code >= 400:
+            try:
+                errors = response.json().get("errors")
+            except ValueError:
+                errors = None
+            raise ResourceException(
+                response.status_code, response.reason, response.text, errors=errors
+            )
+        return response.json().get("data")
+
+    async def _login(self, rejected_ticket: Optional[str] = None) -> None:
+        # Password auth: get a ticket (cookie) + CSRF token, unless another
+        # client in this process already has a valid one. With rejected_ticket
+        # (the server answered 401), that one is dropped and a new one fetched
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self._logged_in and (
+                rejected_ticket is None or self._ticket != rejected_ticket
+            ):
+                return
+            registry = ProxmoxSessionRegistry.instance()
+            key = registry.make_key(
+                host=self.host,
+                user=self.api_user,
+                password=self.api_password,
+                verify_ssl=self.api_verify_ssl,
+            )
+            if rejected_ticket is not None:
+                registry.drop_ticket(key, rejected_ticket)
+            cached = registry.ticket(key)
+            if cached is None:
+                ticket = await self._run_in_executor(
+                    self._send,
+                    "POST",
+                    "/access/ticket",
+                    {"username": self.api_user, "password": self.api_password},
+                )
+                cached = (ticket["ticket"], ticket["CSRFPreventionToken"])
+                registry.store_ticket(key, *cached)
+            self.session.cookies.set("PVEAuthCookie", cached[0])
+            self._ticket = cached[0]
+            self._csrf_token = cached[1]
+            self._logged_in = True
+
+    async def _run_in_executor(self, function, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    async def request(self, method: str, path: str, **params) -> Any:
+        if not self._logged_in:
+            await self._login()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        ticket = self._ticket
+        try:
+            async with self._semaphore:
+                return await self._run_in_executor(self._send, method, path, params)
+        except ResourceException as e:
+            # A shared ticket can be rejected before we think it expires, log
+            # in again (once) and retry
+            if ticket is None or e.status_code != 401:
+                raise
+        await self._login(rejected_ticket=ticket)
+        async with self._semaphore:
+            return await self._run_in_executor(self._send, method, path, params)
+
+    async def get(self, path: str, **params) -> Any:
+        return await self.request("GET", path, **params)
+
+    async def post(self, path: str, **params) -> Any:
+        return await self.request("POST", path, **params)
+
+    async def put(self, path: str, **params) -> Any:
+        return await self.request("PUT", path, **params)
+
+    async def delete(self, path: str, **params) -> Any:
+        return await self.request("DELETE", path, **params)
+
+    ###########################
+    # Same operations as ProxmoxConnection
+    ###########################
+
+    async def check_node_exists(self, node_name: str) -> bool:
+        nodes = await self.get("/nodes")
+        return any(node.get("node") == node_name for node in nodes)
+
+    async def check_vm_exists(self, node_name: str, vm_id: int) -> bool:
+        # type=vm also lists LXC containers, only a qemu VM counts
+        vms = await self.get("/cluster/resources", type="vm")
+        return any(
+            vm.get("type") == "qemu"
+            and vm.get("node") == node_name
+            and int(vm.get("vmid")) == int(vm_id)
+            for vm in vms
+        )
+
+    async def get_vm_config(self, node_name: str, vm_id: int) -> Dict[str, Any]:
+        return await self.get(f"/nodes/{node_name}/qemu/{vm_id}/config")
+
+    async def get_vm_status(self, node_name: str, vm_id: int) -> str:
+        status = await self.get(f"/nodes/{node_name}/qemu/{vm_id}/status/current")
+        return status.get("status")
+
+    async def qemu_guest_agent_installed(self, node_name: str, vm_id: int) -> bool:
+        vm_config = await self.get_vm_config(node_name=node_name, vm_id=vm_id)
+        return bool(vm_config.get("agent", 0))
+
+    async def ping_qemu_guest_agent(self, node_name: str, vm_id: int) -> bool:
+        try:
+            await self.post(f"/nodes/{node_name}/qemu/{vm_id}/agent/ping")
+        except ResourceException:
+            # Agent isn't up (yet)
+            return False
+        return True
+
+    async def get_ip_of_vm(self, node_name: str, vm_id: int) -> str:
+        # Double check that vm_id exists
+        if not await self.check_vm_exists(node_name=node_name, vm_id=vm_id):
+            raise Exception(f"VM {vm_id} doesn't exist on the proxmox cluster")
+
+        # First check if the qemu guest is installed (otherwise this won't work
+        if not await self.qemu_guest_agent_installed(node_name=node_name, vm_id=vm_id):
+            raise Exception("QEMU Guest agent must be installed for this to work")
+
+        result = await self.get(
+            f"/nodes/{node_name}/qemu/{vm_id}/agent/network-get-interfaces"
+        )
+        ip_address = ipv4_of_interface(result["result"], name="eth0")
+        if ip_address is None:
+            raise Exception("Unable to find an IP address")
+        return ip_address
+
+    async def wait_for_ip_of_vm(
+        self,
+        node_name: str,
+        vm_id: int,
+        max_wait_in_seconds: float = 300,
+        initial_delay_in_seconds: float = 1.0,
+        max_delay_in_seconds: float = 10.0,
+    ) -> str:
+        """
+        Poll the guest agent (with backoff) until the VM reports an IPv4
+        address. The interface is picked by the MAC address(es) in the VM's
+        config, falling back to "eth0" if the config has none.
+        """
+        vm_config = await self.get_vm_config(node_name=node_name, vm_id=vm_id)
+        if not bool(vm_config.get("agent", 0)):
+            raise Exception("QEMU Guest agent must be installed for this to work")
+        mac_addresses = vm_mac_addresses(vm_config)
+
+        async def reported_ip() -> Optional[str]:
+            try:
+                result = await self.get(
+                    f"/nodes/{node_name}/qemu/{vm_id}/agent/network-get-interfaces"
+                )
+            except ResourceException:
+                # Agent isn't up (yet)
+                return None
+            if len(mac_addresses) > 0:
+                return ipv4_of_mac_addresses(result["result"], mac_addresses)
+            return ipv4_of_interface(result["result"], name="eth0")
+
+        return await poll_with_backoff_async(
+            check=reported_ip,
+            max_wait_in_seconds=max_wait_in_seconds,
+            description=f"VM {vm_id} IP address",
+            initial_delay_in_seconds=initial_delay_in_seconds,
+            max_delay_in_seconds=max_delay_in_seconds,
+        )
+
+    async def find_available_disk_interfaces(
+        self, node_name: str, vm_id: int
+    ) -> Dict[str, List[int]]:
+        vm_config = await self.get_vm_config(node_name=node_name, vm_id=vm_id)
+        return available_disk_interfaces(vm_config)
+
+    ###########################
+    # Batches (one request per VM, all in flight at once)
+    ###########################
+
+    async def get_vm_configs(
+        self, node_name: str, vm_ids: List[int]
+    ) -> Dict[int, Dict[str, Any]]:
+        return await self._per_vm(self.get_vm_config, node_name, vm_ids)
+
+    async def get_vm_statuses(
+        self, node_name: str, vm_ids: List[int]
+    ) -> Dict[int, str]:
+        return await self._per_vm(self.get_vm_status, node_name, vm_ids)
+
+    async def get_ips_of_vms(self, node_name: str, vm_ids: List[int]) -> Dict[int, str]:
+        return await self._per_vm(self.get_ip_of_vm, node_name, vm_ids)
+
+    async def wait_for_ips_of_vms(
+        self, node_name: str, vm_ids: List[int], max_wait_in_seconds: float = 300
+    ) -> Dict[int, str]:
+        return await self._per_vm(
+            functools.partial(
+                self.wait_for_ip_of_vm, max_wait_in_seconds=max_wait_in_seconds
+            ),
+            node_name,
+            vm_ids,
+        )
+
+    @staticmethod
+    async def _per_vm(operation, node_name: str, vm_ids: List[int]) -> Dict[int, Any]:
+        results = await asyncio.gather(
+            *[operation(node_name=node_name, vm_id=vm_id) for vm_id in vm_ids]
+        )
+        return dict(zip(vm_ids, results))
+
+
+class ProxmoxClient:
+    """
+    Synchronous facade over ProxmoxAsyncClient, for the dynamic providers.
+
+    Every coroutine of the async client is available as a plain method. They
+    run on an event loop in a background thread, so this works whether or not
+    the caller is already inside a running loop.
+
+        client = ProxmoxClient(ProxmoxAsyncClient.from_connection_args(args))
+        statuses = client.get_vm_statuses("pve", [501, 502, 503])
+    """
+
+    def __init__(self, async_client: ProxmoxAsyncClient):
+        self.async_client = async_client
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine: Awaitable[T]) -> T:
+        """
+        Run any coroutine (i.e. an asyncio.gather of client calls) to completion.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def close(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self.async_client.close()
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "async_client":
+            raise AttributeError(name)
+        attribute = getattr(self.async_client, name)
+        if not inspect.iscoroutinefunction(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def run_sync(*args, **kwargs):
+            return self.run(attribute(*args, **kwargs))
+
+        return run_sync
@@ -1,5 +1,6 @@
 import json
 import os
+import shlex
 from typing import Any, Optional, Sequence
 
 import pulumi
@@ -8,6 +9,7 @@ import pulumi_tls
 from pulumi import Input, Output
 
 from home_infra.utils.pulumi_extras import PulumiExtras
+from pulumi_mrsharky.proxmox.gpu_roms import gpu_rom_sync_script
 from pulumi_mrsharky.proxmox.proxmox_connection import ProxmoxConnectionArgs
 from pulumi_mrsharky.remote.enable_iommu import EnableIOMMU, EnableIOMMUArgs
 
@@ -22,6 +24,9 @@ class ProxmoxBase(pulumi.ComponentResource):
         private_key: Input[pulumi_tls.PrivateKey],
         proxmox_api_username: Input[str] = "pulumi",
         proxmox_api_token_name: Input[str] = "provider",
+        gpu_rom_max_parallel_downloads: int = 8,
+        gpu_rom_use_archive: bool = False,
+        gpu_rom_detect_hardware: bool = True,
         stdin: Optional[pulumi.Input[str]] = None,
         triggers: Optional[pulumi.Input[Sequence[Any]]] = None,
         opts: Optional[pulumi.ResourceOptions] = None,
@@ -35,6 +40,9 @@ class ProxmoxBase(pulumi.ComponentResource):
         self.private_key = private_key
         self.proxmox_api_username = proxmox_api_username
         self.proxmox_api_token_name = proxmox_api_token_name
+        self.gpu_rom_max_parallel_downloads = gpu_rom_max_parallel_downloads
+        self.gpu_rom_use_archive = gpu_rom_use_archive
+        self.gpu_rom_detect_hardware = gpu_rom_detect_hardware
 
         super().__init__(
             t="pkg:index:Proxmox",
@@ -191,70 +199,19 @@ class ProxmoxBase(pulumi.ComponentResource):
         """
         Copy over GPU rom files for iGPU passthrough
         """
-        # Download gpu roms
+        # Download gpu roms (only new/changed ones, a few at a time). Unless
+        # disabled, only the roms matching the host's CPU/iGPU are fetched
         # https://github.com/isc30/ryzen-gpu-passthrough-proxmox
-        download_script = []
-        roms = [
-            "AMDGopDriver-5825U.rom",
-            "AMDGopDriver.rom",
-            "AMDGopDriver_5500U.rom",
-            "AMDGopDriver_5600G.rom",
-            "AMDGopDriver_5700G.rom",
-            "AMDGopDriver_5700U.rom",
-            "AMDGopDriver_5800H.rom",
-            "AMDGopDriver_6600H.rom",
-            "AMDGopDriver_6800H.rom",
-            "AMDGopDriver_6900HX.rom",
-            "AMDGopDriver_7840hs.rom",
-            "AMDGopDriver_7900.rom",
-            "AMDGopDriver_7950x.rom",
-            "AMDGopDriver_8700GE.rom",
-            "AMDGopDriver_8745hs.rom",
-            "AMDGopDriver_8845hs.rom",
-            "AMDGopDriver_8945.rom",
-            "AMDGopDriver_9700x.rom",
-            "AMDGopDriver_9800x3d.rom",
-            "vbios_5500U.bin",
-            "vbios_5600G.bin",
-            "vbios_5700G.bin",
-            "vbios_5700U.bin",
-            "vbios_5825U.bin",
-            "vbios_6600h.bin",
-            "vbios_6800h.bin",
-            "vbios_6900HX.bin",
-            "vbios_7530u.bin",
-            "vbios_7600x.bin",
-            "vbios_7700x.rom",
-            "vbios_7735hs.bin",
-            "vbios_7840hs.bin",
-            "vbios_7900.bin",
-            "vbios_7900x.bin",
-            "vbios_7940hs.bin",
-            "vbios_7945hx.bin",
-            "vbios_7950x.bin",
-            "vbios_7950x3d.bin",
-            "vbios_8600g.bin",
-            "vbios_8700g.bin",
-            "vbios_8745hs.bin",
-            "vbios_8845hs.bin",
-            "vbios_8845hs.dat",
-            "vbios_8945.bin",
-            "vbios_9700x.bin",
-            "vbios_9800x3d.bin",
-            "vbios_9950x.rom",
-        ]
-        for rom in roms:
-            download_script.append(
-                f"sudo wget --continue --output-document=/usr/share/kvm/{rom} "
-                + f"https://github.com/isc30/ryzen-gpu-passthrough-proxmox/raw/refs/heads/main/{rom} ",
-            )
-
-        download_script_str = " && ".join(download_script)
+        download_script = gpu_rom_sync_script(
+            max_parallel_downloads=self.gpu_rom_max_parallel_downloads,
+            use_archive=self.gpu_rom_use_archive,
+            detect_hardware=self.gpu_rom_detect_hardware,
+        )
 
         PulumiExtras.run_command_on_remote_host(
             resource_name=f"{resource_name_prefix}_download_gpu_roms",
             connection=self.pulumi_connection,
-            create=download_script_str,
+            create=f"sudo bash -c {shlex.quote(download_script)}",
             opts=pulumi.ResourceOptions(
                 parent=self.enable_iommu,
             ),
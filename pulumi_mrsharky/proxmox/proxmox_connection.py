@@ -1,16 +1,22 @@
 import json
 import os
 import re
+import shlex
 import time
-from typing import Dict
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import pulumi
 from paramiko.client import SSHClient
-from proxmoxer import ProxmoxAPI
+from proxmoxer.core import ResourceException
 from pulumi import Input
 
+from pulumi_mrsharky.common.backoff import poll_with_backoff
 from pulumi_mrsharky.common.remote import RemoteMethods
+from pulumi_mrsharky.proxmox.cluster_inventory import ClusterInventory
+from pulumi_mrsharky.proxmox.proxmox_sessions import ProxmoxSessionRegistry
+from pulumi_mrsharky.proxmox.task_tracker import ProxmoxTaskTracker
+from pulumi_mrsharky.proxmox.vm_config import VmConfig
 
 AVAILABLE_DISK_INTERFACES = {
     "ide": {
@@ -33,6 +39,97 @@ AVAILABLE_DISK_INTERFACES = {
 
 PROXMOX_ISO_BASE_LOCATION = "/var/lib/vz/template/iso"
 
+# Compressed image extension -> `compression` the download-url API decompresses
+ISO_API_COMPRESSIONS = {
+    ".gz": "gz",
+    ".lzo": "lzo",
+    ".zst": "zst",
+    ".bz2": "bz2",
+}
+
+# Compressed image extension -> command that decompresses stdin to stdout
+# NOTE: funzip only extracts the first file in the zip (and needs unzip on the
+# host)
+ISO_DECOMPRESS_COMMANDS = {
+    ".gz": "gzip -dc",
+    ".zip": "funzip",
+    ".xz": "xz -dc",
+    ".zst": "zstd -dc",
+}
+
+
+def ipv4_of_interface(interfaces: List[Dict[str, Any]], name: str) -> Optional[str]:
+    """
+    First IPv4 address of the interface called `name`, from the guest agent's
+    network-get-interfaces result (None if it has none yet).
+    """
+    for interface in interfaces:
+        if interface.get("name") == name:
+            for ip in interface.get("ip-addresses", []):
+                if ip["ip-address-type"] == "ipv4":
+                    return ip["ip-address"]
+    return None
+
+
+def vm_mac_addresses(vm_config: Dict[str, Any]) -> List[str]:
+    """
+    MAC addresses of the VM's network devices (net0, net1, ...), lowercase.
+    """
+    macs = []
+    for key, value in vm_config.items():
+        if re.fullmatch(r"net[0-9]+", key):
+            # i.e. "virtio=BC:24:11:2F:9A:01,bridge=vmbr0,firewall=1"
+            m = re.search(r"=((?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2})", str(value))
+            if m:
+                macs.append(m.group(1).lower())
+    return macs
+
+
+def ipv4_of_mac_addresses(
+    interfaces: List[Dict[str, Any]], mac_addresses: List[str]
+) -> Optional[str]:
+    """
+    First usable IPv4 address (not loopback / link-local) of an interface with
+    one of `mac_addresses`, from the guest agent's network-get-interfaces
+    result (None if there's none yet).
+    """
+    for interface in interfaces:
+        if str(interface.get("hardware-address", "")).lower() not in mac_addresses:
+            continue
+        for ip in interface.get("ip-addresses", []):
+            address = ip["ip-address"]
+            if ip["ip-address-type"] == "ipv4" and not address.startswith(
+                ("127.", "169.254.")
+            ):
+                return address
+    return None
+
+
+def available_disk_interfaces(vm_config: Dict[str, Any]) -> Dict[str, List[int]]:
+    """
+    Per disk interface (ide, sata, ...) the numbers not used in `vm_config`.
+    """
+    existing_interfaces: Dict[str, List[int]] = {
+        interface: [] for interface in AVAILABLE_DISK_INTERFACES
+    }
+
+    # Go through devices and identify what we have
+    for device in vm_config:
+        regex_pattern = r"(?P<interface>ide|sata|scsi|virtio)(?P<number>[0-9]+)"
+        m = re.fullmatch(regex_pattern, device)
+        if m:
+            grouped = m.groupdict()
+            existing_interfaces[grouped["interface"]].append(int(grouped["number"]))
+
+    # Find available numbers
+    available_interfaces = {}
+    for interface, bounds in AVAILABLE_DISK_INTERFACES.items():
+        all_numbers = set(range(bounds["lower_bound"], bounds["upper_bound"] + 1))
+        available_interfaces[interface] = list(
+            all_numbers - set(existing_interfaces[interface])
+        )
+    return available_interfaces
+
 
 @pulumi.input_type
 class ProxmoxConnectionArgs(object):
@@ -84,7 +181,6 @@ class ProxmoxConnection:
     api_token_value: Input[str] = None
     api_password: Input[str] = None
     api_verify_ssl: Input[bool] = False
-    proxmox_ssh: SSHClient = None
 
     def __init__(
         self,
@@ -103,27 +199,30 @@ class ProxmoxConnection:
         self.api_password = proxmox_connection_args.api_password
         self.api_verify_ssl = bool(proxmox_connection_args.api_verify_ssl)
 
-        # Generate a proxmoxer connection
-        if self.api_token_name is not None and self.api_token_value is not None:
-            self.proxmox_api = ProxmoxAPI(
-                host=self.host,
-                user=self.api_user,
-                token_name=self.api_token_name,
-                token_value=self.api_token_value,
-                verify_ssl=self.api_verify_ssl,
-            )
-        elif self.api_password is not None:
-            self.proxmox_api = ProxmoxAPI(
-                host=self.host,
-                user=self.api_user,
-                password=self.api_password,
-                verify_ssl=self.api_verify_ssl,
-            )
-        else:
-            raise SyntaxError("Must connect either via token or password.")
+        # Authenticated proxmoxer session (shared through the process-wide
+        # registry, so the TLS handshake / login only happens once per host)
+        if self.api_token_name is None or self.api_token_value is None:
+            if self.api_password is None:
+                raise SyntaxError("Must connect either via token or password.")
+        self.proxmox_api = ProxmoxSessionRegistry.instance().api(
+            host=self.host,
+            user=self.api_user,
+            token_name=self.api_token_name,
+            token_value=self.api_token_value,
+            password=self.api_password,
+            verify_ssl=self.api_verify_ssl,
+        )
+
+        # Cached view of the cluster, so existence checks don't re-list everything
+        self.inventory = ClusterInventory(self.proxmox_api)
 
-        # Generate an ssh connection
-        self.proxmox_ssh = RemoteMethods.ssh_connection(
+        # Waits on the UPIDs returned by long-running API calls
+        self.tasks = ProxmoxTaskTracker(self.proxmox_api)
+
+    def ssh_session(self) -> ContextManager[SSHClient]:
+        # Pooled ssh connection to the host, checked out for the with block
+        # (only opened on first use, plenty of callers only need the API)
+        return RemoteMethods.ssh_session(
             host=self.host,
             user=self.ssh_user,
             port=self.ssh_port,
@@ -131,9 +230,32 @@ class ProxmoxConnection:
             private_key=self.ssh_private_key,
         )
 
-    def __del__(self):
-        if self.proxmox_ssh is not None:
-            self.proxmox_ssh.close()
+    def vm_config(
+        self, node_name: str, vm_id: int, digest: Optional[str] = None
+    ) -> VmConfig:
+        """
+        Builder for config changes to a VM, applied with a single PUT. Pass the
+        `digest` of the config the changes were based on (if any).
+        """
+        return VmConfig(
+            proxmox_connection=self, node_name=node_name, vm_id=vm_id, digest=digest
+        )
+
+    def _ssh_exec(self, command: str) -> Tuple[str, str, int]:
+        # Run a command on the proxmox host: (stdout, stderr, exit status)
+        with self.ssh_session() as ssh:
+            _, stdout, stderr = ssh.exec_command(command)
+            output = stdout.read().decode("utf-8").strip("\n")
+            error = stderr.read().decode("utf-8").strip("\n")
+            exit_status = stdout.channel.recv_exit_status()
+        return output, error, exit_status
+
+    def _run_ssh_command(self, command: str) -> Tuple[str, str]:
+        # Run a command on the proxmox host, raise if it fails
+        output, error, exit_status = self._ssh_exec(command)
+        if exit_status != 0:
+            raise Exception(f"Command failed ({exit_status}): {command}\n{error}")
+        return output, error
 
     def install_app_via_apt_get(self, applications: str):
         return
@@ -221,24 +343,21 @@ class ProxmoxConnection:
     def create_user(
         self, node_name: str, username: str, role: str = "Administrator"
     ) -> None:
-        create_user = self.proxmox_ssh.exec_command(
+        create_user, _, _ = self._ssh_exec(
             f"sudo pveum user add {username}@{node_name}"
         )
-        create_user = create_user[1].read().decode("ascii").strip("\n")
         print(create_user)
 
-        add_role = self.proxmox_ssh.exec_command(
+        add_role, _, _ = self._ssh_exec(
             f"sudo pveum aclmod / -user {username}@{node_name} -role {role}"
         )
-        add_role = add_role[1].read().decode("ascii").strip("\n")
         print(add_role)
         return
 
     def delete_user(self, node_name: str, username: str) -> None:
-        delete_user = self.proxmox_ssh.exec_command(
+        delete_user, _, _ = self._ssh_exec(
             f"sudo pveum user delete {username}@{node_name}"
         )
-        delete_user = delete_user[1].read().decode("ascii").strip("\n")
         print(delete_user)
         return
 
@@ -249,21 +368,19 @@ class ProxmoxConnection:
         token_name: str = "provider",
         expire: int = 0,
     ) -> str:
-        create_token = self.proxmox_ssh.exec_command(
+        create_token_output, _, _ = self._ssh_exec(
             f"sudo pveum user token add {username}@{node_name} {token_name} "
             + f"--privsep=0 --expire {expire} --output-format json"
         )
-        create_token_output = create_token[1].read().decode("ascii").strip("\n")
         token = json.loads(create_token_output).get("value")
         return token
 
     def delete_token(
         self, node_name: str, username: str, token_name: str = "provider"
     ) -> None:
-        delete_token = self.proxmox_ssh.exec_command(
+        delete_token, _, _ = self._ssh_exec(
             f"sudo pveum user token remove {username}@{node_name} {token_name}"
         )
-        delete_token = delete_token[1].read().decode("ascii").strip("\n")
         print(delete_token)
         return
 
@@ -286,24 +403,24 @@ class ProxmoxConnection:
         parsed_url = urlparse(url)
         download_image_name = os.path.basename(parsed_url.path)
 
-        # Figure out what the final local_image_name will be
-        gzip_compressed = False
-        zip_compressed = False
-        if download_image_name.endswith(".gz"):
-            local_image_name = download_image_name.removesuffix(".gz")
-            gzip_compressed = True
-        elif download_image_name.endswith(".zip"):
-            local_image_name = download_image_name.removesuffix(".zip")
-            zip_compressed = True
+        # Figure out what the final local_image_name will be (and how to
+        # decompress it on the fly)
+        local_image_name = download_image_name
+        decompress = None
+        for extension, decompress_command in ISO_DECOMPRESS_COMMANDS.items():
+            if download_image_name.endswith(extension):
+                local_image_name = download_image_name.removesuffix(extension)
+                decompress = decompress_command
+                break
 
         # Double check the local name ends with .iso or .img
-        if not local_image_name.endswith(".iso") or local_image_name.endswith(".img"):
+        if not local_image_name.endswith((".iso", ".img")):
             raise Exception(f"Image is not an .iso or .img {local_image_name}")
 
         # Check if the image is already present
         command_to_run = f'[[ -f "{PROXMOX_ISO_BASE_LOCATION}/{local_image_name}" ]] && echo "1" || echo "";'
-        detect_file = self.proxmox_ssh.exec_command(command_to_run)
-        iso_exists = bool(detect_file[1].read().decode("ascii").strip())
+        detect_file, _, _ = self._ssh_exec(command_to_run)
+        iso_exists = bool(detect_file.strip())
         print(
             f"Image file: {PROXMOX_ISO_BASE_LOCATION}/{local_image_name} - EXISTS: {iso_exists}"
         )
@@ -311,79 +428,203 @@ class ProxmoxConnection:
         if iso_exists:
             return local_image_name
 
-        # Download the file to "/tmp/"
-        print(f"Downloading (start): {url}")
-        download_file = self.proxmox_ssh.exec_command(
-            f"wget --continue --output-document=/tmp/{download_image_name} {url}"
+        # Download and decompress in one pass, straight into a .partial file
+        # next to the final one, then rename it into place (atomic, and
+        # proxmox doesn't list the .partial file in the meantime)
+        final_path = f"{PROXMOX_ISO_BASE_LOCATION}/{local_image_name}"
+        partial_path = f"{final_path}.partial"
+        pipeline = f"curl --fail --silent --show-error --location {shlex.quote(url)}"
+        if decompress is not None:
+            pipeline += f" | {decompress}"
+        script = (
+            "set -o pipefail; "
+            f"{pipeline} > {shlex.quote(partial_path)} && "
+            f"mv -f {shlex.quote(partial_path)} {shlex.quote(final_path)} || "
+            f"{{ rm -f {shlex.quote(partial_path)}; exit 1; }}"
         )
-        download_file_output = download_file[1].read().decode("ascii").strip("\n")
-        print(f"Downloading (end): {url}")
-        print(download_file_output)
-
-        uncompress_file = ""
-        if gzip_compressed:
-            uncompress_file = self.proxmox_ssh.exec_command(
-                f"gzip -dkf /tmp/{download_image_name}"
-            )
-            uncompress_file = uncompress_file[1].read().decode("ascii").strip("\n")
-        elif zip_compressed:
-            uncompress_file = self.proxmox_ssh.exec_command(
-                f"gzip -dkf /tmp/{download_image_name}"
+        # The decompressor isn't always installed (funzip comes with unzip)
+        if decompress is not None:
+            tool = decompress.split()[0]
+            _, _, exit_status = self._ssh_exec(f"command -v {tool}")
+            if exit_status != 0:
+                raise Exception(
+                    f"Can't decompress '{download_image_name}': '{tool}' is not "
+                    "installed on the proxmox host"
+                )
+
+        print(f"Downloading (start): {url} to: {final_path}")
+        # stdout / stderr are read before waiting on the exit status, so a
+        # chatty download can't fill the channel and hang
+        _, error, exit_status = self._ssh_exec(f"sudo bash -c {shlex.quote(script)}")
+        if exit_status != 0:
+            raise Exception(f"Failed to download '{url}' ({exit_status}): {error}")
+        print(f"Downloading (end): {url} to: {final_path}")
+        return local_image_name
+
+    def wait_for_task(
+        self,
+        node_name: str,
+        upid: str,
+        max_wait_in_seconds: float = 3600,
+        description: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Block until the proxmox task finishes. Raises if it didn't finish OK.
+        """
+        return self.tasks.wait(
+            upid=upid,
+            node_name=node_name,
+            max_wait_in_seconds=max_wait_in_seconds,
+            description=description,
+        )
+
+    def run_task(
+        self,
+        node_name: str,
+        path: str,
+        description: str,
+        max_wait_in_seconds: float = 3600,
+        **params,
+    ) -> Dict[str, Any]:
+        """
+        POST to an API endpoint that starts a task (returns a UPID) and wait
+        for it to finish.
+        """
+        upid = self.proxmox_api(path).post(**params)
+        return self.wait_for_task(
+            node_name=node_name,
+            upid=upid,
+            max_wait_in_seconds=max_wait_in_seconds,
+            description=description,
+        )
+
+    def get_storage_content(
+        self, node_name: str, storage: str, volid: str
+    ) -> Optional[Dict[str, Any]]:
+        for content in self.proxmox_api(
+            f"/nodes/{node_name}/storage/{storage}/content"
+        ).get():
+            if content.get("volid") == volid:
+                return content
+        return None
+
+    def download_iso_image_via_api(
+        self,
+        node_name: str,
+        url: str,
+        storage: str = "local",
+        checksum: Optional[str] = None,
+        checksum_algorithm: Optional[str] = None,
+        verify_certificates: bool = True,
+        max_wait_in_seconds: float = 3600,
+    ) -> Dict[str, Any]:
+        """
+        Have proxmox itself download (verify and decompress) the image, via the
+        download-url API, and wait for the task. Nothing streams through this
+        process. `checksum` is of the file at `url`.
+
+        Returns the local_image_name, the size in bytes, and how long the
+        download took (duration is 0.0 if the image was already there).
+        """
+        download_image_name = os.path.basename(urlparse(url).path)
+        local_image_name = download_image_name
+        compression = None
+        for extension, api_compression in ISO_API_COMPRESSIONS.items():
+            if download_image_name.endswith(extension):
+                local_image_name = download_image_name.removesuffix(extension)
+                compression = api_compression
+                break
+        if not local_image_name.endswith((".iso", ".img")):
+            raise Exception(
+                f"Image is not an .iso or .img (or a compression the API can "
+                f"handle: {list(ISO_API_COMPRESSIONS)}) {download_image_name}"
             )
-            uncompress_file = uncompress_file[1].read().decode("ascii").strip("\n")
-        print(uncompress_file)
 
-        # Move the file to the iso folder
-        print(
-            f"Moving (start): /tmp/{local_image_name} to: {PROXMOX_ISO_BASE_LOCATION}/{local_image_name}"
+        volid = f"{storage}:iso/{local_image_name}"
+        existing = self.get_storage_content(
+            node_name=node_name, storage=storage, volid=volid
         )
-        mv_file = self.proxmox_ssh.exec_command(
-            f"sudo mv /tmp/{local_image_name} {PROXMOX_ISO_BASE_LOCATION}/{local_image_name}"
+        print(f"Image file: {volid} - EXISTS: {existing is not None}")
+        if existing is not None:
+            return {
+                "local_image_name": local_image_name,
+                "size": existing.get("size"),
+                "duration": 0.0,
+            }
+
+        data = {
+            "content": "iso",
+            "filename": local_image_name,
+            "url": url,
+            "verify-certificates": 1 if verify_certificates else 0,
+        }
+        if compression is not None:
+            data["compression"] = compression
+        if checksum is not None:
+            if checksum_algorithm is None:
+                raise Exception("checksum_algorithm is required with checksum")
+            data["checksum"] = checksum
+            data["checksum-algorithm"] = checksum_algorithm
+
+        print(f"Downloading (start): {url} to: {volid}")
+        start_time = time.time()
+        upid = self.proxmox_api(
+            f"/nodes/{node_name}/storage/{storage}/download-url"
+        ).post(**data)
+        self.wait_for_task(
+            node_name=node_name,
+            upid=upid,
+            max_wait_in_seconds=max_wait_in_seconds,
+            description=f"download {local_image_name}",
         )
-        mv_file = mv_file[1].read().decode("ascii").strip("\n")
-        print(mv_file)
-        print(
-            f"Moving (end): /tmp/{local_image_name} to: {PROXMOX_ISO_BASE_LOCATION}/{local_image_name}"
+        duration = time.time() - start_time
+        print(f"Downloading (end): {url} to: {volid} in {duration:.1f} seconds")
+
+        downloaded = self.get_storage_content(
+            node_name=node_name, storage=storage, volid=volid
         )
-        return local_image_name
+        return {
+            "local_image_name": local_image_name,
+            "size": downloaded.get("size") if downloaded is not None else None,
+            "duration": duration,
+        }
+
+    def remove_iso_image_via_api(
+        self, node_name: str, local_image_name: str, storage: str = "local"
+    ) -> None:
+        volid = f"{storage}:iso/{local_image_name}"
+        if self.get_storage_content(node_name=node_name, storage=storage, volid=volid):
+            self.proxmox_api(
+                f"/nodes/{node_name}/storage/{storage}/content/{volid}"
+            ).delete()
+        return
 
     def remove_iso_image(self, local_image_name: str):
         # Check if the is present (it could have been deleted)
         command_to_run = f'[[ -f "{PROXMOX_ISO_BASE_LOCATION}/{local_image_name}" ]] && echo "1" || echo "";'
-        detect_file = self.proxmox_ssh.exec_command(command_to_run)
-        iso_exists = bool(detect_file[1].read().decode("ascii").strip())
+        detect_file, _, _ = self._ssh_exec(command_to_run)
+        iso_exists = bool(detect_file.strip())
         print(
             f"Image file: {PROXMOX_ISO_BASE_LOCATION}/{local_image_name} - EXISTS: {iso_exists}"
         )
 
         # Remove the iso file
         if iso_exists:
-            rm_file = self.proxmox_ssh.exec_command(
+            rm_file, _, _ = self._ssh_exec(
                 f"sudo rm {PROXMOX_ISO_BASE_LOCATION}/{local_image_name}"
             )
-            rm_file = rm_file[1].read().decode("ascii").strip("\n")
             print(rm_file)
 
         return
 
     def check_node_exists(self, node_name: str) -> bool:
-        # Loop on the nodes and see if we found it
-        for curr_node in self.proxmox_api.nodes.get():
-            if curr_node.get("node") == node_name:
-                return True
-        return False
+        return self.inventory.has_node(node_name)
 
     def check_vm_exists(self, node_name: str, vm_id: int):
-        for vm in self.proxmox_api.nodes(node_name).qemu.get():
-            if vm.get("vmid") == vm_id:
-                return True
-        return False
+        return self.inventory.has_vm(node_name=node_name, vm_id=vm_id)
 
     def _qemu_guest_agent_installed(self, vm_id: int) -> bool:
-        vm_config_results = self.proxmox_ssh.exec_command(
-            f"qm config {vm_id} --current 1"
-        )
-        vm_config_results = vm_config_results[1].read().decode("ascii").strip("\n")
+        vm_config_results, _, _ = self._ssh_exec(f"qm config {vm_id} --current 1")
 
         # Regular expression pattern to match "agent: X" where X is a number
         pattern = r"^agent:\s*(?P<value>\d)$"
@@ -394,25 +635,69 @@ class ProxmoxConnection:
         return guest_installed
 
     def qemu_guest_agent_installed(self, node_name: str, vm_id: int) -> bool:
-        vm_config_results = self.proxmox_api(
-            f"/nodes/{node_name}/qemu/{vm_id}/config"
-        ).get()
+        vm_config_results = self.inventory.vm_config(node_name=node_name, vm_id=vm_id)
         guest_installed = bool(vm_config_results.get("agent", 0))
         return guest_installed
 
-    def start_vm(self, node_name: str, vm_id: int, wait: int = 30):
+    def get_vm_status(self, node_name: str, vm_id: int) -> str:
+        status = self.proxmox_api(
+            f"/nodes/{node_name}/qemu/{vm_id}/status/current"
+        ).get()
+        return status.get("status")
+
+    def ping_qemu_guest_agent(self, node_name: str, vm_id: int) -> bool:
+        try:
+            self.proxmox_api(f"/nodes/{node_name}/qemu/{vm_id}/agent/ping").post()
+        except ResourceException:
+            # Agent isn't up (yet)
+            return False
+        return True
+
+    def start_vm(
+        self,
+        node_name: str,
+        vm_id: int,
+        max_wait_in_seconds: int = 300,
+        wait_for_agent: bool = True,
+    ) -> float:
+        """
+        Start the VM and block until it's running (and its guest agent answers,
+        when one is configured). Returns the seconds it took to become ready.
+        """
         # Double check that vm_id exists
         if not self.check_vm_exists(node_name=node_name, vm_id=vm_id):
             raise Exception(f"VM {vm_id} doesn't exist on the proxmox cluster")
 
-        # Start the VM
-        self.proxmox_api(f"/nodes/{node_name}/qemu/{vm_id}/status/start").post()
-        # self.proxmox_ssh.exec_command(f"qm start {vm_id}")
+        start_time = time.time()
 
-        # Wait for the VM to start
-        print(f"Waiting {wait} seconds for VM to start")
-        time.sleep(wait)
-        return
+        # Start the VM (unless it's already up) and wait for the start task
+        if self.get_vm_status(node_name=node_name, vm_id=vm_id) != "running":
+            self.run_task(
+                node_name=node_name,
+                path=f"/nodes/{node_name}/qemu/{vm_id}/status/start",
+                description=f"start {vm_id}",
+                max_wait_in_seconds=max_wait_in_seconds,
+            )
+            self.inventory.invalidate_vm(node_name=node_name, vm_id=vm_id)
+
+        # Then for the guest agent to answer (if there is one)
+        if wait_for_agent and self.qemu_guest_agent_installed(
+            node_name=node_name, vm_id=vm_id
+        ):
+            remaining = max(max_wait_in_seconds - (time.time() - start_time), 1)
+            poll_with_backoff(
+                check=lambda: (
+                    True
+                    if self.ping_qemu_guest_agent(node_name=node_name, vm_id=vm_id)
+                    else None
+                ),
+                max_wait_in_seconds=remaining,
+                description=f"VM {vm_id} guest agent",
+            )
+
+        time_to_ready = time.time() - start_time
+        print(f"VM {vm_id} ready after {time_to_ready:.1f} seconds")
+        return time_to_ready
 
     def get_ip_of_vm(self, node_name: str, vm_id: int) -> str:
         # Double check that vm_id exists
@@ -426,61 +711,18 @@ class ProxmoxConnection:
         result = self.proxmox_api(
             f"/nodes/{node_name}/qemu/{vm_id}/agent/network-get-interfaces"
         ).get()
-        ip_infos = result["result"]
-
-        # Loop through all the values and get the correct IP address
-        ip_address = None
-        for ip_info in ip_infos:
-            if ip_info["name"] == "eth0":
-                for ip in ip_info["ip-addresses"]:
-                    if ip["ip-address-type"] == "ipv4":
-                        ip_address = ip["ip-address"]
-                        break
-
+        ip_address = ipv4_of_interface(result["result"], name="eth0")
         if ip_address is None:
             raise Exception("Unable to find an IP address")
 
         return ip_address
 
     def check_drive_exists(self, node_name: str, drive_id: str):
-        for curr_drive in self.proxmox_api.nodes(node_name).disks.list.get():
-            if curr_drive.get("by_id_link") == f"/dev/disk/by-id/{drive_id}":
-                return True
-        return False
+        return self.inventory.has_drive(node_name=node_name, drive_id=drive_id)
 
     def find_available_disk_interfaces(self, node_name: str, vm_id: int):
-        devices = self.proxmox_api(f"nodes/{node_name}/qemu/{vm_id}/config").get()
-        existing_interfaces = {}
-        for curr_interface in list(AVAILABLE_DISK_INTERFACES.keys()):
-            existing_interfaces[curr_interface] = []
-
-        # Go through devices and identify what we have
-        for device in list(devices.keys()):
-            regex_pattern = r"(?P<interface>ide|sata|scsi|virtio)(?P<number>[0-9]+)"
-            m = re.fullmatch(regex_pattern, device)
-            if m:
-                grouped = m.groupdict()
-                interface = grouped["interface"]
-                number = int(grouped["number"])
-                existing_interfaces[interface].append(number)
-
-        # Find available numbers
-        available_interfaces = {}
-        for curr_interface in list(AVAILABLE_DISK_INTERFACES.keys()):
-            curr_available = self._find_available_numbers(
-                current_numbers=existing_interfaces[curr_interface],
-                lower_bound=AVAILABLE_DISK_INTERFACES[curr_interface]["lower_bound"],
-                upper_bound=AVAILABLE_DISK_INTERFACES[curr_interface]["upper_bound"],
-            )
-            available_interfaces[curr_interface] = curr_available
-        return available_interfaces
-
-    def _find_available_numbers(
-        self, current_numbers, lower_bound: int, upper_bound: int
-    ):
-        all_numbers = set(range(lower_bound, upper_bound + 1))
-        available_numbers = list(all_numbers - set(current_numbers))
-        return available_numbers
+        devices = self.inventory.vm_config(node_name=node_name, vm_id=vm_id)
+        return available_disk_interfaces(devices)
 
     def attach_drive_to_vm(
         self,
@@ -511,8 +753,8 @@ class ProxmoxConnection:
             node_name=node_name, vm_id=vm_id
         )
 
-        # Check the device hasn't already been added
-        devices = self.proxmox_api(f"nodes/{node_name}/qemu/{vm_id}/config").get()
+        # Check the device hasn't already been added (config is cached from above)
+        devices = self.inventory.vm_config(node_name=node_name, vm_id=vm_id)
         for key, value in devices.items():
             if value == f"/dev/disk/by-id/{drive_id}":
                 raise Exception(
@@ -525,24 +767,27 @@ class ProxmoxConnection:
         volume_type_number = available[volume_type][0]
 
         # Assign the scsi#/ide#/etc... to the drive
-        command_to_run = f"qm set {vm_id} --{volume_type}{volume_type_number} /dev/disk/by-id/{drive_id}"
+        drive = f"/dev/disk/by-id/{drive_id}"
 
         # Add optional arguments
         if ssd_emulation:
-            command_to_run = f"{command_to_run},ssd=1"
-
-        self.proxmox_ssh.exec_command(command_to_run)
+            drive = f"{drive},ssd=1"
+
+        # Based on the config we picked the interface from (fails if the VM was
+        # changed since)
+        # NOTE: Passing through a raw block device is root only in the API, so
+        #       VmConfig sends this one as a single `qm set` over ssh
+        self.vm_config(
+            node_name=node_name, vm_id=vm_id, digest=devices.get("digest")
+        ).set(f"{volume_type}{volume_type_number}", drive).apply()
         results = {
             "interface": f"{volume_type}{volume_type_number}",
         }
         return results
 
     def is_hardware_present(self, node_name, vm_id, hardware_device) -> bool:
-        devices = self.proxmox_api(f"nodes/{node_name}/qemu/{vm_id}/config").get()
-        result = False
-        if hardware_device in devices.keys():
-            result = True
-        return result
+        devices = self.inventory.vm_config(node_name=node_name, vm_id=vm_id)
+        return hardware_device in devices
 
     def remove_drive_from_vm(
         self,
@@ -563,14 +808,17 @@ class ProxmoxConnection:
         ):
             raise Exception(f"VM {vm_id} doesn't have hardware {interface}")
 
-        command_to_run = f"qm set {vm_id} --delete {interface}"
-        results = self.proxmox_ssh.exec_command(command_to_run)
-        stdin = results[0].read().decode("ascii").strip("\n")
-        stdout = results[1].read().decode("ascii").strip("\n")
-        stderr = results[2].read().decode("ascii").strip("\n")
+        devices = self.inventory.vm_config(node_name=node_name, vm_id=vm_id)
+        applied = (
+            self.vm_config(
+                node_name=node_name, vm_id=vm_id, digest=devices.get("digest")
+            )
+            .delete(interface)
+            .apply()
+        )
 
         return {
-            "stdin": stdin,
-            "stdout": stdout,
-            "stderr": stderr,
+            "stdin": "",
+            "stdout": f"update VM {vm_id}: {applied}",
+            "stderr": "",
         }
@@ -1,14 +1,26 @@
 from typing import Dict, List, Optional
+from urllib.parse import quote
 
 import pulumi
 import pulumi_command
 from pulumi import Resource
 
 from home_infra.utils.pulumi_extras import PulumiExtras
+from pulumi_mrsharky.proxmox.clone_spec import clone_spec_cleanup, clone_spec_statements
+from pulumi_mrsharky.proxmox.image_store import CachedImage, CachedImageArgs
+from pulumi_mrsharky.proxmox.provisioning_scheduler import ProvisioningScheduler
 from pulumi_mrsharky.proxmox.proxmox_base import ProxmoxBase
 from pulumi_mrsharky.proxmox.start_vm import StartVm, StartVmArgs
+from pulumi_mrsharky.proxmox.vm_settings import VmSettings, VmSettingsArgs
 from pulumi_mrsharky.remote import RunCommandsOnHost, SaveFileOnRemoteHost
 
+# Clone modes for create_vm
+CLONE_MODE_FULL = "full"
+CLONE_MODE_LINKED = "linked"
+
+# One marker file per linked clone: {LINKED_CLONE_REGISTRY_DIR}/{template_id}/{vm_id}
+LINKED_CLONE_REGISTRY_DIR = "/var/lib/pulumi-provisioning/linked-clones"
+
 
 class ProxmoxNixOS:
     def __init__(
@@ -16,11 +28,17 @@ class ProxmoxNixOS:
         resource_name_prefix: str,
         proxmox_base: ProxmoxBase,
         template_storage_volume_name: str = "local-lvm",
+        provisioning_scheduler: Optional[ProvisioningScheduler] = None,
     ):
         self.resource_name_prefix = resource_name_prefix
         self.proxmox_base = proxmox_base
         self.template_storage_volume_name = template_storage_volume_name
 
+        # Limits how many VMs clone against the same storage at once
+        if provisioning_scheduler is None:
+            provisioning_scheduler = ProvisioningScheduler()
+        self.provisioning_scheduler = provisioning_scheduler
+
         # Create the template image
         self.template_resource = self._create_nixos_template_25_05_bios(
             resource_name=f"{self.resource_name_prefix}NixOSTemplate",
@@ -40,6 +58,20 @@ class ProxmoxNixOS:
 
         return
 
+    def _cached_image(self, resource_name: str, url: str) -> CachedImage:
+        # Downloads the image into the host's image store (only if not there yet)
+        return CachedImage(
+            resource_name=resource_name,
+            cached_image_args=CachedImageArgs(
+                host=self.proxmox_base.proxmox_ip,
+                user=self.proxmox_base.proxmox_api_username,
+                private_key=self.proxmox_base.private_key.private_key_pem,
+                url=url,
+                use_sudo=True,
+            ),
+            opts=pulumi.ResourceOptions(parent=self.proxmox_base.enable_iommu),
+        )
+
     def _create_nixos_template_25_05_bios(
         self,
         resource_name: str,
@@ -48,13 +80,17 @@ class ProxmoxNixOS:
         opts: Optional[pulumi.ResourceOptions] = None,
     ) -> pulumi.Resource:
 
+        image = self._cached_image(
+            resource_name=f"{resource_name}_image",
+            url="https://mrsharky.com/extras/nixos-25.05-cloud-init.img",
+        )
+
         create_script = [
-            "sudo wget --continue --output-document=/var/lib/vz/template/iso/nixos-25.05-cloud-init.img "
-            + "https://mrsharky.com/extras/nixos-25.05-cloud-init.img ",
             f"sudo qm create {template_id} --memory 2048 --core 2 --cpu cputype=host,flags=+aes "
             + "--name nixos-25.05-kvm --net0 virtio,bridge=vmbr0",
-            f"sudo qm importdisk {template_id} /var/lib/vz/template/iso/nixos-25.05-cloud-init.img "
-            + f"{storage_vol_name}",
+            image.path.apply(
+                lambda path: f"sudo qm importdisk {template_id} {path} {storage_vol_name}"
+            ),
             f"sudo qm set {template_id} --scsihw virtio-scsi-pci --scsi0 {storage_vol_name}:vm-{template_id}-disk-0",
             f"sudo qm set {template_id} --ide2 {storage_vol_name}:cloudinit",
             f"sudo qm set {template_id} --boot c --bootdisk scsi0",
@@ -71,13 +107,11 @@ class ProxmoxNixOS:
         ]
 
         delete_script = [
-            f"sudo qm destroy {template_id} --destroy-unreferenced-disks 1 --purge 1"
+            self._template_not_in_use_check(template_id),
+            f"sudo qm destroy {template_id} --destroy-unreferenced-disks 1 --purge 1",
         ]
 
-        create_script = " && ".join(create_script)
-        delete_script = " && ".join(delete_script)
-
-        create_nixos_cloud_init_image = PulumiExtras.run_command_on_remote_host(
+        create_nixos_cloud_init_image = PulumiExtras.run_commands_on_remote_host(
             resource_name=resource_name,
             connection=self.proxmox_base.pulumi_connection,
             create=create_script,
@@ -98,15 +132,19 @@ class ProxmoxNixOS:
         opts: Optional[pulumi.ResourceOptions] = None,
     ) -> pulumi.Resource:
 
+        image = self._cached_image(
+            resource_name=f"{resource_name}_image",
+            url="https://mrsharky.com/extras/nixos-25.05-cloud-init-uefi.qcow2",
+        )
+
         create_script = [
             # "sudo mkdir -p /var/lib/vz/images/9003/ ",
-            "sudo wget --continue --output-document=/var/lib/vz/template/iso/nixos-25.05-cloud-init-uefi.qcow2 "
-            + "https://mrsharky.com/extras/nixos-25.05-cloud-init-uefi.qcow2 ",
             f"sudo qm create {template_id} --memory 2048 --core 2 --cpu cputype=host,flags=+aes "
             + "--name nixos-25.05-kvm-uefi --net0 virtio,bridge=vmbr0 ",
-            f"sudo qm importdisk {template_id} /var/lib/vz/template/iso/nixos-25.05-cloud-init-uefi.qcow2 "
             # f"sudo qm importdisk {template_id} /var/lib/vz/images/9003/vm-9003-disk-0.qcow2 "
-            + f"{storage_vol_name}",
+            image.path.apply(
+                lambda path: f"sudo qm importdisk {template_id} {path} {storage_vol_name}"
+            ),
             f"sudo qm set {template_id} --bios ovmf",
             f"sudo qm set {template_id} --scsihw virtio-scsi-pci --scsi0 {storage_vol_name}:vm-{template_id}-disk-0",
             f"sudo qm set {template_id} --ide2 {storage_vol_name}:cloudinit",
@@ -116,13 +154,11 @@ class ProxmoxNixOS:
         ]
 
         delete_script = [
-            f"sudo qm destroy {template_id} --destroy-unreferenced-disks 1 --purge 1"
+            self._template_not_in_use_check(template_id),
+            f"sudo qm destroy {template_id} --destroy-unreferenced-disks 1 --purge 1",
         ]
 
-        create_script = " && ".join(create_script)
-        delete_script = " && ".join(delete_script)
-
-        create_nixos_cloud_init_image = PulumiExtras.run_command_on_remote_host(
+        create_nixos_cloud_init_image = PulumiExtras.run_commands_on_remote_host(
             resource_name=resource_name,
             connection=self.proxmox_base.pulumi_connection,
             create=create_script,
@@ -135,6 +171,18 @@ class ProxmoxNixOS:
 
         return create_nixos_cloud_init_image
 
+    @staticmethod
+    def _template_not_in_use_check(template_id: int) -> str:
+        # Refuse to destroy a template while linked clones still depend on it
+        registry = f"{LINKED_CLONE_REGISTRY_DIR}/{template_id}"
+        return (
+            f'if [ -n "$(ls -A {registry} 2>/dev/null)" ]; then '
+            f'echo "Template {template_id} is in use by linked clones: '
+            f'$(ls {registry} | tr "\\n" " ")" >&2; '
+            "exit 1; "
+            "fi"
+        )
+
     def create_vm(
         self,
         resource_name: str,
@@ -157,7 +205,16 @@ class ProxmoxNixOS:
         drive_config: Optional[str] = None,
         extra_args: Optional[str] = None,
         enable_agent: Optional[bool] = None,
+        clone_mode: Optional[str] = None,
+        promote_to_storage: Optional[str] = None,
     ):
+        """
+        clone_mode "full" (default) copies the whole template disk onto
+        `lvm_name`. "linked" creates a thin copy-on-write clone on the template's
+        storage instead (seconds, almost no space; needs LVM-thin/ZFS/qcow2). A
+        linked VM can later be made independent of its template by setting
+        `promote_to_storage`, which moves its disk onto that storage.
+        """
         if resource_name in self.resource_lookup:
             raise Exception(f"VM resource '{resource_name}' already exists")
         else:
@@ -188,14 +245,18 @@ class ProxmoxNixOS:
             memory = 2048
         if enable_agent is None:
             enable_agent = True
-
-        # Some inputs need to be strings to be used
-        on_boot = "0"
-        if start_on_boot:
-            on_boot = "1"
-        kvm_status = "0"
-        if kvm:
-            kvm_status = "1"
+        if clone_mode is None:
+            clone_mode = CLONE_MODE_FULL
+        if clone_mode not in (CLONE_MODE_FULL, CLONE_MODE_LINKED):
+            raise ValueError(f"Invalid clone_mode: {clone_mode}")
+        if promote_to_storage is not None:
+            if clone_mode != CLONE_MODE_LINKED:
+                raise ValueError("promote_to_storage only applies to linked clones")
+            if promote_to_storage == self.template_storage_volume_name:
+                raise ValueError(
+                    "promote_to_storage must differ from the template storage "
+                    + f"'{self.template_storage_volume_name}'"
+                )
 
         # sudo qm set 503 --efidisk0 file=local-zfs:vm-503-disk-1,format=qcow2,efitype=4m,size=4M
         # f"qm set {vm_id} --efidisk0 file={lvm_name}:vm-{vm_id}-disk-1,format=qcow2,efitype=4m,size=4M"
@@ -210,6 +271,8 @@ class ProxmoxNixOS:
         #       make a full resource for this in the future
         # key_path = f"/home/{self.proxmox_base.proxmox_api_username}/proxmox_key_vm={vm_id}.pem"
 
+        # NOTE: The VM gets the key through VmSettings now, the file is kept as
+        #       existing VMs hang off this resource
         key_path = f"/home/pulumi/proxmox_key_vm={vm_id}.pem"
         save_key_resource_name = (
             f"{self.resource_name_prefix}_{resource_name}_nixosSshKey"
@@ -227,46 +290,61 @@ class ProxmoxNixOS:
         )
         self.resource_lookup[resource_name][save_key_resource_name] = save_key
 
-        # Create the VM
-        create_script = [
-            # Clone the nixos template
-            f"qm clone {nixos_template_id} {vm_id} --name {vm_name} --storage {lvm_name} "
-            + f'--description "{vm_description}" --full 1',
-            # Set options on the template
-            f"qm set {vm_id} --kvm {kvm_status} --ciuser ops ",
-            f"qm set {vm_id} --cpu {cpu_type}",
-            f"qm set {vm_id} --bios {bios}",
-            f"qm set {vm_id} --cores {cpu_cores}",
-            f"qm set {vm_id} --balloon 0 --memory {memory}",
-            f"qm set {vm_id} --scsi0 {lvm_name}:vm-{vm_id}-disk-0,ssd=1",
-            f"qm disk resize {vm_id} scsi0 {disk_space_in_gb}G",
-            f"qm set {vm_id} --machine {machine}",  # Set the machine
-            f"qm set {vm_id} --onboot {on_boot}",
-            f"qm set {vm_id} --sshkeys {key_path}",  # Set the SSH key
-            # Set cloud-init IP
-            f"qm set {vm_id} --ipconfig0 ip={ip_v4}/{ip_v4_cidr},gw={ip_v4_gw}",
-        ]
-
-        if extra_args is not None and len(extra_args) > 0:
-            create_script.append(f'qm set {vm_id} --args "{extra_args}"')
-
-        if enable_agent:  # Enable qemu agent
-            create_script.append(f"qm set {vm_id} --agent 1")
-
-        # qm set 501 --hostpci0 host=0000:10:00.0,pcie=1,rombar=0,pci=assign
-
-        # Add hardware passthrough (if applicable)
-        for idx, hardware in enumerate(hardware_passthrough):
-            # Set the PCI card (notice it's 0000:02:00 and NOT 0000:02:00.0)
-            # Serial Attached SCSI controller: Broadcom / LSI SAS2008 PCI-Express Fusion-MPT SAS-2 [Falcon] (rev 03)
-            # qm set 300 --hostpci0 host=0000:02:00,rombar=1
-            create_script.append(f"qm set {vm_id} --hostpci{idx} host={hardware}")
+        # Clone the VM. Only what it's cloned from is immutable (changing it
+        # re-clones the VM), everything else is kept in sync by VmSettings below
+        linked_clone_marker = f"{LINKED_CLONE_REGISTRY_DIR}/{nixos_template_id}/{vm_id}"
+        register_script = []
+        if clone_mode == CLONE_MODE_LINKED:
+            clone_spec = f"template={nixos_template_id} clone_mode={clone_mode}"
+            # Record that this VM depends on the template
+            register_script = [
+                f"mkdir -p {LINKED_CLONE_REGISTRY_DIR}/{nixos_template_id}",
+                f"touch {linked_clone_marker}",
+            ]
+            clone_script = [
+                # Linked clone of the nixos template. It lives on the template's
+                # storage and is cheap, so it doesn't need a clone slot
+                f"qm clone {nixos_template_id} {vm_id} --name {vm_name} "
+                + f'--description "{vm_description}"',
+            ] + register_script
+        else:
+            clone_spec = (
+                f"template={nixos_template_id} clone_mode={clone_mode} "
+                + f"storage={lvm_name}"
+            )
+            clone_script = [
+                # Clone the nixos template (waits for a free clone slot on the storage)
+                self.provisioning_scheduler.with_storage_slot(
+                    storage=lvm_name,
+                    command=(
+                        f"qm clone {nixos_template_id} {vm_id} --name {vm_name} "
+                        + f'--storage {lvm_name} --description "{vm_description}" --full 1'
+                    ),
+                ),
+            ]
 
         delete_script = [
             f"qm shutdown {vm_id}",
             f"qm wait {vm_id}",
             f"qm destroy {vm_id}",
+            clone_spec_cleanup(vm_id),
         ]
+        if clone_mode == CLONE_MODE_LINKED:
+            delete_script.append(f"rm -f {linked_clone_marker}")
+
+        # A kept VM is registered too (it may predate the registry), unless it
+        # gets promoted off the template
+        keep_script = []
+        if promote_to_storage is None:
+            keep_script = register_script
+
+        create_script, update_script = clone_spec_statements(
+            vm_id=vm_id,
+            clone_spec=clone_spec,
+            create_script=clone_script,
+            delete_script=delete_script,
+            keep_script=keep_script,
+        )
 
         create_vm_resource_name = (
             f"{self.resource_name_prefix}_{resource_name}_proxmoxCreateNixos"
@@ -276,7 +354,7 @@ class ProxmoxNixOS:
             connection=self.proxmox_base.pulumi_connection,
             create=create_script,
             delete=delete_script,
-            update=delete_script + create_script,
+            update=[update_script],
             use_sudo=True,
             opts=pulumi.ResourceOptions(
                 parent=save_key,
@@ -285,7 +363,68 @@ class ProxmoxNixOS:
         )
         self.resource_lookup[resource_name][create_vm_resource_name] = create_vm
 
-        # Start the VM and pause for 60 seconds
+        # Settings of the VM, changed in place (hot-plugged, or with a single
+        # reboot when proxmox can't)
+        vm_config = {
+            "name": vm_name,
+            "description": vm_description,
+            "kvm": kvm,
+            "ciuser": "ops",
+            "cpu": cpu_type,
+            "bios": bios,
+            "cores": cpu_cores,
+            "balloon": 0,
+            "memory": memory,
+            "machine": machine,
+            "onboot": start_on_boot,
+            # Set the SSH key
+            "sshkeys": self.proxmox_base.private_key.public_key_openssh.apply(
+                lambda key: quote(key.strip(), safe="")
+            ),
+            # Set cloud-init IP
+            "ipconfig0": f"ip={ip_v4}/{ip_v4_cidr},gw={ip_v4_gw}",
+        }
+        if extra_args is not None and len(extra_args) > 0:
+            vm_config["args"] = extra_args
+        if enable_agent:  # Enable qemu agent
+            vm_config["agent"] = 1
+
+        # qm set 501 --hostpci0 host=0000:10:00.0,pcie=1,rombar=0,pci=assign
+
+        # Add hardware passthrough (if applicable)
+        for idx, hardware in enumerate(hardware_passthrough):
+            # Set the PCI card (notice it's 0000:02:00 and NOT 0000:02:00.0)
+            # Serial Attached SCSI controller: Broadcom / LSI SAS2008 PCI-Express Fusion-MPT SAS-2 [Falcon] (rev 03)
+            # qm set 300 --hostpci0 host=0000:02:00,rombar=1
+            vm_config[f"hostpci{idx}"] = f"host={hardware}"
+
+        # NOTE: A linked clone's disk references its base volume, so leave
+        #       its scsi0 entry as `qm clone` wrote it
+        disk_options = None
+        if clone_mode == CLONE_MODE_FULL:
+            disk_options = {"ssd": "1"}
+
+        vm_settings_resource_name = (
+            f"{self.resource_name_prefix}_{resource_name}_NixosSettings"
+        )
+        vm_settings = VmSettings(
+            resource_name=vm_settings_resource_name,
+            vm_settings_args=VmSettingsArgs(
+                proxmox_connection_args=self.proxmox_base.proxmox_connection_args,
+                node_name=self.proxmox_base.node_name,
+                vm_id=vm_id,
+                config=vm_config,
+                disk="scsi0",
+                disk_size_in_gb=disk_space_in_gb,
+                disk_options=disk_options,
+            ),
+            opts=pulumi.ResourceOptions(
+                parent=create_vm,
+            ),
+        )
+        self.resource_lookup[resource_name][vm_settings_resource_name] = vm_settings
+
+        # Start the VM and wait until it (and its guest agent) is up
         start_vm_resource_name = (
             f"{self.resource_name_prefix}_{resource_name}_StartNixos"
         )
@@ -295,14 +434,40 @@ class ProxmoxNixOS:
                 proxmox_connection_args=self.proxmox_base.proxmox_connection_args,
                 node_name=self.proxmox_base.node_name,
                 vm_id=vm_id,
-                wait=60,
             ),
             opts=pulumi.ResourceOptions(
                 parent=create_vm,
+                depends_on=[vm_settings],
             ),
         )
         self.resource_lookup[resource_name][start_vm_resource_name] = start_vm
 
+        # Optionally turn the linked clone into a full one (moving the disk off
+        # the template's storage breaks the link), so the template can go away
+        if promote_to_storage is not None:
+            promote_resource_name = (
+                f"{self.resource_name_prefix}_{resource_name}_PromoteToFull"
+            )
+            promote_vm = RunCommandsOnHost(
+                resource_name=promote_resource_name,
+                connection=self.proxmox_base.pulumi_connection,
+                create=[
+                    self.provisioning_scheduler.with_storage_slot(
+                        storage=promote_to_storage,
+                        command=(
+                            f"qm disk move {vm_id} scsi0 {promote_to_storage} "
+                            + "--delete 1"
+                        ),
+                    ),
+                    f"rm -f {linked_clone_marker}",
+                ],
+                use_sudo=True,
+                opts=pulumi.ResourceOptions(
+                    parent=start_vm,
+                ),
+            )
+            self.resource_lookup[resource_name][promote_resource_name] = promote_vm
+
         ####################################
         # update the nix-channel on the VM
         ####################################
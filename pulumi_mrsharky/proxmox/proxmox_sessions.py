@@ -0,0 +1,149 @@
+import hashlib
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from proxmoxer import ProxmoxAPI
+
+# Proxmox auth tickets are valid for 2 hours, renew them a bit before that
+PROXMOX_TICKET_LIFETIME_IN_SECONDS = 2 * 60 * 60
+PROXMOX_TICKET_RENEW_MARGIN_IN_SECONDS = 10 * 60
+
+# (host, user, token name, credential fingerprint, verify ssl)
+SessionKey = Tuple[str, str, str, str, bool]
+
+
+class ProxmoxSessionRegistry:
+    """
+    Process-wide registry of authenticated proxmox API sessions, keyed on
+    host, user and a fingerprint of the credentials. Every dynamic provider
+    running in the same Python process shares the same instance (see
+    ProxmoxSessionRegistry.instance()), so only the first ProxmoxConnection to
+    a host pays for the TLS handshake and (with password auth) the login.
+
+    Password sessions are dropped once their ticket gets close to expiring,
+    token sessions never expire. Password tickets are shared through here as
+    well: the one from a ProxmoxAPI login is stored for ProxmoxAsyncClient,
+    which only logs in itself when there isn't a valid one.
+    """
+
+    _instance: Optional["ProxmoxSessionRegistry"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        ticket_lifetime_in_seconds: float = PROXMOX_TICKET_LIFETIME_IN_SECONDS
+        - PROXMOX_TICKET_RENEW_MARGIN_IN_SECONDS,
+    ):
+        self.ticket_lifetime_in_seconds = ticket_lifetime_in_seconds
+        self._sessions: Dict[SessionKey, Tuple[float, ProxmoxAPI]] = {}
+        self._tickets: Dict[SessionKey, Tuple[float, str, str]] = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def instance(cls) -> "ProxmoxSessionRegistry":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = ProxmoxSessionRegistry()
+            return cls._instance
+
+    @staticmethod
+    def make_key(
+        host: str,
+        user: str,
+        token_name: Optional[str] = None,
+        token_value: Optional[str] = None,
+        password: Optional[str] = None,
+        verify_ssl: bool = False,
+    ) -> SessionKey:
+        # Never keep the raw secret in the key, only a hash of it
+        if token_name is not None and token_value is not None:
+            fingerprint = (
+                "token:" + hashlib.sha256(token_value.encode("utf-8")).hexdigest()
+            )
+        elif password is not None:
+            fingerprint = "pass:" + hashlib.sha256(password.encode("utf-8")).hexdigest()
+        else:
+            raise SyntaxError("Must connect either via token or password.")
+        return (str(host), str(user), str(token_name), fingerprint, bool(verify_ssl))
+
+    def _expired(self, key: SessionKey, created: float) -> bool:
+        if key[3].startswith("token:"):
+            return False
+        return time.time() - created > self.ticket_lifetime_in_seconds
+
+    def api(
+        self,
+        host: str,
+        user: str,
+        token_name: Optional[str] = None,
+        token_value: Optional[str] = None,
+        password: Optional[str] = None,
+        verify_ssl: bool = False,
+    ) -> ProxmoxAPI:
+        key = self.make_key(host, user, token_name, token_value, password, verify_ssl)
+        with self._lock:
+            cached = self._sessions.get(key)
+            if cached is not None and not self._expired(key, cached[0]):
+                return cached[1]
+
+            # Token > Password
+            if token_name is not None and token_value is not None:
+                proxmox_api = ProxmoxAPI(
+                    host=host,
+                    user=user,
+                    token_name=token_name,
+                    token_value=token_value,
+                    verify_ssl=verify_ssl,
+                )
+            else:
+                proxmox_api = ProxmoxAPI(
+                    host=host,
+                    user=user,
+                    password=password,
+                    verify_ssl=verify_ssl,
+                )
+                self._store_ticket_of(key, proxmox_api)
+            self._sessions[key] = (time.time(), proxmox_api)
+            return proxmox_api
+
+    def ticket(self, key: SessionKey) -> Optional[Tuple[str, str]]:
+        """
+        (ticket, CSRF token) for a password login, if one is still valid.
+        """
+        with self._lock:
+            cached = self._tickets.get(key)
+            if cached is None or self._expired(key, cached[0]):
+                return None
+            return cached[1], cached[2]
+
+    def store_ticket(self, key: SessionKey, ticket: str, csrf_token: str) -> None:
+        with self._lock:
+            self._tickets[key] = (time.time(), ticket, csrf_token)
+        return
+
+    def drop_ticket(self, key: SessionKey, ticket: str) -> None:
+        # The server rejected it. Only drop it if nobody replaced it already
+        with self._lock:
+            cached = self._tickets.get(key)
+            if cached is not None and cached[1] == ticket:
+                del self._tickets[key]
+        return
+
+    def _store_ticket_of(self, key: SessionKey, proxmox_api: ProxmoxAPI) -> None:
+        # NOTE: proxmoxer keeps the ticket on the auth of its https backend,
+        #       skip sharing it if that ever moves
+        auth = getattr(getattr(proxmox_api, "_backend", None), "auth", None)
+        ticket = getattr(auth, "pve_auth_ticket", None)
+        csrf_token = getattr(auth, "csrf_prevention_token", None)
+        if ticket and csrf_token:
+            self.store_ticket(key, ticket, csrf_token)
+        return
+
+    def evict_host(self, host: str) -> None:
+        # Drop every session to a host (i.e. its credentials changed)
+        with self._lock:
+            for cache in (self._sessions, self._tickets):
+                for key in [key for key in cache if key[0] == str(host)]:
+                    del cache[key]
+        return
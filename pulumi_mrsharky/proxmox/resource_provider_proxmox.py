@@ -1,5 +1,6 @@
 from pulumi.dynamic import ResourceProvider
 
+from pulumi_mrsharky.proxmox.proxmox_async import ProxmoxAsyncClient, ProxmoxClient
 from pulumi_mrsharky.proxmox.proxmox_connection import (
     ProxmoxConnection,
     ProxmoxConnectionArgs,
@@ -32,3 +33,15 @@ class ResourceProviderProxmox(ResourceProvider):
 
         # Set up the connection
         return ProxmoxConnection(proxmox_connection_args=proxmox_connection_args)
+
+    def _create_proxmox_client(
+        self, proxmox_connection_args, max_concurrency: int = 8
+    ) -> ProxmoxClient:
+
+        # REST API only client, for fanning out many calls at once
+        return ProxmoxClient(
+            ProxmoxAsyncClient.from_connection_args(
+                proxmox_connection_args=proxmox_connection_args,
+                max_concurrency=max_concurrency,
+            )
+        )
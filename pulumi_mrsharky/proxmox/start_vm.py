@@ -13,19 +13,22 @@ class StartVmArgs(object):
     proxmox_connection_args: Input[ProxmoxConnectionArgs]
     node_name: Input[str]
     vm_id: Input[int]
-    wait: Input[int]
+    max_wait_in_seconds: Input[int]
+    wait_for_agent: Input[bool]
 
     def __init__(
         self,
         proxmox_connection_args: ProxmoxConnectionArgs,
         node_name: str,
         vm_id: int,
-        wait: int = 30,
+        max_wait_in_seconds: int = 300,
+        wait_for_agent: bool = True,
     ) -> None:
         self.proxmox_connection_args = proxmox_connection_args
         self.node_name = node_name
         self.vm_id = int(vm_id)
-        self.wait = int(wait)
+        self.max_wait_in_seconds = int(max_wait_in_seconds)
+        self.wait_for_agent = bool(wait_for_agent)
         return
 
 
@@ -39,7 +42,8 @@ class StartVmProvider(ResourceProviderProxmox):
             proxmox_connection_args=proxmox_connection_args,
             node_name=props.get("node_name"),
             vm_id=int(props.get("vm_id")),
-            wait=int(props.get("wait")),
+            max_wait_in_seconds=int(props.get("max_wait_in_seconds", 300)),
+            wait_for_agent=bool(props.get("wait_for_agent", True)),
         )
         return start_vm_args
 
@@ -51,17 +55,20 @@ class StartVmProvider(ResourceProviderProxmox):
             proxmox_connection_args=arguments.proxmox_connection_args
         )
 
-        # Start the VM
-        proxmox_connection.start_vm(
+        # Start the VM and wait until it's ready
+        time_to_ready = proxmox_connection.start_vm(
             node_name=arguments.node_name,
             vm_id=arguments.vm_id,
-            wait=arguments.wait,
+            max_wait_in_seconds=arguments.max_wait_in_seconds,
+            wait_for_agent=arguments.wait_for_agent,
         )
 
         results = {
             "node_name": arguments.node_name,
             "vm_id": arguments.vm_id,
-            "wait": arguments.wait,
+            "max_wait_in_seconds": arguments.max_wait_in_seconds,
+            "wait_for_agent": arguments.wait_for_agent,
+            "time_to_ready": time_to_ready,
         }
 
         return proxmox_connection.host, results
@@ -83,7 +90,9 @@ class StartVm(Resource):
     id: Output[str]
     node_name: Output[str]
     vm_id: Output[int]
-    wait: Output[int]
+    max_wait_in_seconds: Output[int]
+    wait_for_agent: Output[bool]
+    time_to_ready: Output[float]
 
     def __init__(
         self,
@@ -91,7 +100,7 @@ class StartVm(Resource):
         start_vm_args: StartVmArgs,
         opts: Optional[ResourceOptions] = None,
     ):
-        full_args = {**vars(start_vm_args)}
+        full_args = {"time_to_ready": None, **vars(start_vm_args)}
         super().__init__(
             provider=StartVmProvider(),
             name=resource_name,
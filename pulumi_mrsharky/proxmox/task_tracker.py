@@ -0,0 +1,101 @@
+import time
+from typing import Any, Dict, List, Optional
+
+from proxmoxer import ProxmoxAPI
+
+from pulumi_mrsharky.common.backoff import poll_with_backoff
+
+
+class ProxmoxTaskError(Exception):
+    def __init__(self, upid: str, exit_status: str, log: List[str]):
+        self.upid = upid
+        self.exit_status = exit_status
+        self.log = log
+        tail = "\n".join(log[-20:])
+        super().__init__(f"Task {upid} failed: {exit_status}\n{tail}")
+
+
+class ProxmoxTaskTracker:
+    """
+    Waits on proxmox tasks (the UPID returned by async API calls like
+    status/start, clone, migrate, vzdump, download-url, ...).
+
+    Polls /nodes/{node}/tasks/{upid}/status with a capped exponential backoff
+    (short tasks finish after a few quick polls, long ones don't hammer the
+    API), prints the task log as it grows, and raises ProxmoxTaskError if the
+    task didn't finish OK.
+    """
+
+    def __init__(
+        self,
+        proxmox_api: ProxmoxAPI,
+        initial_delay_in_seconds: float = 0.5,
+        max_delay_in_seconds: float = 5.0,
+    ):
+        self.proxmox_api = proxmox_api
+        self.initial_delay_in_seconds = initial_delay_in_seconds
+        self.max_delay_in_seconds = max_delay_in_seconds
+
+    @staticmethod
+    def node_of(upid: str) -> str:
+        # UPID:{node}:{pid}:{pstart}:{starttime}:{type}:{id}:{user}:
+        return upid.split(":")[1]
+
+    def status(self, upid: str, node_name: Optional[str] = None) -> Dict[str, Any]:
+        node_name = node_name or self.node_of(upid)
+        return self.proxmox_api(f"/nodes/{node_name}/tasks/{upid}/status").get()
+
+    def log(
+        self, upid: str, node_name: Optional[str] = None, start: int = 0
+    ) -> List[str]:
+        node_name = node_name or self.node_of(upid)
+        lines = self.proxmox_api(f"/nodes/{node_name}/tasks/{upid}/log").get(
+            start=start, limit=500
+        )
+        return [line.get("t", "") for line in sorted(lines, key=lambda x: x["n"])]
+
+    def wait(
+        self,
+        upid: str,
+        node_name: Optional[str] = None,
+        max_wait_in_seconds: float = 3600,
+        description: Optional[str] = None,
+        stream_log: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Block until the task stops. Returns its final status (with "duration"
+        added, in seconds).
+        """
+        node_name = node_name or self.node_of(upid)
+        description = description or f"task {upid}"
+        start_time = time.time()
+        log: List[str] = []
+
+        def read_new_log_lines():
+            new_lines = self.log(upid=upid, node_name=node_name, start=len(log))
+            # A still running task can report a trailing "no content" line
+            new_lines = [line for line in new_lines if line != "no content"]
+            log.extend(new_lines)
+            if stream_log:
+                for line in new_lines:
+                    print(f"[{description}] {line}")
+
+        def task_stopped() -> Optional[Dict[str, Any]]:
+            status = self.status(upid=upid, node_name=node_name)
+            read_new_log_lines()
+            return status if status.get("status") == "stopped" else None
+
+        status = poll_with_backoff(
+            check=task_stopped,
+            max_wait_in_seconds=max_wait_in_seconds,
+            description=description,
+            initial_delay_in_seconds=self.initial_delay_in_seconds,
+            max_delay_in_seconds=self.max_delay_in_seconds,
+        )
+
+        status["duration"] = time.time() - start_time
+        exit_status = status.get("exitstatus") or ""
+        if exit_status != "OK" and not exit_status.startswith("WARNINGS"):
+            raise ProxmoxTaskError(upid=upid, exit_status=exit_status, log=log)
+        print(f"{description} finished in {status['duration']:.1f} seconds")
+        return status
@@ -0,0 +1,111 @@
+import shlex
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from pulumi_mrsharky.proxmox.proxmox_connection import ProxmoxConnection
+
+# Keys only root@pam may set through the API
+ROOT_ONLY_KEYS = ("args",)
+ROOT_ONLY_KEY_PREFIXES = ("hostpci",)
+
+
+class VmConfig:
+    """
+    Collects config changes for a single VM and applies them all at once: one
+    PUT /nodes/{node}/qemu/{vmid}/config (one config lock, one round trip)
+    instead of a `qm set` per key.
+
+    The PUT carries the config `digest` the changes were based on, so if the
+    VM was modified in the meantime proxmox rejects it instead of silently
+    overwriting (optimistic concurrency).
+
+        proxmox_connection.vm_config(node_name, vm_id) \\
+            .set("cores", 4) \\
+            .set("memory", 8192) \\
+            .delete("scsi3") \\
+            .apply()
+    """
+
+    def __init__(
+        self,
+        proxmox_connection: "ProxmoxConnection",
+        node_name: str,
+        vm_id: int,
+        digest: Optional[str] = None,
+    ):
+        self.proxmox_connection = proxmox_connection
+        self.node_name = node_name
+        self.vm_id = vm_id
+        self.digest = digest
+        self.changes: Dict[str, Any] = {}
+        self.deletes: List[str] = []
+
+    def set(self, key: str, value: Any) -> "VmConfig":
+        if isinstance(value, bool):
+            value = 1 if value else 0
+        self.changes[key] = value
+        if key in self.deletes:
+            self.deletes.remove(key)
+        return self
+
+    def set_many(self, values: Dict[str, Any]) -> "VmConfig":
+        for key, value in values.items():
+            self.set(key, value)
+        return self
+
+    def delete(self, key: str) -> "VmConfig":
+        self.changes.pop(key, None)
+        if key not in self.deletes:
+            self.deletes.append(key)
+        return self
+
+    def is_empty(self) -> bool:
+        return len(self.changes) == 0 and len(self.deletes) == 0
+
+    @staticmethod
+    def is_root_only(key: str, value: Any) -> bool:
+        # Raw host paths (i.e. /dev/disk/by-id/... passthrough), extra qemu args
+        # and PCI passthrough can only be set by root@pam through the API
+        return (
+            key in ROOT_ONLY_KEYS
+            or key.startswith(ROOT_ONLY_KEY_PREFIXES)
+            or str(value).startswith("/")
+        )
+
+    def _needs_root(self) -> bool:
+        return any(self.is_root_only(key, value) for key, value in self.changes.items())
+
+    def apply(self) -> Dict[str, Any]:
+        """
+        Apply all the collected changes. Returns what was sent (empty if there
+        was nothing to do).
+        """
+        if self.is_empty():
+            return {}
+
+        connection = self.proxmox_connection
+        path = f"/nodes/{self.node_name}/qemu/{self.vm_id}/config"
+        digest = self.digest
+        if digest is None:
+            digest = connection.proxmox_api(path).get().get("digest")
+
+        params: Dict[str, Any] = dict(self.changes)
+        if len(self.deletes) > 0:
+            params["delete"] = ",".join(self.deletes)
+        if digest is not None:
+            params["digest"] = digest
+
+        if self._needs_root():
+            # Same thing, as a single `qm set` over ssh (qm only runs as root)
+            arguments = " ".join(
+                f"--{key} {shlex.quote(str(value))}" for key, value in params.items()
+            )
+            connection._run_ssh_command(f"sudo qm set {self.vm_id} {arguments}")
+        else:
+            connection.proxmox_api(path).put(**params)
+
+        connection.inventory.invalidate_vm(node_name=self.node_name, vm_id=self.vm_id)
+        self.digest = None
+        self.changes = {}
+        self.deletes = []
+        return params
@@ -0,0 +1,365 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+import pulumi
+from pulumi import Input, Output, ResourceOptions
+from pulumi.dynamic import CreateResult, DiffResult, Resource, UpdateResult
+from pulumi.runtime.rpc import UNKNOWN
+
+from pulumi_mrsharky.proxmox.proxmox_connection import (
+    ProxmoxConnection,
+    ProxmoxConnectionArgs,
+)
+from pulumi_mrsharky.proxmox.resource_provider_proxmox import ResourceProviderProxmox
+from pulumi_mrsharky.proxmox.vm_config import VmConfig
+
+# Changing one of these means a different VM
+VM_SETTINGS_REPLACE_KEYS = ("node_name", "vm_id")
+
+# Inputs whose change needs an update even when the VM already matches them
+VM_SETTINGS_UPDATE_KEYS = (
+    "config",
+    "disk",
+    "disk_size_in_gb",
+    "disk_options",
+    "restart_if_needed",
+)
+
+SIZE_UNITS_IN_GB = {"K": 1 / (1024 * 1024), "M": 1 / 1024, "G": 1, "T": 1024}
+
+
+def _clean_value(value: Any) -> Any:
+    # Numbers come back from the engine as floats (8192 -> 8192.0)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _parse_drive(value: str) -> Tuple[str, Dict[str, str]]:
+    # "local-lvm:vm-501-disk-0,size=32G,ssd=1" -> volume, options
+    volume, *options = str(value).split(",")
+    return volume, dict(option.split("=", 1) for option in options if "=" in option)
+
+
+def _format_drive(volume: str, options: Dict[str, str]) -> str:
+    return ",".join([volume] + [f"{key}={value}" for key, value in options.items()])
+
+
+def _size_in_gb(size: str) -> float:
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)", str(size).strip())
+    if match is None:
+        raise ValueError(f"Can't parse disk size: {size}")
+    number, unit = match.groups()
+    if unit == "":
+        # Plain bytes
+        return float(number) / (1024 * 1024 * 1024)
+    return float(number) * SIZE_UNITS_IN_GB[unit]
+
+
+@pulumi.input_type
+class VmSettingsArgs(object):
+    proxmox_connection_args: Input[ProxmoxConnectionArgs]
+    node_name: Input[str]
+    vm_id: Input[int]
+    config: Input[Dict[str, Any]]
+    disk: Input[str]
+    disk_size_in_gb: Optional[Input[int]]
+    disk_options: Optional[Input[Dict[str, str]]]
+    restart_if_needed: Input[bool]
+    max_wait_in_seconds: Input[int]
+
+    def __init__(
+        self,
+        proxmox_connection_args: ProxmoxConnectionArgs,
+        node_name: str,
+        vm_id: int,
+        config: Dict[str, Any],
+        disk: str = "scsi0",
+        disk_size_in_gb: Optional[int] = None,
+        disk_options: Optional[Dict[str, str]] = None,
+        restart_if_needed: bool = True,
+        max_wait_in_seconds: int = 300,
+    ) -> None:
+        """
+        config: the VM config keys to manage (as in /nodes/{node}/qemu/{vmid}/config,
+            i.e. {"cores": 4, "memory": 8192}). Keys not given are left alone,
+            keys dropped from a previous config are removed from the VM.
+        disk_size_in_gb: grow `disk` to (at least) this size.
+        disk_options: options to set on `disk`, i.e. {"ssd": "1"}.
+        restart_if_needed: reboot a running VM (once) if some of the changes
+            can't be hot-plugged.
+        """
+        self.proxmox_connection_args = proxmox_connection_args
+        self.node_name = node_name
+        self.vm_id = int(vm_id)
+        self.config = config
+        self.disk = disk
+        self.disk_size_in_gb = disk_size_in_gb
+        self.disk_options = disk_options
+        self.restart_if_needed = bool(restart_if_needed)
+        self.max_wait_in_seconds = int(max_wait_in_seconds)
+        return
+
+
+class VmSettingsProvider(ResourceProviderProxmox):
+    """
+    Keeps the settings of an existing VM in sync with the desired config.
+
+    The diff is against the VM's live /config: only the keys that differ are
+    changed, in one PUT. Changes proxmox can hot-plug take effect right away,
+    the rest are left pending by proxmox and applied with a single reboot.
+    Changing the node or VM id replaces the resource. The VM itself belongs to
+    whatever cloned it, so deleting this leaves the VM alone.
+    """
+
+    def _process_inputs(self, props) -> VmSettingsArgs:
+        # Proxmox connection args
+        proxmox_connection_args = super()._process_inputs(props)
+
+        arguments = VmSettingsArgs(
+            proxmox_connection_args=proxmox_connection_args,
+            node_name=props.get("node_name"),
+            vm_id=int(props.get("vm_id")),
+            config={
+                key: _clean_value(value)
+                for key, value in (props.get("config") or {}).items()
+            },
+            disk=props.get("disk", "scsi0"),
+            disk_size_in_gb=_clean_value(props.get("disk_size_in_gb")),
+            disk_options=props.get("disk_options"),
+            restart_if_needed=bool(props.get("restart_if_needed", True)),
+            max_wait_in_seconds=int(props.get("max_wait_in_seconds", 300)),
+        )
+        return arguments
+
+    @staticmethod
+    def _normalize(key: str, value: Any) -> str:
+        if isinstance(value, bool):
+            value = 1 if value else 0
+        value = str(value).strip()
+        if key == "sshkeys":
+            # Stored url-encoded
+            value = unquote(value).strip()
+        return value
+
+    def _plan(
+        self,
+        proxmox_connection: ProxmoxConnection,
+        arguments: VmSettingsArgs,
+        old_config: Dict[str, Any],
+    ) -> Tuple[VmConfig, VmConfig, Optional[str]]:
+        """
+        What has to change on the VM: the config changes (split into the ones
+        the API token can make and the ones that need root), and the size to
+        grow the disk to (None if it's big enough).
+        """
+        current = proxmox_connection.proxmox_api(
+            f"/nodes/{arguments.node_name}/qemu/{arguments.vm_id}/config"
+        ).get()
+        api_changes = proxmox_connection.vm_config(
+            node_name=arguments.node_name,
+            vm_id=arguments.vm_id,
+            digest=current.get("digest"),
+        )
+        root_changes = proxmox_connection.vm_config(
+            node_name=arguments.node_name, vm_id=arguments.vm_id
+        )
+
+        for key, value in arguments.config.items():
+            if self._normalize(key, current.get(key, "")) == self._normalize(
+                key, value
+            ):
+                continue
+            if VmConfig.is_root_only(key, value):
+                root_changes.set(key, value)
+            else:
+                api_changes.set(key, value)
+
+        # Keys we used to manage, but don't anymore
+        for key in old_config:
+            if key not in arguments.config and key in current:
+                if VmConfig.is_root_only(key, ""):
+                    root_changes.delete(key)
+                else:
+                    api_changes.delete(key)
+
+        resize = None
+        if arguments.disk in current:
+            volume, options = _parse_drive(current[arguments.disk])
+            wanted = {**options, **(arguments.disk_options or {})}
+            if wanted != options:
+                api_changes.set(arguments.disk, _format_drive(volume, wanted))
+
+            if arguments.disk_size_in_gb is not None:
+                current_size = _size_in_gb(options.get("size", "0"))
+                if current_size < arguments.disk_size_in_gb:
+                    resize = f"{arguments.disk_size_in_gb}G"
+                elif current_size > arguments.disk_size_in_gb:
+                    print(
+                        f"VM {arguments.vm_id} {arguments.disk} is {options['size']}, "
+                        + f"can't shrink it to {arguments.disk_size_in_gb}G"
+                    )
+        elif arguments.disk_size_in_gb is not None or arguments.disk_options:
+            raise Exception(f"VM {arguments.vm_id} has no {arguments.disk} disk")
+
+        return api_changes, root_changes, resize
+
+    def _pending_restart(
+        self, proxmox_connection: ProxmoxConnection, arguments: VmSettingsArgs
+    ) -> List[str]:
+        # Keys changed in the config that the running VM hasn't picked up
+        pending = proxmox_connection.proxmox_api(
+            f"/nodes/{arguments.node_name}/qemu/{arguments.vm_id}/pending"
+        ).get()
+        return sorted(
+            entry["key"] for entry in pending if "pending" in entry or "delete" in entry
+        )
+
+    def _apply(self, props, old_config: Dict[str, Any]):
+        arguments = self._process_inputs(props)
+
+        # Set up the connection
+        proxmox_connection = self._create_proxmox_connection(
+            proxmox_connection_args=arguments.proxmox_connection_args
+        )
+        if not proxmox_connection.check_vm_exists(
+            node_name=arguments.node_name, vm_id=arguments.vm_id
+        ):
+            raise Exception(
+                f"VM {arguments.vm_id} doesn't exist on the proxmox cluster"
+            )
+
+        api_changes, root_changes, resize = self._plan(
+            proxmox_connection=proxmox_connection,
+            arguments=arguments,
+            old_config=old_config,
+        )
+        changed_keys = sorted(
+            set(api_changes.changes)
+            | set(api_changes.deletes)
+            | set(root_changes.changes)
+            | set(root_changes.deletes)
+        )
+        api_changes.apply()
+        root_changes.apply()
+
+        if resize is not None:
+            upid = proxmox_connection.proxmox_api(
+                f"/nodes/{arguments.node_name}/qemu/{arguments.vm_id}/resize"
+            ).put(disk=arguments.disk, size=resize)
+            # Newer proxmox versions run the resize as a task
+            if isinstance(upid, str) and upid.startswith("UPID:"):
+                proxmox_connection.wait_for_task(
+                    node_name=arguments.node_name,
+                    upid=upid,
+                    max_wait_in_seconds=arguments.max_wait_in_seconds,
+                    description=f"resize {arguments.vm_id} {arguments.disk}",
+                )
+            changed_keys.append(arguments.disk)
+
+        # Whatever couldn't be hot-plugged takes one reboot
+        restarted = False
+        pending = self._pending_restart(proxmox_connection, arguments)
+        if len(pending) > 0:
+            status = proxmox_connection.get_vm_status(
+                node_name=arguments.node_name, vm_id=arguments.vm_id
+            )
+            if status == "running" and arguments.restart_if_needed:
+                print(f"VM {arguments.vm_id} needs a reboot to apply: {pending}")
+                proxmox_connection.run_task(
+                    node_name=arguments.node_name,
+                    path=f"/nodes/{arguments.node_name}/qemu/{arguments.vm_id}/status/reboot",
+                    description=f"reboot {arguments.vm_id}",
+                    max_wait_in_seconds=arguments.max_wait_in_seconds,
+                )
+                proxmox_connection.inventory.invalidate_vm(
+                    node_name=arguments.node_name, vm_id=arguments.vm_id
+                )
+                restarted = True
+
+        results = {
+            "node_name": arguments.node_name,
+            "vm_id": arguments.vm_id,
+            "config": arguments.config,
+            "disk": arguments.disk,
+            "disk_size_in_gb": arguments.disk_size_in_gb,
+            "disk_options": arguments.disk_options,
+            "restart_if_needed": arguments.restart_if_needed,
+            "max_wait_in_seconds": arguments.max_wait_in_seconds,
+            "changed_keys": changed_keys,
+            "restarted": restarted,
+        }
+        return proxmox_connection.host, results
+
+    def create(self, props) -> CreateResult:
+        id, results = self._apply(props, old_config={})
+        return CreateResult(id_=id, outs=results)
+
+    def diff(self, id: str, old_props: Any, new_props: Any) -> DiffResult:
+        replaces = [
+            key
+            for key in VM_SETTINGS_REPLACE_KEYS
+            if str(old_props.get(key)) != str(new_props.get(key))
+        ]
+        if len(replaces) > 0:
+            return DiffResult(changes=True, replaces=replaces)
+
+        if any(
+            old_props.get(key) != new_props.get(key) for key in VM_SETTINGS_UPDATE_KEYS
+        ):
+            return DiffResult(changes=True)
+
+        # Same inputs, check whether the VM drifted from them
+        config = new_props.get("config") or {}
+        if any(value == UNKNOWN for value in config.values()):
+            return DiffResult(changes=True)
+        arguments = self._process_inputs(new_props)
+        proxmox_connection = self._create_proxmox_connection(
+            proxmox_connection_args=arguments.proxmox_connection_args
+        )
+        if not proxmox_connection.check_vm_exists(
+            node_name=arguments.node_name, vm_id=arguments.vm_id
+        ):
+            return DiffResult(changes=True)
+        api_changes, root_changes, resize = self._plan(
+            proxmox_connection=proxmox_connection,
+            arguments=arguments,
+            old_config=old_props.get("config") or {},
+        )
+        changes = not (api_changes.is_empty() and root_changes.is_empty())
+        return DiffResult(changes=changes or resize is not None)
+
+    def update(self, id: str, old_props: Any, new_props: Any) -> UpdateResult:
+        _, results = self._apply(new_props, old_config=old_props.get("config") or {})
+        return UpdateResult(outs=results)
+
+    def delete(self, id: str, props: Any) -> None:
+        return
+
+
+class VmSettings(Resource):
+    id: Output[str]
+    node_name: Output[str]
+    vm_id: Output[int]
+    config: Output[Dict[str, Any]]
+    changed_keys: Output[List[str]]
+    restarted: Output[bool]
+
+    def __init__(
+        self,
+        resource_name,
+        vm_settings_args: VmSettingsArgs,
+        opts: Optional[ResourceOptions] = None,
+    ):
+        full_args = {
+            "changed_keys": None,
+            "restarted": None,
+            **vars(vm_settings_args),
+        }
+        super().__init__(
+            provider=VmSettingsProvider(),
+            name=resource_name,
+            props=full_args,
+            opts=opts,
+        )
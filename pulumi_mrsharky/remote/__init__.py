@@ -1,4 +1,8 @@
 from .reboot_remote_host import Reboot, RebootArgs  # noqa: F401
 from .run_commands_on_host import RunCommandsOnHost  # noqa: F401
 from .save_file_on_remote_host import SaveFileOnRemoteHost  # noqa: F401
+from .sync_directory_to_remote_host import (  # noqa: F401
+    SyncDirectoryToRemoteHost,
+    SyncDirectoryToRemoteHostArgs,
+)
 from .wait_for_host import WaitForHost, WaitForHostArgs  # noqa: F401
@@ -14,6 +14,8 @@ class RebootArgs(object):
     password: Optional[Input[str]]
     private_key: Optional[Input[str]]
     use_sudo: Optional[Input[bool]]
+    force: Optional[Input[bool]]
+    max_wait_for_shutdown_in_seconds: Optional[Input[int]]
 
     def __init__(
         self,
@@ -24,6 +26,8 @@ class RebootArgs(object):
         password: Optional[Union[Output[str], str]] = None,
         private_key: Optional[Union[Output[str], str]] = None,
         use_sudo: bool = False,
+        force: bool = True,
+        max_wait_for_shutdown_in_seconds: int = 60,
     ) -> None:
         self.host = host
         self.port = port
@@ -32,6 +36,8 @@ class RebootArgs(object):
         self.private_key = private_key
         self.max_wait_for_reboot_in_seconds = max_wait_for_reboot_in_seconds
         self.use_sudo = use_sudo
+        self.force = force
+        self.max_wait_for_shutdown_in_seconds = max_wait_for_shutdown_in_seconds
         return
 
 
@@ -48,10 +54,14 @@ class RebootProvider(ResourceProvider):
             props.get("max_wait_for_reboot_in_seconds", 300)
         )
         use_sudo = bool(props.get("use_sudo"))
+        force = bool(props.get("force", True))
+        max_wait_for_shutdown_in_seconds = int(
+            props.get("max_wait_for_shutdown_in_seconds", 60)
+        )
 
-        # Run the reboot function that waits
+        # Reboot and wait for the host to come back with a new boot_id
         print("running reboot function")
-        finish_time = RemoteMethods.reboot_function(
+        finish_time, boot_id = RemoteMethods.reboot_and_wait(
             host=host,
             user=user,
             port=port,
@@ -59,13 +69,18 @@ class RebootProvider(ResourceProvider):
             private_key=private_key,
             max_wait_for_reboot_in_seconds=max_wait_for_reboot_in_seconds,
             use_sudo=use_sudo,
+            force=force,
+            max_wait_for_shutdown_in_seconds=max_wait_for_shutdown_in_seconds,
         )
 
-        return CreateResult(id_=host, outs={"finish_time": finish_time})
+        return CreateResult(
+            id_=host, outs={"finish_time": finish_time, "boot_id": boot_id}
+        )
 
 
 class Reboot(Resource):
     finish_time: Output[float]
+    boot_id: Output[str]
 
     def __init__(
         self,
@@ -73,5 +88,5 @@ class Reboot(Resource):
         reboot_args: RebootArgs,
         opts: Optional[ResourceOptions] = None,
     ):
-        full_args = {"finish_time": None, **vars(reboot_args)}
+        full_args = {"finish_time": None, "boot_id": None, **vars(reboot_args)}
         super().__init__(RebootProvider(), resource_name, full_args, opts)
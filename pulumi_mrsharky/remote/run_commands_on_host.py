@@ -84,22 +84,19 @@ class RunCommandsOnHost(pulumi.ComponentResource):
 
         return
 
+    @staticmethod
     def _generate_outputs_from_string_list(
-        self,
         statements: List[str] | List[Output[str]],
         use_sudo: bool = False,
-    ):
-        combined_statements = pulumi.Output.all(x="").apply(lambda args: f"{args['x']}")
+    ) -> Output[str]:
         sudo = ""
         if use_sudo:
             sudo = "sudo"
-        for idx, statement in enumerate(statements):
-            combined_statements = pulumi.Output.all(
-                x=combined_statements,
-                y=statement,
-            ).apply(lambda args: f"{args['x']} {sudo} {args['y']}")
-            if idx < len(statements) - 1:
-                combined_statements = pulumi.Output.all(
-                    x=combined_statements, y=" && "
-                ).apply(lambda args: f"{args['x']} {args['y']}")
-        return combined_statements
+
+        # Resolve every statement in one go and join them (rather than chaining
+        # an Output.apply per statement, which builds an N-deep await chain)
+        # NOTE: The spacing matches the previous output exactly, so existing
+        #       stacks don't see a diff on their commands
+        return pulumi.Output.all(*statements).apply(
+            lambda parts: "  && ".join(f" {sudo} {part}" for part in parts)
+        )
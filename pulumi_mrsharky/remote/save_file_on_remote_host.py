@@ -1,3 +1,5 @@
+import base64
+import hashlib
 import os
 import re
 from typing import Any, Mapping, Optional, Sequence, Union
@@ -7,33 +9,36 @@ import pulumi_command
 from pulumi import Output
 from pulumi_command.remote import ConnectionArgs
 
+# "inline": contents are echo'd as part of the command (small text files)
+# "stdin": contents are streamed (base64 encoded) over the command's stdin
+TRANSFER_MODE_INLINE = "inline"
+TRANSFER_MODE_STDIN = "stdin"
+
+# Above this size (of the escaped contents, as they appear in the command),
+# default to streaming. Well below the 128 KiB limit on a single shell argument,
+# which leaves room for the rest of the command
+STREAMING_THRESHOLD_IN_BYTES = 64 * 1024
+
 
 class SaveFileOnRemoteHost(pulumi.ComponentResource):
     def __init__(
         self,
         resource_name: str,
         connection: pulumi.Input[pulumi.InputType[ConnectionArgs]],
-        file_contents: Union[str, Output],
+        file_contents: Union[str, bytes, Output],
         file_location: Union[str, Output],
         file_permission: str = "644",
         use_sudo: bool = False,
         environment: Optional[pulumi.Input[Mapping[str, pulumi.Input[str]]]] = None,
         stdin: Optional[pulumi.Input[str]] = None,
         triggers: Optional[pulumi.Input[Sequence[Any]]] = None,
+        transfer_mode: Optional[str] = None,
         opts: Optional[pulumi.ResourceOptions] = None,
     ) -> None:
         # Check the file_permissions are valid
         pattern = r"^[012467]{3}$"
         assert bool(re.match(pattern, file_permission))
 
-        # Fix issues with single quotes in the file_contents
-        # NOTE: This was a weird one to solve:
-        # https://stackoverflow.com/questions/25608503/using-single-quotes-with-echo-in-bash
-        # Basically, you need to surround \' with '\'' quotes. But, you need to
-        # double escape it too.
-        if isinstance(file_contents, str):
-            file_contents = file_contents.replace("'", "'\\''")
-
         # Get the folder the file is in (to create the directory if not present)
         folder_path = os.path.dirname(file_location)
 
@@ -42,26 +47,75 @@ class SaveFileOnRemoteHost(pulumi.ComponentResource):
         if use_sudo:
             sudo = "sudo"
 
-        # Generate the Create/Delete Statement
-        # If the file_contents happens to be a Pulumi Output, we have to process it
-        # via an .apply(). So, do it just in case
-        create = pulumi.Output.all(x=file_contents).apply(
-            lambda args: (
-                f"{sudo} mkdir -p {folder_path} && "
-                f"{sudo} rm -f {file_location} && "
-                f"echo '{args['x']}' | {sudo} tee -a {file_location} && "
-                f"{sudo} chmod {file_permission} {file_location}"
-            )
+        if transfer_mode not in (None, TRANSFER_MODE_INLINE, TRANSFER_MODE_STDIN):
+            raise ValueError(f"Invalid transfer_mode: {transfer_mode}")
+        if transfer_mode == TRANSFER_MODE_STDIN and stdin is not None:
+            raise ValueError("transfer_mode 'stdin' can't be combined with stdin")
+
+        def pick_transfer_mode(contents: Union[str, bytes]) -> str:
+            if transfer_mode == TRANSFER_MODE_INLINE and isinstance(contents, bytes):
+                raise ValueError("Binary file_contents need transfer_mode 'stdin'")
+            if transfer_mode is not None:
+                return transfer_mode
+            # Binary contents can't go through echo, and large contents would
+            # blow past the remote ARG_MAX (and are slow to escape)
+            if stdin is None and (
+                isinstance(contents, bytes)
+                or len(self._escape_single_quotes(contents).encode("utf-8"))
+                > STREAMING_THRESHOLD_IN_BYTES
+            ):
+                return TRANSFER_MODE_STDIN
+            return TRANSFER_MODE_INLINE
+
+        file_contents = pulumi.Output.from_input(file_contents)
+
+        # Hash of what will end up on disk. The remote side compares against it
+        # and skips the write if it matches.
+        sha256 = file_contents.apply(
+            lambda contents: hashlib.sha256(self._file_bytes(contents)).hexdigest()
         )
-        delete = f"{sudo} rm -f {file_location}"
-        _ = pulumi.Output.all(x=file_contents).apply(
-            lambda args: (
+
+        def create_statement(contents: Union[str, bytes], sha: str) -> str:
+            if pick_transfer_mode(contents) == TRANSFER_MODE_STDIN:
+                # Contents come in (base64 encoded) over stdin, written to a
+                # temp file and moved into place
+                write_file = (
+                    f"base64 -d | {sudo} tee {file_location}.partial > /dev/null && "
+                    f"{sudo} mv -f {file_location}.partial {file_location}"
+                )
+            else:
+                write_file = (
+                    f"{sudo} rm -f {file_location} && "
+                    f"echo '{self._escape_single_quotes(contents)}' | "
+                    f"{sudo} tee -a {file_location} > /dev/null"
+                )
+            return (
                 f"{sudo} mkdir -p {folder_path} && "
-                f"{sudo} rm -f {file_location} && "
-                f"echo '{args['x']}' | {sudo} tee -a {file_location} && "
+                f"if echo '{sha}  {file_location}' | "
+                f"{sudo} sha256sum --check --status 2>/dev/null; then "
+                f"echo 'unchanged: {file_location}'; "
+                "else "
+                f"{write_file} && "
+                f"echo 'written: {file_location}'; "
+                "fi && "
                 f"{sudo} chmod {file_permission} {file_location}"
             )
+
+        def create_stdin(contents: Union[str, bytes], user_stdin: Optional[str]):
+            if pick_transfer_mode(contents) == TRANSFER_MODE_STDIN:
+                return base64.b64encode(self._file_bytes(contents)).decode("ascii")
+            return user_stdin
+
+        # Generate the Create/Delete Statement
+        # If the file_contents happens to be a Pulumi Output, we have to process it
+        # via an .apply(). So, do it just in case
+        create = pulumi.Output.all(x=file_contents, sha256=sha256).apply(
+            lambda args: create_statement(args["x"], args["sha256"])
+        )
+        command_stdin = pulumi.Output.all(x=file_contents, stdin=stdin).apply(
+            lambda args: create_stdin(args["x"], args["stdin"])
         )
+        delete = f"{sudo} rm -f {file_location}"
 
         remote_cmd = pulumi_command.remote.Command(
             resource_name=f"{resource_name}-remote-command",
@@ -70,7 +124,7 @@ class SaveFileOnRemoteHost(pulumi.ComponentResource):
             delete=delete,
             # update=update,
             environment=environment,
-            stdin=stdin,
+            stdin=command_stdin,
             triggers=triggers,
             opts=opts,
         )
@@ -86,6 +140,7 @@ class SaveFileOnRemoteHost(pulumi.ComponentResource):
                 "stderr": remote_cmd.stderr,
                 "triggers": remote_cmd.triggers,
                 "update": remote_cmd.update,
+                "sha256": sha256,
             }
         )
 
@@ -102,7 +157,24 @@ class SaveFileOnRemoteHost(pulumi.ComponentResource):
                 "stderr": remote_cmd.stderr,
                 "triggers": remote_cmd.triggers,
                 "update": remote_cmd.update,
+                "sha256": sha256,
             },
             opts=opts,
         )
         return
+
+    @staticmethod
+    def _file_bytes(contents: Union[str, bytes]) -> bytes:
+        # Text files get the trailing newline that echo would add
+        if isinstance(contents, bytes):
+            return contents
+        return f"{contents}\n".encode("utf-8")
+
+    @staticmethod
+    def _escape_single_quotes(contents: str) -> str:
+        # Fix issues with single quotes in the file_contents
+        # NOTE: This was a weird one to solve:
+        # https://stackoverflow.com/questions/25608503/using-single-quotes-with-echo-in-bash
+        # Basically, you need to surround \' with '\'' quotes. But, you need to
+        # double escape it too.
+        return contents.replace("'", "'\\''")
@@ -0,0 +1,189 @@
+import hashlib
+import io
+import shlex
+import tarfile
+from pathlib import Path
+from typing import Any, List, Optional, Tuple, Union
+
+from pulumi import Input, Output, ResourceOptions
+from pulumi.dynamic import CreateResult, Resource, ResourceProvider, UpdateResult
+
+from pulumi_mrsharky.common.remote import RemoteMethods
+
+# Marker written next to the synced files, holds the content hash of the tree
+SYNC_HASH_FILENAME = ".pulumi-sync.sha256"
+
+
+def directory_content_hash(local_dir: str) -> Tuple[str, List[str]]:
+    """
+    Merkle style hash of a directory: sha256 of every file, then a sha256 over
+    the sorted (relative path, file hash) pairs. Returns (hash, relative paths).
+    """
+    base_path = Path(local_dir)
+    relative_paths = sorted(
+        str(path.relative_to(base_path))
+        for path in base_path.rglob("*")
+        if path.is_file()
+    )
+    tree_hash = hashlib.sha256()
+    for relative_path in relative_paths:
+        file_hash = hashlib.sha256((base_path / relative_path).read_bytes())
+        tree_hash.update(f"{relative_path}\0{file_hash.hexdigest()}\n".encode())
+    return tree_hash.hexdigest(), relative_paths
+
+
+def build_tar_gz(local_dir: str, relative_paths: List[str]) -> bytes:
+    # Deterministic archive: sorted entries, fixed owner/mode/mtime
+    base_path = Path(local_dir)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for relative_path in relative_paths:
+            contents = (base_path / relative_path).read_bytes()
+            tar_info = tarfile.TarInfo(name=relative_path)
+            tar_info.size = len(contents)
+            tar_info.mode = 0o644
+            tar_info.mtime = 0
+            tar_info.uid = tar_info.gid = 0
+            tar_info.uname = tar_info.gname = "root"
+            tar.addfile(tar_info, io.BytesIO(contents))
+    return buffer.getvalue()
+
+
+class SyncDirectoryToRemoteHostArgs(object):
+    host: Input[str]
+    user: Input[str]
+    port: Input[int]
+    password: Optional[Input[str]]
+    private_key: Optional[Input[str]]
+    local_dir: Input[str]
+    remote_dir: Input[str]
+    use_sudo: Input[bool]
+    content_hash: Input[str]
+
+    def __init__(
+        self,
+        host: Union[Input[str], str],
+        user: Union[Input[str], str],
+        local_dir: str,
+        remote_dir: str,
+        port: Union[Input[int], int] = 22,
+        password: Optional[Union[Input[str], str]] = None,
+        private_key: Optional[Union[Input[str], str]] = None,
+        use_sudo: bool = False,
+    ) -> None:
+        self.host = host
+        self.user = user
+        self.port = port
+        self.password = password
+        self.private_key = private_key
+        self.local_dir = str(local_dir)
+        self.remote_dir = str(remote_dir)
+        self.use_sudo = use_sudo
+
+        # Computed locally when the program runs, so an unchanged tree means
+        # unchanged inputs (and Pulumi never calls the provider)
+        self.content_hash, _ = directory_content_hash(self.local_dir)
+        return
+
+
+class SyncDirectoryToRemoteHostProvider(ResourceProvider):
+    def _ssh(self, props):
+        return RemoteMethods.ssh_session(
+            host=props.get("host"),
+            user=props.get("user"),
+            port=int(props.get("port", 22)),
+            password=props.get("password"),
+            private_key=props.get("private_key"),
+        )
+
+    @staticmethod
+    def _run(ssh, command: str, stdin_bytes: Optional[bytes] = None) -> str:
+        stdin, stdout, stderr = ssh.exec_command(command)
+        if stdin_bytes is not None:
+            chunk_size = 1024 * 1024
+            for offset in range(0, len(stdin_bytes), chunk_size):
+                end = offset + chunk_size
+                stdin.write(stdin_bytes[offset:end])
+            stdin.flush()
+            stdin.channel.shutdown_write()
+        output = stdout.read().decode("utf-8")
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            error = stderr.read().decode("utf-8")
+            raise Exception(f"Command failed ({exit_status}): {command}\n{error}")
+        return output
+
+    def _sync(self, props) -> dict:
+        local_dir = props.get("local_dir")
+        remote_dir = props.get("remote_dir").rstrip("/")
+        sudo = "sudo " if props.get("use_sudo") else ""
+        content_hash, relative_paths = directory_content_hash(local_dir)
+        hash_file = shlex.quote(f"{remote_dir}/{SYNC_HASH_FILENAME}")
+
+        with self._ssh(props) as ssh:
+            # Nothing to do if the remote side already has this exact tree
+            remote_hash = self._run(ssh, f"{sudo}cat {hash_file} 2>/dev/null || true")
+            if remote_hash.strip() == content_hash:
+                print(f"{remote_dir} already up to date ({content_hash})")
+            else:
+                # Unpack into a staging dir on the same filesystem, then rename each
+                # file into place so every file is swapped atomically
+                # NOTE: The whole script runs under a single sudo, the staging dir
+                #       it creates is only accessible to root
+                quoted_dir = shlex.quote(remote_dir)
+                script = (
+                    "set -e; "
+                    f"mkdir -p {quoted_dir}; "
+                    f"staging=$(mktemp -d {quoted_dir}/.sync.XXXXXX); "
+                    'tar -xzf - -C "$staging"; '
+                    'cd "$staging"; '
+                    f"find . -mindepth 1 -type d -exec mkdir -p {quoted_dir}/{{}} \\; ; "
+                    f"find . -type f -exec mv -f {{}} {quoted_dir}/{{}} \\; ; "
+                    'cd /; rm -rf "$staging"; '
+                    f"echo {content_hash} > {hash_file}"
+                )
+                command = f"{sudo}sh -c {shlex.quote(script)}"
+                archive = build_tar_gz(local_dir, relative_paths)
+                print(f"Syncing {len(relative_paths)} files to {remote_dir}")
+                self._run(ssh, command, stdin_bytes=archive)
+
+        return {
+            **props,
+            "content_hash": content_hash,
+            "files": relative_paths,
+        }
+
+    def create(self, props: Any) -> CreateResult:
+        outs = self._sync(props)
+        return CreateResult(
+            id_=f"{props.get('host')}:{props.get('remote_dir')}", outs=outs
+        )
+
+    def update(self, id: str, old_props: Any, new_props: Any) -> UpdateResult:
+        outs = self._sync(new_props)
+        return UpdateResult(outs=outs)
+
+    def delete(self, id: str, props: Any) -> None:
+        remote_dir = props.get("remote_dir").rstrip("/")
+        sudo = "sudo " if props.get("use_sudo") else ""
+        files = list(props.get("files") or []) + [SYNC_HASH_FILENAME]
+        quoted_files = " ".join(shlex.quote(f"{remote_dir}/{file}") for file in files)
+        with self._ssh(props) as ssh:
+            self._run(ssh, f"{sudo}rm -f {quoted_files}")
+        return
+
+
+class SyncDirectoryToRemoteHost(Resource):
+    content_hash: Output[str]
+    files: Output[List[str]]
+
+    def __init__(
+        self,
+        resource_name,
+        sync_directory_args: SyncDirectoryToRemoteHostArgs,
+        opts: Optional[ResourceOptions] = None,
+    ):
+        full_args = {"files": None, **vars(sync_directory_args)}
+        super().__init__(
+            SyncDirectoryToRemoteHostProvider(), resource_name, full_args, opts
+        )
@@ -1,8 +1,8 @@
-from typing import Optional, Union
+from typing import Any, Optional, Union
 
 import pulumi
 from pulumi import Input, Output, ResourceOptions
-from pulumi.dynamic import CreateResult, Resource, ResourceProvider
+from pulumi.dynamic import CreateResult, Resource, ResourceProvider, UpdateResult
 
 from pulumi_mrsharky.common.remote import RemoteMethods
 
@@ -15,6 +15,8 @@ class WaitForHostArgs(object):
     max_wait_for_reboot_in_seconds: Input[int]
     password: Optional[Input[str]]
     private_key: Optional[Input[str]]
+    previous_boot_id: Optional[Input[str]]
+    max_wait_for_shutdown_in_seconds: Optional[Input[int]]
 
     def __init__(
         self,
@@ -24,6 +26,8 @@ class WaitForHostArgs(object):
         max_wait_for_reboot_in_seconds: Input[int] = 300,
         password: Optional[Union[Input[str], str]] = None,
         private_key: Optional[Union[Input[str], str]] = None,
+        previous_boot_id: Optional[Union[Input[str], str]] = None,
+        max_wait_for_shutdown_in_seconds: Optional[Input[int]] = None,
     ) -> None:
         self.host = host
         self.port = port
@@ -31,11 +35,15 @@ class WaitForHostArgs(object):
         self.password = password
         self.private_key = private_key
         self.max_wait_for_reboot_in_seconds = max_wait_for_reboot_in_seconds
+        # If given, also wait until the host is on a different boot than this one
+        self.previous_boot_id = previous_boot_id
+        # With previous_boot_id, fail early if the host never goes down
+        self.max_wait_for_shutdown_in_seconds = max_wait_for_shutdown_in_seconds
         return
 
 
 class WaitForHostProvider(ResourceProvider):
-    def create(self, props):
+    def _wait(self, props: Any) -> dict:
         host = props.get("host")
         port = int(
             props.get("port", 22)
@@ -46,21 +54,40 @@ class WaitForHostProvider(ResourceProvider):
         max_wait_for_reboot_in_seconds = int(
             props.get("max_wait_for_reboot_in_seconds", 300)
         )
+        previous_boot_id = props.get("previous_boot_id", None)
+        max_wait_for_shutdown_in_seconds = props.get(
+            "max_wait_for_shutdown_in_seconds", None
+        )
+        if max_wait_for_shutdown_in_seconds is not None:
+            max_wait_for_shutdown_in_seconds = int(max_wait_for_shutdown_in_seconds)
 
         # Wait for remote host
-        finish_time = RemoteMethods.wait_for_remote_host(
+        finish_time, boot_id = RemoteMethods.wait_for_boot(
             host=host,
             user=user,
             port=port,
             password=password,
             private_key=private_key,
             max_wait_for_reboot_in_seconds=max_wait_for_reboot_in_seconds,
+            previous_boot_id=previous_boot_id,
+            max_wait_for_shutdown_in_seconds=max_wait_for_shutdown_in_seconds,
         )
-        return CreateResult(id_=host, outs={"finish_time": finish_time})
+        return {"finish_time": finish_time, "boot_id": boot_id}
+
+    def create(self, props: Any) -> CreateResult:
+        outs = self._wait(props)
+        return CreateResult(id_=props.get("host"), outs=outs)
+
+    def update(self, id: str, old_props: Any, new_props: Any) -> UpdateResult:
+        # A changed input (i.e. a new previous_boot_id after another reboot)
+        # means waiting on the host again, same as on create
+        outs = self._wait(new_props)
+        return UpdateResult(outs=outs)
 
 
 class WaitForHost(Resource):
     finish_time: Output[float]
+    boot_id: Output[str]
 
     def __init__(
         self,
@@ -68,5 +95,5 @@ class WaitForHost(Resource):
         wait_for_host_args: WaitForHostArgs,
         opts: Optional[ResourceOptions] = None,
     ):
-        full_args = {"finish_time": None, **vars(wait_for_host_args)}
+        full_args = {"finish_time": None, "boot_id": None, **vars(wait_for_host_args)}
         super().__init__(WaitForHostProvider(), resource_name, full_args, opts)
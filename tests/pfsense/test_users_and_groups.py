@@ -0,0 +1,150 @@
+from pulumi_mrsharky.pfsense.users_and_groups import (
+    GROUP_FIELDS,
+    USER_FIELDS,
+    _normalize,
+    plan_records,
+)
+
+CURRENT_USERS = [
+    {"id": 0, "name": "admin", "priv": ["page-all"], "descr": "System Admin"},
+    {"id": 1, "name": "alice", "priv": ["user-shell-access"], "descr": "Alice"},
+    {"id": 2, "name": "bob", "priv": [], "descr": "Bob"},
+    {"id": 3, "name": "carol", "descr": "Made by hand"},
+]
+
+
+def test_normalize_treats_unset_values_as_equal():
+    assert _normalize(False) is None
+    assert _normalize("") is None
+    assert _normalize([]) is None
+    assert _normalize(None) is None
+    assert _normalize(True) is True
+    assert _normalize(3) == "3"
+    assert _normalize((1, "a")) == ["1", "a"]
+    assert _normalize(["b", "a"]) == ["a", "b"]
+
+
+def test_only_previously_managed_records_are_deleted():
+    previous = [{"username": "alice"}, {"username": "bob"}, {"username": "dave"}]
+    desired = [{"username": "alice"}]
+
+    creates, patches, delete_ids = plan_records(
+        desired=desired,
+        current=CURRENT_USERS,
+        name_key="username",
+        fields=USER_FIELDS,
+        previous=previous,
+    )
+
+    # bob was managed and isn't wanted anymore, dave is already gone, admin and
+    # carol were never managed here
+    assert creates == []
+    assert patches == []
+    assert delete_ids == [2]
+
+
+def test_admin_and_unmanaged_records_are_never_touched():
+    desired = [{"username": "erin", "description": "Erin"}]
+
+    creates, patches, delete_ids = plan_records(
+        desired=desired,
+        current=CURRENT_USERS,
+        name_key="username",
+        fields=USER_FIELDS,
+        previous=[],
+    )
+
+    assert creates == [{"name": "erin", "descr": "Erin"}]
+    assert patches == []
+    assert delete_ids == []
+
+
+def test_only_changed_fields_are_patched():
+    desired = [
+        # Same as pfSense, with unset values spelled differently
+        {"username": "bob", "description": "Bob", "privileges": None},
+        {"username": "alice", "description": "Alice", "disable": False},
+        {"username": "carol", "description": "Carol"},
+    ]
+
+    creates, patches, delete_ids = plan_records(
+        desired=desired,
+        current=CURRENT_USERS,
+        name_key="username",
+        fields=USER_FIELDS,
+        previous=[],
+    )
+
+    assert creates == []
+    assert patches == [{"id": 3, "name": "carol", "descr": "Carol"}]
+    assert delete_ids == []
+
+
+def test_passwords_are_only_sent_when_new_or_changed():
+    previous = [
+        {"username": "alice", "password": "same"},
+        {"username": "bob", "password": "old"},
+    ]
+    desired = [
+        {"username": "alice", "password": "same", "description": "Alice"},
+        {"username": "bob", "password": "new", "description": "Bob"},
+        # Exists on pfSense, but is new to this resource
+        {"username": "carol", "password": "carol", "description": "Made by hand"},
+        {"username": "erin", "password": "erin"},
+    ]
+
+    creates, patches, delete_ids = plan_records(
+        desired=desired,
+        current=CURRENT_USERS,
+        name_key="username",
+        fields=USER_FIELDS,
+        previous=previous,
+    )
+
+    assert creates == [{"name": "erin", "password": "erin"}]
+    assert patches == [
+        {"id": 2, "name": "bob", "password": "new"},
+        {"id": 3, "name": "carol", "password": "carol"},
+    ]
+    assert delete_ids == []
+
+
+def test_groups_are_matched_by_group_name():
+    current = [
+        {"id": 0, "name": "admins", "scope": "system", "member": ["admin"]},
+        {"id": 1, "name": "ops", "scope": "local", "member": ["alice"]},
+    ]
+    desired = [{"group_name": "ops", "scope": "local", "members": ["alice", "bob"]}]
+
+    creates, patches, delete_ids = plan_records(
+        desired=desired,
+        current=current,
+        name_key="group_name",
+        fields=GROUP_FIELDS,
+        previous=[{"group_name": "ops"}],
+    )
+
+    assert creates == []
+    assert patches == [{"id": 1, "name": "ops", "member": ["alice", "bob"]}]
+    assert delete_ids == []
+
+
+def test_list_fields_are_compared_regardless_of_order():
+    current = [
+        {"id": 1, "name": "ops", "member": ["alice", "bob"], "priv": ["b", "a"]},
+    ]
+    desired = [
+        {"group_name": "ops", "members": ["bob", "alice"], "privileges": ["a", "b"]}
+    ]
+
+    creates, patches, delete_ids = plan_records(
+        desired=desired,
+        current=current,
+        name_key="group_name",
+        fields=GROUP_FIELDS,
+        previous=[{"group_name": "ops"}],
+    )
+
+    assert creates == []
+    assert patches == []
+    assert delete_ids == []
@@ -0,0 +1,136 @@
+import os
+import subprocess
+
+import pytest
+from pulumi_mrsharky.proxmox import clone_spec
+from pulumi_mrsharky.proxmox.clone_spec import clone_spec_statements
+
+FAKE_QM = """#!/bin/sh
+# Records every call, keeps "VMs" as files in $VM_DIR
+echo "$@" >> "$QM_LOG"
+case "$1" in
+    status) [ -f "$VM_DIR/$2" ] ;;
+    clone) touch "$VM_DIR/$3" ;;
+    destroy) rm -f "$VM_DIR/$2" ;;
+esac
+"""
+
+DELETE_SCRIPT = ["qm destroy 100"]
+KEEP_SCRIPT = ["qm set 100 --memory 4096"]
+
+
+@pytest.fixture
+def host(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    qm = bin_dir / "qm"
+    qm.write_text(FAKE_QM)
+    qm.chmod(0o755)
+    (tmp_path / "vms").mkdir()
+    monkeypatch.setattr(clone_spec, "VM_CLONE_SPEC_DIR", str(tmp_path / "specs"))
+    env = {
+        **os.environ,
+        "PATH": f"{bin_dir}:{os.environ['PATH']}",
+        "QM_LOG": str(tmp_path / "qm.log"),
+        "VM_DIR": str(tmp_path / "vms"),
+    }
+    return tmp_path, env
+
+
+def _run(env, statement):
+    subprocess.run(["bash", "-c", statement], env=env, check=True)
+
+
+def _qm_calls(tmp_path):
+    log = tmp_path / "qm.log"
+    if not log.exists():
+        return []
+    return [line.split()[0] for line in log.read_text().splitlines()]
+
+
+def test_existing_vm_without_spec_is_adopted(host):
+    tmp_path, env = host
+    (tmp_path / "vms" / "100").touch()
+
+    # The clone command was reworded (i.e. wrapped in a clone slot)
+    _, update = clone_spec_statements(
+        vm_id=100,
+        clone_spec="template=9001 clone_mode=full storage=local-lvm",
+        create_script=["bash -c 'qm clone 9001 100 --full 1'"] + KEEP_SCRIPT,
+        delete_script=DELETE_SCRIPT,
+        keep_script=KEEP_SCRIPT,
+    )
+    _run(env, update)
+
+    assert _qm_calls(tmp_path) == ["status", "set"]
+    assert (tmp_path / "vms" / "100").exists()
+    assert (tmp_path / "specs" / "100").read_text().strip() == (
+        "template=9001 clone_mode=full storage=local-lvm"
+    )
+
+
+def test_missing_vm_without_spec_is_cloned(host):
+    tmp_path, env = host
+
+    _, update = clone_spec_statements(
+        vm_id=100,
+        clone_spec="template=9001 clone_mode=full storage=local-lvm",
+        create_script=["qm clone 9001 100 --full 1"] + KEEP_SCRIPT,
+        delete_script=DELETE_SCRIPT,
+        keep_script=KEEP_SCRIPT,
+    )
+    _run(env, update)
+
+    assert _qm_calls(tmp_path) == ["status", "clone", "set"]
+
+
+def test_only_a_different_spec_recreates_the_vm(host):
+    tmp_path, env = host
+    create, _ = clone_spec_statements(
+        vm_id=100,
+        clone_spec="template=9001 clone_mode=full storage=local-lvm",
+        create_script=["qm clone 9001 100 --full 1"],
+        delete_script=DELETE_SCRIPT,
+    )
+    _run(env, " && ".join(create))
+
+    # Same spec, different wording: only updated in place
+    _, update = clone_spec_statements(
+        vm_id=100,
+        clone_spec="template=9001 clone_mode=full storage=local-lvm",
+        create_script=["bash -c 'qm clone 9001 100 --full 1'"] + KEEP_SCRIPT,
+        delete_script=DELETE_SCRIPT,
+        keep_script=KEEP_SCRIPT,
+    )
+    _run(env, update)
+    assert _qm_calls(tmp_path) == ["clone", "set"]
+
+    # Different template: destroyed and cloned again
+    _, update = clone_spec_statements(
+        vm_id=100,
+        clone_spec="template=9002 clone_mode=full storage=local-lvm",
+        create_script=["qm clone 9002 100 --full 1"],
+        delete_script=DELETE_SCRIPT,
+    )
+    _run(env, update)
+    assert _qm_calls(tmp_path) == ["clone", "set", "destroy", "clone"]
+
+
+def test_adopted_linked_clone_is_registered(host):
+    tmp_path, env = host
+    (tmp_path / "vms" / "100").touch()
+    marker = tmp_path / "linked-clones" / "9001" / "100"
+    register = [f"mkdir -p {marker.parent}", f"touch {marker}"]
+
+    # Created before specs were recorded, declared as a linked clone
+    _, update = clone_spec_statements(
+        vm_id=100,
+        clone_spec="template=9001 clone_mode=linked",
+        create_script=["qm clone 9001 100"] + register,
+        delete_script=DELETE_SCRIPT,
+        keep_script=register,
+    )
+    _run(env, update)
+
+    assert _qm_calls(tmp_path) == ["status"]
+    assert marker.exists()
@@ -0,0 +1,63 @@
+from pulumi_mrsharky.proxmox.vm_config import VmConfig
+
+
+class FakeInventory:
+    def invalidate_vm(self, node_name, vm_id):
+        return
+
+
+class FakeEndpoint:
+    def __init__(self, connection, path):
+        self.connection = connection
+        self.path = path
+
+    def get(self):
+        return {"digest": "abc123"}
+
+    def put(self, **params):
+        self.connection.puts.append((self.path, params))
+
+
+class FakeProxmoxConnection:
+    def __init__(self):
+        self.inventory = FakeInventory()
+        self.puts = []
+        self.ssh_commands = []
+
+    def proxmox_api(self, path):
+        return FakeEndpoint(self, path)
+
+    def _run_ssh_command(self, command):
+        self.ssh_commands.append(command)
+        return "", ""
+
+
+def test_api_changes_are_a_single_put():
+    connection = FakeProxmoxConnection()
+    VmConfig(connection, node_name="pve", vm_id=100, digest="def456").set(
+        "cores", 4
+    ).set("onboot", True).delete("scsi3").apply()
+
+    assert connection.ssh_commands == []
+    assert connection.puts == [
+        (
+            "/nodes/pve/qemu/100/config",
+            {"cores": 4, "onboot": 1, "delete": "scsi3", "digest": "def456"},
+        )
+    ]
+
+
+def test_root_only_changes_run_qm_set_under_sudo():
+    # The way VmSettings applies args / hostpci* changes
+    connection = FakeProxmoxConnection()
+    root_changes = VmConfig(connection, node_name="pve", vm_id=100)
+    root_changes.set("hostpci0", "0000:01:00,pcie=1").set(
+        "args", "-cpu host,kvm=off"
+    ).apply()
+
+    assert connection.puts == []
+    assert connection.ssh_commands == [
+        "sudo qm set 100 --hostpci0 0000:01:00,pcie=1 "
+        + "--args '-cpu host,kvm=off' --digest abc123"
+    ]
+    assert root_changes.is_empty()
@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import pulumi
+
+from pulumi_mrsharky.remote.run_commands_on_host import RunCommandsOnHost
+
+
+class NoResourceMocks(pulumi.runtime.Mocks):
+    def new_resource(self, args: pulumi.runtime.MockResourceArgs):
+        return [f"{args.name}_id", args.inputs]
+
+    def call(self, args: pulumi.runtime.MockCallArgs):
+        return {}
+
+
+pulumi.runtime.set_mocks(NoResourceMocks())
+
+
+def _legacy_generate_outputs_from_string_list(statements, use_sudo=False):
+    # The previous implementation, two chained applies per statement
+    combined_statements = pulumi.Output.all(x="").apply(lambda args: f"{args['x']}")
+    sudo = ""
+    if use_sudo:
+        sudo = "sudo"
+    for idx, statement in enumerate(statements):
+        combined_statements = pulumi.Output.all(
+            x=combined_statements,
+            y=statement,
+        ).apply(lambda args: f"{args['x']} {sudo} {args['y']}")
+        if idx < len(statements) - 1:
+            combined_statements = pulumi.Output.all(
+                x=combined_statements, y=" && "
+            ).apply(lambda args: f"{args['x']} {args['y']}")
+    return combined_statements
+
+
+@pulumi.runtime.test
+def test_generate_outputs_matches_legacy_format():
+    statements = [
+        "qm set 100 --cores 4",
+        pulumi.Output.from_input("qm set 100 --memory 2048"),
+        "qm start 100",
+    ]
+    new = RunCommandsOnHost._generate_outputs_from_string_list(statements, True)
+    legacy = _legacy_generate_outputs_from_string_list(statements, True)
+
+    def check(args):
+        assert args[0] == args[1]
+        assert args[0] == (
+            " sudo qm set 100 --cores 4  &&  sudo qm set 100 --memory 2048  && "
+            + " sudo qm start 100"
+        )
+
+    return pulumi.Output.all(new, legacy).apply(check)
+
+
+def _resolve(output: pulumi.Output):
+    return asyncio.get_event_loop().run_until_complete(output.future())
+
+
+def benchmark_generate_outputs(sizes=(10, 100, 1000)):
+    """
+    Time building (and resolving) the composed command for scripts of various
+    sizes, old implementation vs new.
+    """
+    for size in sizes:
+        statements = [f"echo {idx}" for idx in range(size)]
+        for label, compose in [
+            ("legacy", _legacy_generate_outputs_from_string_list),
+            ("flat", RunCommandsOnHost._generate_outputs_from_string_list),
+        ]:
+            start = time.perf_counter()
+            output = compose(statements, True)
+            built = time.perf_counter()
+            _resolve(output)
+            resolved = time.perf_counter()
+            print(
+                f"{size:>5} statements | {label:>6} | "
+                f"build: {(built - start) * 1000:8.2f} ms | "
+                f"resolve: {(resolved - built) * 1000:8.2f} ms"
+            )
+    return
+
+
+if __name__ == "__main__":
+    test_generate_outputs_matches_legacy_format()
+    benchmark_generate_outputs()